@@ -0,0 +1,178 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import chess
+import numpy
+
+from chess_api.chess_player import CustomEngine, load_network
+from database.database_random import random_board
+from database.engine_pool import configure_engine_pool
+from database.fake_engine import FAKE_ENGINE_COMMAND
+from database.label_cache import configure_label_cache
+from database.util import board_to_obs, board_to_obs_batch, save_dataset, load_datasets, label_boards
+from neural_network.nnue import NNUEModel, FEATURES
+
+# This file contains the benchmarks of the bench package
+# Every benchmark gets a BenchContext and returns its metrics as {name: Metric}
+# All positions come from seeded random number generators, so every run measures the same work
+
+# Positions the search benchmarks think about, from the opening to the endgame
+SEARCH_POSITIONS = [
+    chess.STARTING_FEN,
+    "r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"
+]
+
+
+# A measured value, higher_is_better tells a comparison of two runs which direction is a regression
+class Metric(dict):
+    def __init__(self, value: float, unit: str, higher_is_better: bool = True):
+        super().__init__(value=value, unit=unit, higher_is_better=higher_is_better)
+
+
+# Everything the benchmarks share: the random generator, the size of the workload and the network
+# Without a model path, a NNUE network with random weights is used, which needs no model file and no TensorFlow
+class BenchContext:
+    def __init__(self, model_path: str = None, quick: bool = False, seed: int = 0, repeats: int = 5):
+        self.model_path = model_path
+        self.quick = quick
+        self.seed = seed
+        self.repeats = repeats
+        self._network = None
+        self._boards = {}
+
+    def scale(self, size: int):
+        return max(size // 10, 1) if self.quick else size
+
+    # The same boards for every benchmark that asks for the same count
+    def boards(self, count: int):
+        if count not in self._boards:
+            rng = random.Random(self.seed)
+            self._boards[count] = [random_board(rng=rng) for _ in range(count)]
+        return self._boards[count]
+
+    @property
+    def network(self):
+        if self._network is None:
+            self._network = load_network(self.model_path) if self.model_path is not None else random_nnue(self.seed)
+        return self._network
+
+
+def random_nnue(seed: int = 0, accumulator_size: int = 256, hidden_size: int = 32):
+    rng = numpy.random.default_rng(seed)
+    model = NNUEModel()
+    sizes = [FEATURES, accumulator_size, hidden_size, 1]
+    for inputs, outputs in zip(sizes[:-1], sizes[1:]):
+        kernel = rng.normal(0, 1 / numpy.sqrt(inputs), (inputs, outputs)).astype(numpy.float32)
+        model.layers.append((kernel, numpy.zeros(outputs, dtype=numpy.float32)))
+    return model
+
+
+# Runs the function repeats times and returns the median of the seconds it took
+# The median is less affected by other processes than the mean
+def measure(function, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_encoder(context: BenchContext):
+    boards = context.boards(context.scale(2_000))
+    single = measure(lambda: [board_to_obs(board) for board in boards], context.repeats)
+    batch = measure(lambda: board_to_obs_batch(boards), context.repeats)
+    return {
+        "board_to_obs": Metric(len(boards) / single, "positions/sec"),
+        "board_to_obs_batch": Metric(len(boards) / batch, "positions/sec")
+    }
+
+
+def bench_random_board(context: BenchContext):
+    count = context.scale(500)
+    rng = random.Random(context.seed)
+    seconds = measure(lambda: [random_board(rng=rng) for _ in range(count)], context.repeats)
+    return {"random_board": Metric(count / seconds, "boards/sec")}
+
+
+def bench_inference(context: BenchContext):
+    network = context.network
+    boards = context.boards(context.scale(1_024))
+    network.predict_evaluations(boards[:8])  # Warm up, e.g. the first call of a keras model builds its graph
+    board = boards[0]
+    single = measure(lambda: network.predict_evaluations([board]), context.repeats * 20)
+    batch = measure(lambda: network.predict_evaluations(boards), context.repeats)
+    return {
+        "predict_batch_1_latency": Metric(single * 1000, "ms", higher_is_better=False),
+        # The batch has fewer boards with --quick, runs are only compared if both used the same setting
+        "predict_batch_latency": Metric(batch * 1000, "ms", higher_is_better=False),
+        "predict_batch_throughput": Metric(len(boards) / batch, "positions/sec")
+    }
+
+
+def bench_search(context: BenchContext):
+    depth = 2 if context.quick else 3
+    positions = [chess.Board(fen) for fen in SEARCH_POSITIONS]
+    nodes = 0
+    seconds = 0
+    moves = 0
+    for board in positions:
+        # A fresh engine per position, so no position profits from the caches of another
+        engine = CustomEngine(context.network, depth=depth)
+        start = time.perf_counter()
+        engine.get_move(board)
+        seconds += time.perf_counter() - start
+        nodes += engine.search.nodes
+        moves += 1
+    return {
+        "get_move_latency": Metric(seconds / moves * 1000, "ms", higher_is_better=False),
+        "search_nodes_per_second": Metric(nodes / seconds, "nodes/sec"),
+        "search_nodes": Metric(nodes, "nodes", higher_is_better=False)
+    }
+
+
+def bench_dataset_load(context: BenchContext):
+    samples = context.scale(20_000)
+    rng = numpy.random.default_rng(context.seed)
+    x_train = rng.integers(0, 2, (samples, 14, 8, 8), dtype=numpy.int8)
+    y_train = rng.random(samples, dtype=numpy.float32)
+    with tempfile.TemporaryDirectory() as folder:
+        save_dataset(folder, x_train, y_train, file_name="bench.shard")
+        open_seconds = measure(lambda: load_datasets(folder), context.repeats)
+        read_seconds = measure(lambda: numpy.asarray(load_datasets(folder)[0]), context.repeats)
+        size = sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+    return {
+        "dataset_open": Metric(open_seconds * 1000, "ms", higher_is_better=False),
+        "dataset_read": Metric(samples / read_seconds, "samples/sec"),
+        "dataset_bytes_per_sample": Metric(size / samples, "bytes", higher_is_better=False)
+    }
+
+
+# Labels positions with the fake engine, which answers instantly, so this measures our side of labeling:
+# the engine pool, the UCI communication and the conversion of the results
+def bench_labeling(context: BenchContext):
+    boards = context.boards(context.scale(200))
+    pool = configure_engine_pool(engine_path=FAKE_ENGINE_COMMAND, size=2)
+    configure_label_cache(None)
+    try:
+        label_boards(boards[:2], depth=4)  # Starts the engines
+        seconds = measure(lambda: label_boards(boards, depth=4), max(context.repeats // 2, 1))
+    finally:
+        pool.close()
+    return {"labeling": Metric(len(boards) / seconds, "labels/sec")}
+
+
+BENCHMARKS = {
+    "encoder": bench_encoder,
+    "random_board": bench_random_board,
+    "inference": bench_inference,
+    "search": bench_search,
+    "dataset_load": bench_dataset_load,
+    "labeling": bench_labeling
+}
@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import chess
+import numpy
+
+from bench.benchmarks import BENCHMARKS, BenchContext
+
+# This file runs the benchmarks and compares runs with each other
+# python -m bench [--model <path>] [--only encoder search ...] [--output result.json] [--compare baseline.json]
+# A result file contains the machine the benchmarks ran on, so only runs of the same machine should be compared
+
+RESULTS_FOLDER = os.path.join("bench", "results")
+
+# A metric is reported as regression if it got worse by more than this share
+REGRESSION_TOLERANCE = 0.1
+
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "numpy": numpy.__version__,
+        "python-chess": chess.__version__,
+        "commit": _git_commit()
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Runs the given benchmarks (all by default) and writes the result as json to output_path
+def run_benchmarks(names=None, model_path: str = None, quick: bool = False, seed: int = 0, output_path: str = None):
+    context = BenchContext(model_path, quick, seed)
+    result = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "machine": machine_info(),
+        "model": model_path or "random nnue",
+        "quick": quick,
+        "benchmarks": {}
+    }
+    for name in names or BENCHMARKS:
+        start = time.time()
+        metrics = BENCHMARKS[name](context)
+        result["benchmarks"][name] = metrics
+        for metric, value in metrics.items():
+            print(f"{name:>14} | {metric:<28} {value['value']:>14.2f} {value['unit']}")
+        print(f"{name:>14} | finished in {time.time() - start:.1f} seconds")
+
+    if output_path is None:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        output_path = os.path.join(RESULTS_FOLDER, datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".json")
+    with open(output_path, "w") as file:
+        json.dump(result, file, indent=1)
+    print(f"Results written to {output_path}")
+    return result
+
+
+# Compares two results and returns the metrics that got worse by more than the tolerance
+# as (benchmark, metric, baseline value, current value, relative change)
+def compare_results(baseline: dict, current: dict, tolerance: float = REGRESSION_TOLERANCE):
+    regressions = []
+    for name, metrics in current["benchmarks"].items():
+        for metric, value in metrics.items():
+            old = baseline["benchmarks"].get(name, {}).get(metric)
+            if old is None or old["value"] == 0:
+                continue
+            change = (value["value"] - old["value"]) / abs(old["value"])
+            worse = -change if value["higher_is_better"] else change
+            if worse > tolerance:
+                regressions.append((name, metric, old["value"], value["value"], change))
+    return regressions
+
+
+# Runs with and without --quick measure different workloads, comparing them is refused
+def print_comparison(baseline: dict, current: dict, tolerance: float = REGRESSION_TOLERANCE):
+    if baseline.get("quick", False) != current.get("quick", False):
+        raise ValueError("Only runs that both used --quick or both did not can be compared")
+    machines = [{key: value for key, value in result["machine"].items() if key != "commit"}
+                for result in (baseline, current)]
+    if machines[0] != machines[1]:
+        print("The runs were made on different machines, the comparison may be misleading")
+    regressions = compare_results(baseline, current, tolerance)
+    for name, metric, old, new, change in regressions:
+        print(f"Regression: {name} {metric}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+    if not regressions:
+        print(f"No regressions of more than {tolerance:.0%}")
+    return regressions
+
+
+def load_result(path: str):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bench", description="Benchmarks of SupervisedChess")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--model", help="model path, a random NNUE network by default")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads, e.g. for a quick check")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file of the result")
+    parser.add_argument("--compare", help="json file of an earlier result to check for regressions")
+    arguments = parser.parse_args(argv)
+    baseline = load_result(arguments.compare) if arguments.compare is not None else None
+    # Checked before the benchmarks run, so a wrong --quick flag does not cost a whole run
+    if baseline is not None and baseline.get("quick", False) != arguments.quick:
+        parser.error(f"{arguments.compare} was {'' if baseline.get('quick', False) else 'not '}run with --quick, "
+                     f"use the same setting to compare against it")
+    result = run_benchmarks(arguments.only, arguments.model, arguments.quick, arguments.seed, arguments.output)
+    if baseline is not None:
+        if print_comparison(baseline, result):
+            sys.exit(1)
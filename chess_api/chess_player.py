@@ -1,18 +1,39 @@
+import hashlib
+import os
 import random
+import sys
+from typing import TYPE_CHECKING
 
 import chess
-from keras.models import Model
+import chess.engine
+import numpy
 
-from neural_network.evaluation import BoardEvaluationNetwork
+from instrumentation.spans import traced
+from neural_network.evaluation_cache import EvaluationCache
+from neural_network.nnue import NNUEModel
+from neural_network.numpy_inference import NumpyEvaluationNetwork, NUMPY_MODEL_EXTENSION
+from neural_network.quantization import QuantizedEvaluationNetwork, QUANTIZED_MODEL_EXTENSION
+from neural_network.search import SearchEngine
+
+# Keras and TensorFlow take seconds to import, so they are only imported once a keras model is actually loaded
+if TYPE_CHECKING:
+    from neural_network.evaluation import BoardEvaluationNetwork
+
+# Keras models are converted to a NumpyModel the first time they are loaded and saved with this extension
+# in the model cache folder, never next to the model itself
+NUMPY_CACHE_EXTENSION = ".cache" + NUMPY_MODEL_EXTENSION
+MODEL_CACHE_FOLDER = os.environ.get("MODEL_CACHE_FOLDER",
+                                    os.path.join(os.path.expanduser("~"), ".cache", "supervised_chess"))
 
 
 # An interface for the Interactive Board
 # Used to transform bots, humans and engines into a usable player easily
+# The limit tells an engine how long it may think (time per move, nodes, depth or a chess clock)
 class ChessPlayer:
     def __init__(self, is_human=False):
         self.is_human = is_human
 
-    def get_move(self, board: chess.Board):
+    def get_move(self, board: chess.Board, limit: chess.engine.Limit = None):
         raise NotImplementedError
 
 
@@ -23,17 +44,88 @@ class RandomEngine(ChessPlayer):
         super().__init__()
         self.__name__ = "Random Move Engine"
 
-    def get_move(self, board: chess.Board):
+    def get_move(self, board: chess.Board, limit: chess.engine.Limit = None):
         return random.choice(list(board.legal_moves))
 
 
 # A custom engine using the board evaluation network
+# The network evaluates the leaves of an alpha beta search
+# Without a limit the search goes up to the given depth
+# Engines playing at the same time can share one network by passing the same InferenceServer as model,
+# see the threads of run_match
+# Evaluations are cached across moves and games, engines with the same model can also share a cache
+# NNUE networks get no cache by default, see uses_evaluation_cache
 class CustomEngine(ChessPlayer):
-    def __init__(self, model: BoardEvaluationNetwork):
+    def __init__(self, model: "BoardEvaluationNetwork", depth: int = 3, verbose: bool = False,
+                 cache: EvaluationCache = None):
         super().__init__()
         self.model = model
+        self.cache = cache if cache is not None or not uses_evaluation_cache(model) else EvaluationCache()
+        self.search = SearchEngine(model, max_depth=depth, verbose=verbose, cache=self.cache)
         self.__name__ = "Custom Engine"
 
-    def get_move(self, board: chess.Board):
-        return self.model.get_move(board)
-        # return self.model.get_move_minimax(board, depth=1)
+    @traced("player.get_move")
+    def get_move(self, board: chess.Board, limit: chess.engine.Limit = None):
+        return self.search.search(board, limit).move
+
+
+# Whether an evaluation cache makes the search of a network faster
+# A NNUE network evaluates an updated accumulator in a few microseconds, which is less than a cache lookup
+# and insert cost, so its search is faster without cache. All other networks take a lot longer per position
+def uses_evaluation_cache(model):
+    return not isinstance(model, NNUEModel)
+
+
+# Loads the network of a CustomEngine by its file type
+# .npz files are either an exported NumpyModel (with a graph) or the weights of a NNUE network,
+# .tflite files are int8 quantized models (see quantization.py), every other file is loaded as keras model
+# A keras model is converted to a NumpyModel on its first load (see numpy_inference.py), later runs load the converted
+# file, which needs neither TensorFlow nor keras and starts a lot faster. It is converted again if the model changes
+# The converted file is written to MODEL_CACHE_FOLDER (see numpy_cache_path), use_cache=False neither reads nor writes it
+# threads limits the threads of TensorFlow for keras models, where it has to be set before TensorFlow runs,
+# and the threads of the interpreter for quantized models
+def load_network(model_path: str, use_cache: bool = True, threads: int = None):
+    if model_path.endswith(QUANTIZED_MODEL_EXTENSION):
+        return QuantizedEvaluationNetwork(model_path, threads)
+    if model_path.endswith(NUMPY_MODEL_EXTENSION):
+        with numpy.load(model_path, allow_pickle=False) as data:
+            is_numpy_model = "graph" in data.files
+        return NumpyEvaluationNetwork(model_path) if is_numpy_model else NNUEModel(model_path)
+
+    cache_path = numpy_cache_path(model_path)
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(model_path):
+        return NumpyEvaluationNetwork(cache_path)
+
+    if threads is not None:
+        _set_tensorflow_threads(threads)
+    from neural_network.evaluation import BoardEvaluationNetwork
+    network = BoardEvaluationNetwork(model_path)
+    if use_cache:
+        # Models with layers the NumpyModel does not support are simply loaded with keras every time
+        temporary_path = cache_path[:-len(NUMPY_CACHE_EXTENSION)] + ".tmp" + NUMPY_MODEL_EXTENSION
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            network.export_numpy_model(temporary_path)
+            os.replace(temporary_path, cache_path)
+            print(f"Saved the converted model to {cache_path}", file=sys.stderr)
+        except (ValueError, OSError):
+            pass
+    return network
+
+
+# The path of the converted model in the cache folder
+# The name contains a hash of the absolute model path, so models with the same file name in other folders do not collide
+def numpy_cache_path(model_path: str):
+    model_path = os.path.abspath(model_path).rstrip(os.sep)
+    digest = hashlib.sha1(model_path.encode()).hexdigest()[:16]
+    return os.path.join(MODEL_CACHE_FOLDER, f"{os.path.basename(model_path)}-{digest}{NUMPY_CACHE_EXTENSION}")
+
+
+# TensorFlow only accepts thread settings before it ran its first operation
+def _set_tensorflow_threads(threads: int):
+    import tensorflow
+    try:
+        tensorflow.config.threading.set_intra_op_parallelism_threads(threads)
+        tensorflow.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        print("TensorFlow is already initialized, the number of threads stays unchanged", file=sys.stderr)
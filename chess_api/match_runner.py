@@ -0,0 +1,319 @@
+import dataclasses
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+import chess.pgn
+
+from chess_api.chess_player import ChessPlayer, RandomEngine, CustomEngine, load_network
+from database.pgn_index import stream_games
+from neural_network.inference_server import InferenceServer
+
+# This file plays matches between two ChessPlayers without the gui
+# The games are spread over a pool of worker processes, every worker creates both players once and keeps them warm.
+# Players can not be sent to other processes (e.g. a loaded network), so a match gets player factories instead:
+# functions without arguments that create the player, e.g. functools.partial(custom_player, model_path)
+# Every opening is played twice with swapped colors, so neither player profits from a good or bad opening
+# A worker can also play several games at the same time in threads. Every thread gets its own players,
+# but custom players of the same model share one network through an InferenceServer,
+# which evaluates the positions of all running searches in common batches
+
+# Openings that are used if no opening suite is given, in UCI notation
+DEFAULT_OPENINGS = [
+    "e2e4 e7e5 g1f3 b8c6 f1b5",
+    "e2e4 e7e5 g1f3 b8c6 f1c4",
+    "e2e4 c7c5 g1f3 d7d6 d2d4",
+    "e2e4 c7c5 b1c3 b8c6 g2g3",
+    "e2e4 e7e6 d2d4 d7d5 b1c3",
+    "e2e4 c7c6 d2d4 d7d5 e4e5",
+    "d2d4 d7d5 c2c4 e7e6 b1c3",
+    "d2d4 d7d5 c2c4 c7c6 g1f3",
+    "d2d4 g8f6 c2c4 e7e6 b1c3",
+    "d2d4 g8f6 c2c4 g7g6 b1c3",
+    "c2c4 e7e5 b1c3 g8f6 g2g3",
+    "g1f3 d7d5 g2g3 g8f6 f1g2"
+]
+
+# A move may take this many times its time limit plus the tolerance before it loses on time
+TIME_FORFEIT_FACTOR = 2
+TIME_TOLERANCE = 0.1
+
+# A game is adjudicated as a win once one side is this many pawns ahead for ADJUDICATION_PLIES half moves in a row,
+# and as a draw once it reaches MAX_PLIES half moves
+ADJUDICATION_MATERIAL = 10
+ADJUDICATION_PLIES = 8
+MAX_PLIES = 400
+
+MATERIAL_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 0
+}
+
+
+# Player factories for the worker processes
+def random_player():
+    return RandomEngine()
+
+
+def custom_player(model_path: str, depth: int = 3):
+    network = _shared_network(model_path) if _threads > 1 else load_network(model_path)
+    return CustomEngine(network, depth=depth)
+
+
+# The outcome of a match from the view of the first player
+@dataclasses.dataclass
+class MatchResult:
+    wins: int = 0
+    draws: int = 0
+    losses: int = 0
+    seconds: float = 0
+    terminations: dict = dataclasses.field(default_factory=dict)
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    @property
+    def score(self):
+        return (self.wins + self.draws / 2) / max(self.games, 1)
+
+    def games_per_hour(self):
+        return self.games / max(self.seconds, 1e-9) * 3600
+
+    # The Elo difference of the first player and the margin of its 95% confidence interval
+    def elo(self):
+        return elo_estimate(self.wins, self.draws, self.losses)
+
+    def summary(self):
+        elo, margin = self.elo()
+        return (f"Games: {self.games} | +{self.wins} ={self.draws} -{self.losses} | Score: {self.score:.3f} | "
+                f"Elo: {elo:+.1f} +/- {margin:.1f} | Games/hour: {self.games_per_hour():.0f}")
+
+
+# Estimates the Elo difference from the results of a match
+# The score of a game is 1, 0.5 or 0, its standard deviation gives the error of the mean score.
+# The interval of the mean score is a normal approximation with the observed deviation of the game scores.
+# Like a Wilson score interval its center is moved by z^2 / 2n and its variance grows by z^2 / 4n^2,
+# so it stays wide for small or one sided samples (e.g. only wins or only draws) where the observed deviation is 0.
+# Both ends are converted to Elo.
+# The score itself gets half a game on each side as prior, a perfect score does not mean an infinite difference
+def elo_estimate(wins: int, draws: int, losses: int):
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, math.inf
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    z = 1.96
+    denominator = 1 + z ** 2 / games
+    center = (score + z ** 2 / (2 * games)) / denominator
+    margin = z * math.sqrt(variance / games + z ** 2 / (4 * games ** 2)) / denominator
+    score = (wins + draws / 2 + 0.5) / (games + 1)
+    return _score_to_elo(score), (_score_to_elo(center + margin) - _score_to_elo(center - margin)) / 2
+
+
+def _score_to_elo(score: float):
+    score = min(max(score, 1e-3), 1 - 1e-3)
+    return 400 * math.log10(score / (1 - score))
+
+
+# Reads an opening suite: the main lines of a pgn file or one FEN / EPD position per line of any other file
+def load_openings(path: str):
+    if path.endswith(".pgn"):
+        openings = []
+        for game in stream_games(path):
+            board = game.board()
+            for move in game.mainline_moves():
+                board.push(move)
+            openings.append(board)
+        return openings
+
+    openings = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                openings.append(chess.Board(line))
+            except ValueError:
+                openings.append(chess.Board.from_epd(line)[0])
+    return openings
+
+
+# Plays a match of the given number of games between two players and returns the result from the view of player 1
+# openings can be a list of boards or the path of an opening suite, see load_openings
+# move_time is the time limit of every move in seconds, all games are appended to pgn_path if it is given
+# threads is the number of games every worker plays at the same time. They share the time of one process,
+# so the move time has to leave room for the searches of the other games
+def run_match(player_1, player_2, games: int = 100, workers: int = None, openings=None, move_time: float = 0.1,
+              pgn_path: str = None, names=None, max_plies: int = MAX_PLIES, threads: int = 1):
+    if openings is None:
+        openings = [_opening_board(line) for line in DEFAULT_OPENINGS]
+    elif isinstance(openings, str):
+        openings = load_openings(openings)
+    tasks = [(number, openings[(number // 2) % len(openings)], number % 2 == 0, move_time, max_plies)
+             for number in range(games)]
+    # A worker gets as many games at once as it plays at the same time
+    chunks = [tasks[start:start + threads] for start in range(0, len(tasks), threads)]
+
+    result = MatchResult()
+    start = time.time()
+    pgn_file = open(pgn_path, "a") if pgn_path is not None else None
+    try:
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(player_1, player_2, names, threads)) as pool:
+            for game in (game for chunk in pool.imap_unordered(_play_games, chunks) for game in chunk):
+                score = game["score"]
+                if score == 1:
+                    result.wins += 1
+                elif score == 0:
+                    result.losses += 1
+                else:
+                    result.draws += 1
+                result.terminations[game["termination"]] = result.terminations.get(game["termination"], 0) + 1
+                result.seconds = time.time() - start
+                if pgn_file is not None:
+                    pgn_file.write(game["pgn"] + "\n\n")
+                    pgn_file.flush()
+                print("\r", end="\r")
+                print(result.summary(), end="")
+    finally:
+        if pgn_file is not None:
+            pgn_file.close()
+    print()
+    return result
+
+
+def _opening_board(line: str):
+    board = chess.Board()
+    for move in line.split():
+        board.push_uci(move)
+    return board
+
+
+_factories = None
+_names = None
+_threads = 1
+_executor = None
+_local = threading.local()
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+# Every worker (and every thread of it) creates both players once, so networks are only loaded once per process
+def _init_worker(player_1, player_2, names, threads: int = 1):
+    global _factories, _names, _threads, _executor, _local
+    _factories = (player_1, player_2)
+    _local = threading.local()
+    _threads = threads
+    _executor = ThreadPoolExecutor(threads, thread_name_prefix="Game") if threads > 1 else None
+    _names = list(names) if names is not None else \
+        [_player_name(player, i + 1) for i, player in enumerate(_get_players())]
+
+
+# The players of the current thread
+def _get_players():
+    if not hasattr(_local, "players"):
+        _local.players = [factory() for factory in _factories]
+    return _local.players
+
+
+# The network of a model that all threads of a worker share
+def _shared_network(model_path: str):
+    with _servers_lock:
+        if model_path not in _servers:
+            _servers[model_path] = InferenceServer(load_network(model_path))
+        return _servers[model_path]
+
+
+def _player_name(player: ChessPlayer, number: int):
+    return f"{getattr(player, '__name__', type(player).__name__)} {number}"
+
+
+# Plays the games of a chunk, at the same time if the worker has threads
+def _play_games(chunk):
+    if _executor is None:
+        return [_play_game(arguments) for arguments in chunk]
+    return list(_executor.map(_play_game, chunk))
+
+
+# Plays one game from an opening and returns the score of player 1, the termination and the game as pgn
+def _play_game(arguments):
+    number, opening, player_1_white, move_time, max_plies = arguments
+    white, black = (0, 1) if player_1_white else (1, 0)
+    board = opening.copy()
+    limit = chess.engine.Limit(time=move_time)
+    players = _get_players()
+    winner, termination = play_game(board, players[white], players[black], limit, max_plies)
+
+    game = chess.pgn.Game.from_board(board)
+    game.headers["Event"] = "Match"
+    game.headers["Round"] = str(number + 1)
+    game.headers["White"] = _names[white]
+    game.headers["Black"] = _names[black]
+    game.headers["Termination"] = termination
+    result = "1/2-1/2" if winner is None else "1-0" if winner == chess.WHITE else "0-1"
+    game.headers["Result"] = result
+
+    if winner is None:
+        score = 0.5
+    else:
+        score = 1 if (winner == chess.WHITE) == player_1_white else 0
+    return {"score": score, "termination": termination, "pgn": str(game)}
+
+
+# Plays a game on the given board until it is over or adjudicated and returns the winner (None for a draw)
+# and the reason the game ended. A player that makes an illegal move or takes too long loses the game
+def play_game(board: chess.Board, white: ChessPlayer, black: ChessPlayer, limit: chess.engine.Limit,
+              max_plies: int = MAX_PLIES):
+    leader = None
+    advantage_plies = 0
+    plies = 0
+    while True:
+        outcome = board.outcome(claim_draw=True)
+        if outcome is not None:
+            return outcome.winner, outcome.termination.name.lower()
+        if plies >= max_plies:
+            return None, "adjudication"
+
+        player = white if board.turn == chess.WHITE else black
+        start = time.time()
+        move = player.get_move(board.copy(), limit)
+        elapsed = time.time() - start
+        if limit.time is not None and elapsed > limit.time * TIME_FORFEIT_FACTOR + TIME_TOLERANCE:
+            return not board.turn, "time forfeit"
+        if move is None or not board.is_legal(move):
+            return not board.turn, "illegal move"
+        board.push(move)
+        plies += 1
+
+        balance = _material_balance(board)
+        if abs(balance) < ADJUDICATION_MATERIAL:
+            leader = None
+            advantage_plies = 0
+        elif (balance > 0) == leader:
+            advantage_plies += 1
+        else:
+            leader = balance > 0
+            advantage_plies = 1
+        if advantage_plies >= ADJUDICATION_PLIES:
+            return leader, "adjudication"
+
+
+# The material of white minus the material of black in pawns
+def _material_balance(board: chess.Board):
+    return sum(value * (len(board.pieces(piece_type, chess.WHITE)) - len(board.pieces(piece_type, chess.BLACK)))
+               for piece_type, value in MATERIAL_VALUES.items())
+
+
+# Convenience and Testing function
+if __name__ == '__main__':
+    print(run_match(random_player, random_player, games=200, pgn_path="match.pgn").summary())
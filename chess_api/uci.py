@@ -0,0 +1,207 @@
+import sys
+import threading
+
+import chess
+import chess.engine
+
+from chess_api.chess_player import CustomEngine, load_network, uses_evaluation_cache
+from neural_network.evaluation_cache import EvaluationCache
+from neural_network.search import MATE_SCORE, MATE_PLY_PENALTY, SearchResult
+from neural_network.time_manager import MAX_SEARCH_DEPTH
+
+# This file lets tournament managers, test suites and analysis guis play with the network through the UCI protocol
+# python -m chess_api.uci <model path>
+# The model is loaded once and stays warm for all games. Searches run on a background thread,
+# so the engine keeps reading commands while it thinks and answers 'stop' and 'isready' right away
+
+ENGINE_NAME = "SupervisedChess"
+
+# Estimated memory of one transposition table slot
+# The hash is split between the table and the evaluation cache, networks without cache give it all to the table
+TT_ENTRY_SIZE = 200
+DEFAULT_HASH = 64
+DEFAULT_DEPTH = 3
+
+# Network scores lie in between -0.5 and 0.5, they are reported as centipawns with this factor
+CENTIPAWN_SCALE = 2000
+
+
+class UciEngine:
+    def __init__(self, model_path: str, depth: int = DEFAULT_DEPTH, output=sys.stdout):
+        self.model_path = model_path
+        self.output = output
+        self.options = {
+            "Hash": DEFAULT_HASH,
+            "Threads": 1,
+            "Depth": depth
+        }
+        self.board = chess.Board()
+        self.engine = None
+        self._output_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    # Reads commands until 'quit' or the end of the input
+    def run(self, commands=sys.stdin):
+        for line in commands:
+            if not self.handle(line):
+                break
+        self._stop_search()
+
+    # Handles one command and returns False if the engine should quit
+    def handle(self, line: str):
+        command, *arguments = line.split() or [""]
+        if command == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send("id author SupervisedChess")
+            self.send(f"option name Hash type spin default {DEFAULT_HASH} min 1 max 65536")
+            self.send("option name Threads type spin default 1 min 1 max 512")
+            self.send(f"option name Depth type spin default {self.options['Depth']} min 1 max {MAX_SEARCH_DEPTH}")
+            self.send("uciok")
+        elif command == "setoption":
+            self._set_option(arguments)
+        elif command == "isready":
+            self._load_engine()
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self._stop_search()
+            if self.engine is not None:
+                if self.engine.cache is not None:
+                    self.engine.cache.clear()
+                self.engine.search.table.clear()
+            self.board = chess.Board()
+        elif command == "position":
+            self._stop_search()
+            self.board = parse_position(arguments)
+        elif command == "go":
+            self._stop_search()
+            self._go(arguments)
+        elif command == "stop":
+            self._stop_search()
+        elif command == "quit":
+            return False
+        return True
+
+    def send(self, line: str):
+        with self._output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    # The network is only loaded once, later calls keep the warm model
+    # Threads is passed to TensorFlow while a keras model is loaded, which is why it only applies before the first
+    # 'isready' or 'go'. Numpy and NNUE models (including converted keras models) ignore it
+    def _load_engine(self):
+        if self.engine is None:
+            network = load_network(self.model_path, threads=self.options["Threads"])
+            self.engine = CustomEngine(network, depth=self.options["Depth"])
+            self._apply_option("Hash")
+        return self.engine
+
+    # setoption name <name> value <value>
+    def _set_option(self, arguments):
+        if "name" not in arguments:
+            return
+        value_index = arguments.index("value") if "value" in arguments else len(arguments)
+        name = " ".join(arguments[arguments.index("name") + 1:value_index])
+        value = " ".join(arguments[value_index + 1:])
+        for option in self.options:
+            if option.lower() == name.lower():
+                self.options[option] = int(value)
+                self._apply_option(option)
+
+    def _apply_option(self, option: str):
+        if self.engine is None:
+            return
+        if option == "Hash":
+            hash_bytes = self.options["Hash"] * 1024 * 1024
+            if uses_evaluation_cache(self.engine.model):
+                hash_bytes //= 2
+                self.engine.cache = self.engine.search.cache = EvaluationCache(hash_bytes)
+            self.engine.search.table.size = max(hash_bytes // TT_ENTRY_SIZE, 1)
+            self.engine.search.table.clear()
+        elif option == "Depth":
+            self.engine.search.max_depth = self.options["Depth"]
+
+    def _go(self, arguments):
+        engine = self._load_engine()
+        limit, infinite = parse_go(arguments)
+        board = self.board.copy()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._search, args=(engine, board, limit, infinite), daemon=True)
+        self._thread.start()
+
+    # Runs on the background thread and answers with the best move
+    # An infinite search only answers after 'stop', even if it finished earlier
+    def _search(self, engine: CustomEngine, board: chess.Board, limit: chess.engine.Limit, infinite: bool):
+        def on_iteration(result: SearchResult):
+            self.send(info_line(result))
+            if self._stop.is_set():
+                engine.search.stop()
+
+        if board.is_game_over():
+            self.send("bestmove 0000")
+            return
+        result = engine.search.search(board, limit, on_iteration)
+        if infinite:
+            self._stop.wait()
+        self.send(f"bestmove {result.move.uci() if result.move is not None else '0000'}")
+
+    def _stop_search(self):
+        if self._thread is not None:
+            self._stop.set()
+            if self.engine is not None:
+                self.engine.search.stop()
+            self._thread.join()
+            self._thread = None
+
+
+# position [startpos | fen <fen>] [moves <move> ...]
+def parse_position(arguments):
+    moves_index = arguments.index("moves") if "moves" in arguments else len(arguments)
+    if arguments and arguments[0] == "fen":
+        board = chess.Board(" ".join(arguments[1:moves_index]))
+    else:
+        board = chess.Board()
+    for move in arguments[moves_index + 1:]:
+        board.push_uci(move)
+    return board
+
+
+# Converts the arguments of 'go' to a limit, times are sent in milliseconds
+# Returns the limit and whether the search is infinite
+def parse_go(arguments):
+    values = {}
+    for name in ("wtime", "btime", "winc", "binc", "movestogo", "depth", "nodes", "movetime"):
+        if name in arguments:
+            values[name] = int(arguments[arguments.index(name) + 1])
+
+    def seconds(name):
+        return values[name] / 1000 if name in values else None
+
+    infinite = "infinite" in arguments
+    if infinite or not values:
+        return chess.engine.Limit(depth=MAX_SEARCH_DEPTH if infinite else None), infinite
+    return chess.engine.Limit(time=seconds("movetime"), depth=values.get("depth"), nodes=values.get("nodes"),
+                              white_clock=seconds("wtime"), black_clock=seconds("btime"),
+                              white_inc=seconds("winc"), black_inc=seconds("binc"),
+                              remaining_moves=values.get("movestogo")), False
+
+
+# The info line of a finished iteration
+def info_line(result: SearchResult):
+    if abs(result.score) >= MATE_SCORE / 2:
+        plies = round((MATE_SCORE - abs(result.score)) / MATE_PLY_PENALTY)
+        moves = (plies + 1) // 2
+        score = f"mate {moves if result.score > 0 else -moves}"
+    else:
+        score = f"cp {round(result.score * CENTIPAWN_SCALE)}"
+    pv = f" pv {result.move.uci()}" if result.move is not None else ""
+    return (f"info depth {result.depth} score {score} nodes {result.nodes} nps {result.nodes_per_second:.0f} "
+            f"time {round(result.seconds * 1000)}{pv}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python -m chess_api.uci <model path> [depth]")
+        sys.exit(1)
+    UciEngine(sys.argv[1], depth=int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DEPTH).run()
@@ -0,0 +1,99 @@
+import dataclasses
+import threading
+
+import chess.engine
+
+# This file decides how long a position is analysed while labeling a dataset
+# A fixed depth spends the same time on a quiet position as on a position full of tactics.
+# Instead, the engine reports every finished iteration and the analysis stops early
+# - if the score stayed nearly the same over the last iterations (the position is quiet)
+# - or if the position is clearly decided, a few centipawns more or less do not change the label
+# Volatile positions keep searching until the maximum depth or their share of the node budget is reached.
+# The nodes quiet positions did not use stay in the budget of the shard and go to the volatile positions after them
+# The engine pool asks for the limit of every position right before its analysis and books its nodes right after,
+# so every position sees the nodes the positions before it left over
+# Only analyses that give a label count against the budget: analyses without a centipawn score (no score, mates,
+# crashed engines) are dropped from the dataset, they are reported separately as failures
+
+# Positions are never analysed with less nodes, even if the budget of the shard is used up
+MIN_NODES = 10_000
+
+# The engines of a pool analyse positions in parallel threads, which all book into the same budget
+_lock = threading.Lock()
+
+
+# The labeling policy and the node budget of the current shard
+# One budget belongs to one work unit, it starts a new shard every shard_size analysed positions
+# Without shard_nodes there is no node budget and positions are only limited by max_depth
+@dataclasses.dataclass
+class AnalysisBudget:
+    shard_nodes: int = None
+    shard_size: int = 10_000
+    min_depth: int = 6
+    max_depth: int = 16
+    stable_iterations: int = 3
+    stable_margin: int = 15
+    decided_score: int = 800
+    max_share: float = 4
+
+    # Nodes and analysed positions of the current shard
+    nodes: int = dataclasses.field(default=0, init=False)
+    positions: int = dataclasses.field(default=0, init=False)
+    # Totals of all shards, the depth is summed to report the average depth of the labels
+    total_nodes: int = dataclasses.field(default=0, init=False)
+    total_positions: int = dataclasses.field(default=0, init=False)
+    total_depth: int = dataclasses.field(default=0, init=False)
+    # Analyses that gave no label and the nodes they used
+    failures: int = dataclasses.field(default=0, init=False)
+    failed_nodes: int = dataclasses.field(default=0, init=False)
+
+    # The limit of the next position
+    # A position may use up to max_share times the average nodes that are left per position of the shard
+    def limit(self):
+        if self.shard_nodes is None:
+            return chess.engine.Limit(depth=self.max_depth)
+        with _lock:
+            remaining = self.shard_nodes - self.nodes
+            positions_left = max(self.shard_size - self.positions, 1)
+        nodes = max(int(self.max_share * remaining / positions_left), MIN_NODES)
+        return chess.engine.Limit(depth=self.max_depth, nodes=nodes)
+
+    # Called with the infos of all finished iterations of a position, returns True if the analysis can stop
+    def should_stop(self, iterations):
+        if iterations[-1].get("depth", 0) < self.min_depth:
+            return False
+        score = iterations[-1]["score"].white()
+        if score.is_mate() or abs(score.score()) >= self.decided_score:
+            return True
+        if len(iterations) < self.stable_iterations:
+            return False
+        scores = [info["score"].white().score(mate_score=100_000) for info in iterations[-self.stable_iterations:]]
+        return max(scores) - min(scores) <= self.stable_margin
+
+    # Books the nodes of analysed positions and starts a new shard once the current one is full
+    def spend(self, infos):
+        with _lock:
+            for info in infos:
+                nodes = info.get("nodes", 0)
+                if "score" not in info or info["score"].white().score() is None:
+                    self.failures += 1
+                    self.failed_nodes += nodes
+                    continue
+                self.nodes += nodes
+                self.positions += 1
+                self.total_nodes += nodes
+                self.total_positions += 1
+                self.total_depth += info.get("depth", 0)
+                if self.positions >= self.shard_size:
+                    self.nodes = 0
+                    self.positions = 0
+
+    def stats(self):
+        return {
+            "positions": self.total_positions,
+            "nodes": self.total_nodes,
+            "nodes_per_position": self.total_nodes / max(self.total_positions, 1),
+            "average_depth": self.total_depth / max(self.total_positions, 1),
+            "failures": self.failures,
+            "failed_nodes": self.failed_nodes
+        }
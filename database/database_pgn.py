@@ -1,49 +1,125 @@
+import dataclasses
 import os.path
+from typing import Union
 
 import chess.pgn
 from chess import WHITE
-from chess.pgn import read_game
+from chess.pgn import skip_game
 
-from database.util import board_to_obs, stockfish_evaluate, save_dataset
+from database.analysis_budget import AnalysisBudget
+from database.dataset_job import ShardWriter, run_dataset_job, DEFAULT_SHARD_SIZE
+from database.engine_pool import get_engine_pool
+from database.label_cache import LABEL_CACHE_PATH
+from database.pgn_index import stream_games, MainlineGame
+from database.util import board_to_obs, label_games
+from instrumentation.metrics import METRICS_PATH, METRICS_PORT
 
 
 # This file is used to create datasets from pgn files
 
 # The main function to create a pgn dataset
-def create_pgn_dataset(pgn_folder: str, save_folder: str):
-    x_train = []
-    y_train = []
-    for files in os.listdir(pgn_folder):
+# The games of all pgn files are split into work units of games_per_unit games that are labeled by many processes
+# Running it again with the same folders continues an interrupted job
+# depth, nodes and multipv set the analysis of every position, see label_games
+# With a budget the positions are analysed adaptively and every shard gets the same total node budget
+# Its progress can be followed with the metrics file or http port, see instrumentation/metrics.py
+def create_pgn_dataset(pgn_folder: str, save_folder: str, workers: int = None, games_per_unit: int = 100,
+                       shard_size: int = DEFAULT_SHARD_SIZE, engine_options: dict = None,
+                       label_cache_path: str = LABEL_CACHE_PATH, depth: int = 10, nodes: int = None,
+                       multipv: int = None, budget: AnalysisBudget = None, metrics_path: str = METRICS_PATH,
+                       metrics_port: int = METRICS_PORT):
+    units = []
+    for files in sorted(os.listdir(pgn_folder)):
         if files.endswith(".pgn"):
-            with open(pgn_folder + files) as pgn:
-                while True:
-                    print("\r", end="")
-                    print(f"Creating dataset: {len(x_train)}", end="")
-                    game = read_game(pgn)
-                    if game is None:
-                        break
-                    x, y = game_to_data(game)
-                    x_train.extend(x)
-                    y_train.extend(y)
-    save_dataset(save_folder, x_train, y_train)
+            units.extend(pgn_work_units(os.path.join(pgn_folder, files), games_per_unit, depth, nodes, multipv,
+                                        budget))
+    run_dataset_job(units, save_folder, workers=workers, shard_size=shard_size, engine_options=engine_options,
+                    label_cache_path=label_cache_path, metrics_path=metrics_path, metrics_port=metrics_port)
+
+
+# A range of games of a pgn file, starting at a byte offset
+@dataclasses.dataclass
+class PgnWorkUnit:
+    unit_id: str
+    pgn_path: str
+    offset: int
+    games: int
+    depth: int = 10
+    nodes: int = None
+    multipv: int = None
+    budget: AnalysisBudget = None
+
+    # Only the main lines are read, see pgn_index.py
+    # As many games as the engine pool has engines are labeled at once, one game per engine
+    def create_data(self, writer: ShardWriter):
+        budget = dataclasses.replace(self.budget, shard_size=writer.shard_size) if self.budget is not None else None
+        batch = []
+        for game in stream_games(self.pgn_path, self.offset, self.games):
+            batch.append(game)
+            if len(batch) >= get_engine_pool().size:
+                writer.add(*games_to_data(batch, self.depth, self.nodes, self.multipv, budget, with_depths=True))
+                batch = []
+        if batch:
+            writer.add(*games_to_data(batch, self.depth, self.nodes, self.multipv, budget, with_depths=True))
+
+
+# Splits a pgn file into work units
+# Skipping games is a lot faster than parsing them, so we only remember where every unit starts
+def pgn_work_units(pgn_path: str, games_per_unit: int = 100, depth: int = 10, nodes: int = None,
+                   multipv: int = None, budget: AnalysisBudget = None):
+    units = []
+    name = os.path.splitext(os.path.basename(pgn_path))[0]
+    with open(pgn_path) as pgn:
+        games = 0
+        while True:
+            offset = pgn.tell()
+            if not skip_game(pgn):
+                break
+            if games % games_per_unit == 0:
+                units.append(PgnWorkUnit(f"{name}-{len(units):05d}", pgn_path, offset, games_per_unit,
+                                         depth, nodes, multipv, budget))
+            games += 1
+    return units
 
 
 # Retrieves data from a game
-def game_to_data(game: chess.pgn.Game):
+# All white to move positions of the game are analysed in order by one warm engine, see label_games
+# Positions that were labeled before (e.g. in another game with the same opening) are taken from the label cache
+# The game can either be a chess.pgn.Game or the MainlineGame of a streamed pgn file
+def game_to_data(game: Union[chess.pgn.Game, MainlineGame], depth: int = 10, nodes: int = None,
+                 multipv: int = None, budget: AnalysisBudget = None):
+    return games_to_data([game], depth, nodes, multipv, budget)
+
+
+# Retrieves the data of many games at once, the games are labeled in parallel by the engine pool
+# With with_depths the search depths of the labels are returned as third list
+def games_to_data(games, depth: int = 10, nodes: int = None, multipv: int = None, budget: AnalysisBudget = None,
+                  with_depths: bool = False):
     x = []
     y = []
-    board = chess.Board()
-    for move in list(game.mainline_moves()):
-        board.push(move)
-        if board.turn == WHITE:
-            evaluation, success = stockfish_evaluate(board, depth=10)
+    depths = []
+    games_boards = []
+    for game in games:
+        boards = []
+        board = game.board()
+        for move in list(game.mainline_moves()):
+            board.push(move)
+            if board.turn == WHITE:
+                boards.append(board.copy())
+        games_boards.append(boards)
+
+    labels, label_depths = label_games(games_boards, depth, nodes, multipv, budget, with_depths=True)
+    for boards, game_labels, game_depths in zip(games_boards, labels, label_depths):
+        for board, (evaluation, success), label_depth in zip(boards, game_labels, game_depths):
             if success:
                 x.append(board_to_obs(board))
                 y.append(evaluation)
+                depths.append(label_depth)
 
-    return x, y
+    return (x, y, depths) if with_depths else (x, y)
 
 
 # Convenience and Testing function
 if __name__ == '__main__':
-    create_pgn_dataset("C:/Users/reyof/PycharmProjects/SupervisedChess/database/pgn/")
+    create_pgn_dataset("C:/Users/reyof/PycharmProjects/SupervisedChess/database/pgn/",
+                       "C:/Users/reyof/PycharmProjects/SupervisedChess/datasets/pgn_trained/")
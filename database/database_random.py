@@ -1,20 +1,27 @@
+import dataclasses
+import math
 import random
 
 import chess
-import chess.engine
 
-from database.util import board_to_obs, stockfish_evaluate, DataSet, DIRECTORY, save_dataset
+from database.analysis_budget import AnalysisBudget
+from database.dataset_job import ShardWriter, run_dataset_job, DEFAULT_SHARD_SIZE
+from database.engine_pool import get_engine_pool
+from database.label_cache import LABEL_CACHE_PATH
+from database.util import board_to_obs, DIRECTORY, label_boards
+from instrumentation.metrics import METRICS_PATH, METRICS_PORT
 
 
 # This file is used to create random board positions
 
 # Create a random board by just playing random moves
-def random_board(max_depth=400):
+# A seeded random.Random can be passed as rng to create the same boards again
+def random_board(max_depth=400, rng=random):
     board = chess.Board()
-    depth = random.randrange(0, max_depth)
+    depth = rng.randrange(0, max_depth)
     for _ in range(depth):
         all_moves = list(board.legal_moves)
-        random_move = random.choice(all_moves)
+        random_move = rng.choice(all_moves)
         board.push(random_move)
         if board.is_game_over():
             break
@@ -23,16 +30,47 @@ def random_board(max_depth=400):
 
 # Create a dataset using random board positions with given size and analysis depth
 # Requires stockfish to work properly
-def create_random_dataset(dataset_size: int = 10_000, board_depth: int = 4):
-    x_train = []
-    y_train = []
-    while len(x_train) < dataset_size:
-        board = random_board()
-        score = stockfish_evaluate(board, board_depth)
-        if board is not None and score is not None:  # Stockfish returns 'None' sometimes
-            x_train.append(board_to_obs(board))
-            y_train.append(score)
-            print("\r", end="\r")
-            print(f"Dataset Size: {len(x_train)} / {dataset_size}", end="")
-
-    save_dataset(x_train, y_train)
+# The dataset is split into work units of positions_per_unit positions with their own random seed,
+# which are labeled by many processes. Running it again with the same save folder continues an interrupted job
+# With a budget the positions are analysed adaptively and every shard gets the same total node budget
+# Its progress can be followed with the metrics file or http port, see instrumentation/metrics.py
+def create_random_dataset(dataset_size: int = 10_000, board_depth: int = 4, save_folder: str = DIRECTORY,
+                          workers: int = None, positions_per_unit: int = 1_000, shard_size: int = DEFAULT_SHARD_SIZE,
+                          engine_options: dict = None, label_cache_path: str = LABEL_CACHE_PATH,
+                          budget: AnalysisBudget = None, metrics_path: str = METRICS_PATH,
+                          metrics_port: int = METRICS_PORT):
+    units = [
+        RandomWorkUnit(f"random-{seed:05d}", seed, min(positions_per_unit, dataset_size - seed * positions_per_unit),
+                       board_depth, budget)
+        for seed in range(math.ceil(dataset_size / positions_per_unit))
+    ]
+    run_dataset_job(units, save_folder, workers=workers, shard_size=shard_size, engine_options=engine_options,
+                    label_cache_path=label_cache_path, metrics_path=metrics_path, metrics_port=metrics_port)
+
+
+# A number of random positions created from one random seed
+@dataclasses.dataclass
+class RandomWorkUnit:
+    unit_id: str
+    seed: int
+    positions: int
+    board_depth: int
+    budget: AnalysisBudget = None
+
+    # Boards are created in batches that are analysed in parallel by the engine pool
+    def create_data(self, writer: ShardWriter):
+        budget = dataclasses.replace(self.budget, shard_size=writer.shard_size) if self.budget is not None else None
+        rng = random.Random(self.seed)
+        pool = get_engine_pool()
+        while writer.positions < self.positions:
+            boards = [random_board(rng=rng) for _ in range(min(pool.size, self.positions - writer.positions))]
+            x_train = []
+            y_train = []
+            depths = []
+            labels, label_depths = label_boards(boards, self.board_depth, budget, with_depths=True)
+            for board, (score, success), depth in zip(boards, labels, label_depths):
+                if success:  # Stockfish returns 'None' sometimes
+                    x_train.append(board_to_obs(board))
+                    y_train.append(score)
+                    depths.append(depth)
+            writer.add(x_train, y_train, depths)
@@ -0,0 +1,276 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from database.engine_pool import configure_engine_pool, get_engine_pool
+from database.label_cache import configure_label_cache, get_label_cache, LABEL_CACHE_PATH
+from database.shards import SHARD_EXTENSION
+from database.util import save_dataset
+from instrumentation import spans
+from instrumentation.metrics import MetricsExporter, METRICS_PATH, METRICS_PORT, rss_bytes
+
+# This file is used to create big datasets with many processes at once
+# A job consists of work units (a range of games of a pgn file or a range of random seeds)
+# that are spread over a pool of worker processes, each with its own engine
+# Every work unit writes its samples into fixed size shards while it is running
+# and the manifest remembers which work units are done, so a killed job can simply be started again
+# The progress of a job (rates, engine utilization, cache hits, shard write latency, memory and ETA)
+# is published by a MetricsExporter, see instrumentation/metrics.py
+
+MANIFEST_FILE = "manifest.json"
+
+DEFAULT_SHARD_SIZE = 10_000
+
+
+# Collects the samples of one work unit and writes them to disk whenever a shard is full
+# Shard names only depend on the work unit, so a work unit that is run again overwrites its old shards
+# The search depths of the labels are stored in the shards as long as every added sample has one
+class ShardWriter:
+    def __init__(self, save_folder: str, unit_id: str, shard_size: int = DEFAULT_SHARD_SIZE):
+        self.save_folder = save_folder
+        self.unit_id = unit_id
+        self.shard_size = shard_size
+        self.shards = []
+        self.positions = 0
+        self.write_seconds = 0
+        self.x_train = []
+        self.y_train = []
+        self.depths = []
+        # Called after every added batch, e.g. a UnitReporter
+        self.report = None
+
+    def add(self, x, y, depths=None):
+        self.x_train.extend(x)
+        self.y_train.extend(y)
+        if depths is None:
+            self.depths = None
+        elif self.depths is not None:
+            self.depths.extend(depths)
+        self.positions += len(x)
+        while len(self.x_train) >= self.shard_size:
+            self._write_shard(self.x_train[:self.shard_size], self.y_train[:self.shard_size],
+                              self.depths[:self.shard_size] if self.depths is not None else None)
+            self.x_train = self.x_train[self.shard_size:]
+            self.y_train = self.y_train[self.shard_size:]
+            if self.depths is not None:
+                self.depths = self.depths[self.shard_size:]
+        if self.report is not None:
+            self.report()
+
+    # Writes the remaining samples as the last (smaller) shard
+    def close(self):
+        if self.x_train:
+            self._write_shard(self.x_train, self.y_train, self.depths)
+            self.x_train = []
+            self.y_train = []
+            self.depths = [] if self.depths is not None else None
+
+    def _write_shard(self, x_train, y_train, depths=None):
+        file_name = f"{self.unit_id}_{len(self.shards):05d}{SHARD_EXTENSION}"
+        start = time.perf_counter()
+        save_dataset(self.save_folder, x_train, y_train, file_name=file_name, depths=depths)
+        self.write_seconds += time.perf_counter() - start
+        self.shards.append(file_name)
+
+
+# Keeps track of the finished work units of a job in a json file inside the save folder
+class Manifest:
+    def __init__(self, save_folder: str):
+        self.path = os.path.join(save_folder, MANIFEST_FILE)
+        self.completed = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                self.completed = json.load(file)["completed"]
+
+    def is_completed(self, unit_id: str):
+        return unit_id in self.completed
+
+    def complete(self, unit_id: str, positions: int, shards):
+        self.completed[unit_id] = {
+            "positions": positions,
+            "shards": shards
+        }
+        self.save()
+
+    # We write to a temporary file first, so that a crash while saving never destroys the manifest
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"completed": self.completed}, file, indent=1)
+        os.replace(temporary_path, self.path)
+
+
+# Runs all work units that are not completed yet on a pool of worker processes
+# A work unit needs a 'unit_id' and a 'create_data(writer)' method that adds its samples to the given ShardWriter
+# engine_options are passed to configure_engine_pool in every worker, e.g. to set Threads, Hash or the engine path
+# All workers share the label cache at label_cache_path, None disables it
+# The metrics of the job are appended as json lines to metrics_path and served on localhost:metrics_port
+# Workers send their metrics after every labeled batch through a queue, a thread of the main process collects them
+def run_dataset_job(units, save_folder: str, workers: int = None, shard_size: int = DEFAULT_SHARD_SIZE,
+                    engine_options: dict = None, label_cache_path: str = LABEL_CACHE_PATH,
+                    metrics_path: str = METRICS_PATH, metrics_port: int = METRICS_PORT):
+    os.makedirs(save_folder, exist_ok=True)
+    manifest = Manifest(save_folder)
+    pending = [unit for unit in units if not manifest.is_completed(unit.unit_id)]
+    print(f"Work units: {len(units)} | Completed: {len(units) - len(pending)} | Pending: {len(pending)}")
+
+    engine_options = dict(engine_options or {})
+    engine_options.setdefault("size", 1)
+    worker_stats = {}
+    positions = sum(unit["positions"] for unit in manifest.completed.values())
+    progress_queue = multiprocessing.Queue()
+    with MetricsExporter(os.path.basename(os.path.normpath(save_folder)), total=len(pending),
+                         progress_counter="units_completed", path=metrics_path, port=metrics_port) as metrics:
+        metrics.set("units_pending", len(pending))
+        collector = threading.Thread(target=_collect_progress, args=(metrics, progress_queue, positions,
+                                                                     len(units) - len(pending), len(units)))
+        collector.start()
+        try:
+            with multiprocessing.Pool(workers, initializer=_init_worker,
+                                      initargs=(engine_options, label_cache_path, progress_queue)) as pool:
+                arguments = [(unit, save_folder, shard_size) for unit in pending]
+                for result in pool.imap_unordered(_run_unit, arguments):
+                    manifest.complete(result["unit_id"], result["positions"], result["shards"])
+                    stats = worker_stats.setdefault(result["worker"], {"positions": 0, "seconds": 0})
+                    stats["positions"] += result["positions"]
+                    stats["seconds"] += result["seconds"]
+                    if "trace" in result:
+                        spans.merge(result["trace"])
+                    metrics.add("unit_seconds", result["seconds"])
+                    progress_queue.put({"units_completed": 1})
+                # Workers that exit normally send their last metrics before they stop
+                pool.close()
+                pool.join()
+        finally:
+            progress_queue.put(None)
+            collector.join()
+    print()
+
+    for worker, stats in worker_stats.items():
+        print(f"Worker {worker}: {stats['positions']} positions | "
+              f"{stats['positions'] / max(stats['seconds'], 1e-9):.1f} positions/sec")
+    return manifest
+
+
+# The queue the metrics of a worker process are sent through, see run_dataset_job
+_progress_queue = None
+
+
+# Every worker process gets its own engine pool and connection to the label cache
+# Workers inherit the instrumentation of the main process, but not the data it recorded so far
+def _init_worker(engine_options: dict, label_cache_path: str, progress_queue=None):
+    global _progress_queue
+    spans.reset()
+    configure_engine_pool(**engine_options)
+    configure_label_cache(label_cache_path)
+    _progress_queue = progress_queue
+
+
+# Adds the metrics the workers send to the metrics of the job and prints the progress line, until it gets None
+# A message is either the counters a worker added since its last message or a completed work unit
+def _collect_progress(metrics: MetricsExporter, progress_queue, positions: int, completed: int, units: int):
+    worker_rss = {}
+    last_print = 0
+    while True:
+        message = progress_queue.get()
+        if message is None:
+            break
+        if "units_completed" in message:
+            metrics.add("units_completed", message["units_completed"])
+            metrics.set("units_pending", metrics.total - metrics.counters["units_completed"])
+        else:
+            for name, value in message["counters"].items():
+                metrics.add(name, value)
+            worker_rss[message["worker"]] = message["rss_bytes"]
+            _update_gauges(metrics, worker_rss)
+        # A batch can take milliseconds, so the progress line is only printed once per second
+        if time.time() - last_print >= 1 or "units_completed" in message:
+            last_print = time.time()
+            counters = metrics.counters
+            print("\r", end="\r")
+            print(f"Creating dataset: {positions + counters.get('positions_labeled', 0)} | "
+                  f"Completed units: {completed + counters.get('units_completed', 0)} / {units} | "
+                  f"{_progress(metrics)}", end="")
+
+
+# The gauges of the job that are derived from the counters of all workers
+def _update_gauges(metrics: MetricsExporter, worker_rss: dict):
+    counters = metrics.counters
+    metrics.set("workers", len(worker_rss))
+    metrics.set("engine_pool_utilization",
+                counters["engine_busy_seconds"] / max(counters["engine_capacity_seconds"], 1e-9))
+    lookups = counters["label_cache_hits"] + counters["label_cache_misses"]
+    if lookups:
+        metrics.set("label_cache_hit_rate", counters["label_cache_hits"] / lookups)
+    if counters["shards_written"]:
+        metrics.set("shard_write_latency_seconds", counters["shard_write_seconds"] / counters["shards_written"])
+    metrics.set("worker_rss_bytes", sum(rss or 0 for rss in worker_rss.values()))
+
+
+# Average labels/sec and the estimated remaining time of the job for the progress line
+def _progress(metrics: MetricsExporter):
+    snapshot = metrics.snapshot("progress")
+    rate = snapshot["counters"].get("positions_labeled", 0) / max(snapshot["elapsed_seconds"], 1e-9)
+    eta = snapshot["eta_seconds"]
+    eta = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None and eta < 86_400 \
+        else f"{eta / 86_400:.1f} days" if eta is not None else "?"
+    return f"{rate:.1f} positions/sec | ETA: {eta}"
+
+
+# Sends what the work unit of a worker cost since the last report to the main process:
+# labeled positions, engine time, label cache lookups and shard writes
+# The ShardWriter calls it after every labeled batch, so the metrics move while a long work unit is running
+class UnitReporter:
+    def __init__(self, writer: ShardWriter):
+        self.writer = writer
+        self.pool = get_engine_pool()
+        self.cache = get_label_cache()
+        self.start = time.time()
+        self.last = self._counters()
+
+    def _counters(self):
+        return {
+            "positions_labeled": self.writer.positions,
+            "engine_busy_seconds": self.pool.busy_seconds,
+            "engine_capacity_seconds": (time.time() - self.start) * self.pool.size,
+            "engine_analyses": self.pool.analyses,
+            "label_cache_hits": self.cache.hits if self.cache is not None else 0,
+            "label_cache_misses": self.cache.misses if self.cache is not None else 0,
+            "shards_written": len(self.writer.shards),
+            "shard_write_seconds": self.writer.write_seconds
+        }
+
+    def __call__(self):
+        if _progress_queue is None:
+            return
+        counters = self._counters()
+        _progress_queue.put({
+            "worker": os.getpid(),
+            "counters": {name: value - self.last[name] for name, value in counters.items()},
+            "rss_bytes": rss_bytes()
+        })
+        self.last = counters
+
+
+# Creates the data of one work unit inside a worker process
+def _run_unit(arguments):
+    unit, save_folder, shard_size = arguments
+    start = time.time()
+    writer = ShardWriter(save_folder, unit.unit_id, shard_size)
+    writer.report = UnitReporter(writer)
+    unit.create_data(writer)
+    writer.close()
+    writer.report()
+    result = {
+        "unit_id": unit.unit_id,
+        "positions": writer.positions,
+        "shards": writer.shards,
+        "seconds": time.time() - start,
+        "worker": os.getpid()
+    }
+    # The spans of the worker are sent to the main process, which prints the summary of the whole job at exit
+    if spans.is_enabled():
+        result["trace"] = spans.take_summary()
+    return result
@@ -0,0 +1,266 @@
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+
+from instrumentation.spans import traced
+
+# This file manages long living stockfish processes
+# Starting an engine, the UCI handshake and a cold hash table cost far more than a shallow analysis,
+# so instead of starting a new process per position we keep a pool of engines alive and reuse them
+
+STOCKFISH_PATH = os.environ.get("STOCKFISH_PATH", os.path.curdir + '/stockfish/stockfish.exe')
+
+DEFAULT_POOL_SIZE = max(1, (os.cpu_count() or 1) // 2)
+
+# Seconds an engine may take to start or to answer a command that has no limit
+ENGINE_TIMEOUT = 10.0
+
+
+# A pool of N UCI engines
+# Engines are started lazily when they are needed for the first time and restarted if they crash
+# engine_path may also be a command list, e.g. FAKE_ENGINE_COMMAND from fake_engine.py
+class EnginePool:
+    def __init__(self, engine_path=STOCKFISH_PATH, size: int = DEFAULT_POOL_SIZE, threads: int = 1,
+                 hash_size: int = 16, max_restarts: int = 3):
+        self.engine_path = engine_path
+        self.size = size
+        self.options = {
+            "Threads": threads,
+            "Hash": hash_size
+        }
+        self.max_restarts = max_restarts
+
+        # Seconds the engines spent analysing, compared with the time the pool existed this is its utilization
+        self.busy_seconds = 0
+        self.analyses = 0
+
+        self._identity = None
+
+        # Idle engines wait in this queue until someone needs them
+        self._engines = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        self._loop = None
+        self._watchers = set()
+
+    # Evaluates a board position with one of the engines of the pool and returns the info dictionary of the analysis
+    # Blocks until an engine is available
+    # A stop function can be passed as keyword argument: it gets the infos of all finished iterations
+    # and ends the analysis early by returning True, see AnalysisBudget.should_stop
+    # limit may also be a function that returns the limit right before a position is analysed,
+    # and a spend function gets the info of every finished analysis (an empty one if the engine crashed),
+    # see AnalysisBudget.limit and spend
+    def evaluate(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        engine = self._acquire()
+        try:
+            engine, info = self._analyse(engine, board, limit, **kwargs)
+            return info
+        finally:
+            self._engines.put(engine)
+
+    # Evaluates many boards at once by spreading them over all engines of the pool
+    # The results are returned in the same order as the boards
+    async def evaluate_many(self, boards, limit: chess.engine.Limit, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self._executor, lambda board=board: self.evaluate(board, limit, **kwargs))
+            for board in boards
+        ])
+
+    # Analyses the positions of one game in the order they were played with a single engine
+    # The boards have to keep their move stacks, so the engine receives 'position startpos moves ...'
+    # and finds the positions of the previous plies in its hash table; only a new game starts with 'ucinewgame'
+    # Returns one info dictionary per board, or a list of them per board if multipv is passed
+    def analyse_game(self, boards, limit: chess.engine.Limit, **kwargs):
+        engine = self._acquire()
+        game = object()
+        infos = []
+        try:
+            for board in boards:
+                engine, info = self._analyse(engine, board, limit, game=game, **kwargs)
+                infos.append(info)
+            return infos
+        finally:
+            self._engines.put(engine)
+
+    # Analyses many games at once, every game stays on one engine and the games are spread over the pool
+    async def analyse_games(self, games, limit: chess.engine.Limit, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self._executor, lambda boards=boards: self.analyse_game(boards, limit, **kwargs))
+            for boards in games
+        ])
+
+    # The name and version the engine reports and the settings its analyses depend on,
+    # e.g. 'Stockfish 16 | Hash=16 Threads=1'. The label cache keeps the labels of every identity apart
+    # The first call starts an engine if none is running yet
+    @property
+    def identity(self):
+        if self._identity is None:
+            engine = self._acquire()
+            try:
+                name = engine.id.get("name", str(self.engine_path))
+            finally:
+                self._engines.put(engine)
+            settings = " ".join(f"{option}={value}" for option, value in sorted(self.options.items()))
+            self._identity = f"{name} | {settings}"
+        return self._identity
+
+    # Quits all engines of the pool
+    # The pool can still be used afterwards, it starts new engines when they are needed again
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while not self._engines.empty():
+            self._quit(self._engines.get_nowait())
+        self._started = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Takes an idle engine from the pool or starts a new one if the pool is not full yet
+    def _acquire(self):
+        try:
+            return self._engines.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            start_engine = self._started < self.size
+            if start_engine:
+                self._started += 1
+        if start_engine:
+            try:
+                return self._start_engine()
+            except Exception:
+                with self._lock:
+                    self._started -= 1
+                raise
+        return self._engines.get()
+
+    # Runs one analysis and restarts the engine if it crashed, returns the engine that is still alive and the info
+    @traced("engine.analyse")
+    def _analyse(self, engine, board: chess.Board, limit, stop=None, spend=None, **kwargs):
+        restarts = 0
+        start = time.perf_counter()
+        limit = limit() if callable(limit) else limit
+        try:
+            while True:
+                try:
+                    if stop is None:
+                        info = engine.analyse(board, limit, **kwargs)
+                    else:
+                        info = self._analyse_until(engine, board, limit, stop, **kwargs)
+                    if spend is not None:
+                        spend([info[0] if isinstance(info, list) else info])
+                    return engine, info
+                except chess.engine.EngineTerminatedError:
+                    # A crashed analysis gives no label, it is booked as failure
+                    if spend is not None:
+                        spend([{}])
+                    if restarts >= self.max_restarts:
+                        raise
+                    restarts += 1
+                    engine = self._restart(engine)
+        finally:
+            with self._lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.analyses += 1
+
+    # Follows the analysis iteration by iteration and stops it as soon as stop returns True
+    # Only complete iterations of the best line count, bounds of an unfinished iteration are skipped
+    # Returns the info of the last complete iteration
+    @staticmethod
+    def _analyse_until(engine, board: chess.Board, limit: chess.engine.Limit, stop, **kwargs):
+        iterations = []
+        with engine.analysis(board, limit, **kwargs) as analysis:
+            for info in analysis:
+                if "score" not in info or "depth" not in info or info.get("multipv", 1) != 1 \
+                        or info.get("lowerbound") or info.get("upperbound"):
+                    continue
+                iterations.append(info)
+                if stop(iterations):
+                    break
+        return iterations[-1] if iterations else analysis.info
+
+    # Starts an engine and applies the options it supports
+    @traced("engine.start")
+    def _start_engine(self):
+        engine = asyncio.run_coroutine_threadsafe(self._popen(), self._event_loop()).result()
+        engine.configure({name: value for name, value in self.options.items() if name in engine.options})
+        return engine
+
+    # All engines of the pool run on one event loop in a daemon thread
+    # SimpleEngine.popen_uci would start a non daemon thread per engine, which only ends when the engine quits.
+    # The interpreter joins those threads before it runs the atexit handlers, so the pool could not be closed at exit.
+    # The loop keeps running as long as the pool exists, so a closed pool can start engines again
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="EnginePool event loop", daemon=True).start()
+            return self._loop
+
+    # Same as SimpleEngine.popen_uci, but on the event loop of the pool
+    async def _popen(self):
+        transport, protocol = await chess.engine.UciProtocol.popen(self.engine_path)
+        engine = chess.engine.SimpleEngine(transport, protocol, timeout=ENGINE_TIMEOUT)
+        try:
+            await asyncio.wait_for(protocol.initialize(), ENGINE_TIMEOUT)
+        except BaseException:
+            engine.close()
+            raise
+        watcher = asyncio.get_running_loop().create_task(self._watch(engine))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+        return engine
+
+    # Closes the transport of an engine once its process ended, like SimpleEngine.popen_uci does
+    @staticmethod
+    async def _watch(engine):
+        engine.returncode.set_result(await engine.protocol.returncode)
+        engine.close()
+
+    # Replaces a crashed engine with a fresh one
+    def _restart(self, engine):
+        self._quit(engine)
+        return self._start_engine()
+
+    @staticmethod
+    def _quit(engine):
+        try:
+            engine.quit()
+        except (chess.engine.EngineError, asyncio.TimeoutError):
+            engine.close()
+
+
+_default_pool = None
+
+
+# Returns the engine pool shared by this process and creates it on first use
+def get_engine_pool():
+    if _default_pool is None:
+        configure_engine_pool()
+    return _default_pool
+
+
+# Replaces the engine pool shared by this process, e.g. to change its size or to use the fake engine
+def configure_engine_pool(**kwargs):
+    global _default_pool
+    if _default_pool is not None:
+        _default_pool.close()
+        atexit.unregister(_default_pool.close)
+    _default_pool = EnginePool(**kwargs)
+    # The engines are quit when the process exits, see EnginePool._event_loop
+    atexit.register(_default_pool.close)
+    return _default_pool
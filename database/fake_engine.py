@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+
+import chess
+
+# This file is a tiny UCI engine that can stand in for stockfish
+# It evaluates positions by counting material, so it answers instantly and deterministically
+# Run it as a script or use FAKE_ENGINE_COMMAND as the engine path of an EnginePool
+
+FAKE_ENGINE_COMMAND = [sys.executable, os.path.abspath(__file__)]
+
+MATERIAL_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 300,
+    chess.BISHOP: 300,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0
+}
+
+
+# Evaluates a board in centipawns from the perspective of the side to move, just like UCI engines do
+def evaluate(board: chess.Board):
+    score = 0
+    for piece in board.piece_map().values():
+        value = MATERIAL_VALUES[piece.piece_type]
+        score += value if piece.color == board.turn else -value
+    return score
+
+
+# Sets up a board from the arguments of a 'position' command
+def parse_position(arguments):
+    if arguments[0] == "startpos":
+        board = chess.Board()
+        arguments = arguments[1:]
+    else:
+        fen_end = arguments.index("moves") if "moves" in arguments else len(arguments)
+        board = chess.Board(" ".join(arguments[1:fen_end]))
+        arguments = arguments[fen_end:]
+    if arguments and arguments[0] == "moves":
+        for move in arguments[1:]:
+            board.push_uci(move)
+    return board
+
+
+# Answers a 'go' command with one info line per depth and a best move
+def go(board: chess.Board, arguments, delay: float):
+    depth = int(arguments[arguments.index("depth") + 1]) if "depth" in arguments else 1
+    time.sleep(delay)
+    moves = list(board.legal_moves)
+    if not moves:
+        score = "mate 0" if board.is_check() else "cp 0"
+        print(f"info depth 0 score {score}")
+        print("bestmove 0000")
+        return
+    best_move = max(moves, key=lambda move: (board.is_capture(move), move.uci()))
+    score = evaluate(board)
+    for current_depth in range(1, depth + 1):
+        print(f"info depth {current_depth} seldepth {current_depth} score cp {score} nodes {current_depth * len(moves)}"
+              f" pv {best_move.uci()}")
+    print(f"bestmove {best_move.uci()}")
+
+
+# The main loop of the engine
+# crash_after lets the engine die after the given amount of 'go' commands, which is handy to test restarts
+def run(crash_after: int = None, delay: float = 0):
+    board = chess.Board()
+    searches = 0
+    for line in sys.stdin:
+        command, *arguments = line.split() or [""]
+        if command == "uci":
+            print("id name Fake Engine")
+            print("id author SupervisedChess")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("option name MultiPV type spin default 1 min 1 max 500")
+            print("uciok")
+        elif command == "isready":
+            print("readyok")
+        elif command == "ucinewgame":
+            board = chess.Board()
+        elif command == "position":
+            board = parse_position(arguments)
+        elif command == "go":
+            if crash_after is not None and searches >= crash_after:
+                sys.exit(1)
+            searches += 1
+            go(board, arguments, delay)
+        elif command == "quit":
+            break
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(crash_after=int(args[args.index("--crash-after") + 1]) if "--crash-after" in args else None,
+        delay=float(args[args.index("--delay") + 1]) if "--delay" in args else 0)
@@ -0,0 +1,61 @@
+import chess
+
+from database.util import board_to_bitboards, legal_move_mask, bitboards_to_obs
+
+# This file keeps the observation of a board up to date while moves are pushed and popped, e.g. during a search
+# Instead of encoding every position from scratch with board_to_obs:
+# - the piece planes of a move are patched: the moving piece leaves its square, a captured piece disappears
+# - the attack planes are only computed when the observation is actually needed,
+#   so positions inside of the search tree that are never evaluated do not pay for them
+# - popping a move restores the bitboards of the position before without any work
+
+
+class IncrementalEncoder:
+    def __init__(self, board: chess.Board):
+        self.board = board
+        self.stack = [board_to_bitboards(board)]
+
+    # The 14 bitboards of the current position, equal to board_to_bitboards(board)
+    @property
+    def value(self):
+        bitboards = self.stack[-1]
+        if bitboards[12] is None:
+            bitboards[12] = legal_move_mask(self.board, chess.WHITE)
+            bitboards[13] = legal_move_mask(self.board, chess.BLACK)
+        return bitboards
+
+    # The observation of the current position, equal to board_to_obs(board)
+    def obs(self):
+        return bitboards_to_obs(self.value)
+
+    def push(self, board: chess.Board, move: chess.Move):
+        if board.is_castling(move) or board.is_en_passant(move):
+            # Rare moves that change more than two squares simply take the new piece masks
+            board.push(move)
+            bitboards = _piece_bitboards(board)
+        else:
+            bitboards = self.stack[-1][:12]
+            color = board.turn
+            from_mask = chess.BB_SQUARES[move.from_square]
+            to_mask = chess.BB_SQUARES[move.to_square]
+            bitboards[_plane(color, board.piece_type_at(move.from_square))] ^= from_mask
+            captured = board.piece_type_at(move.to_square)
+            if captured:
+                bitboards[_plane(not color, captured)] ^= to_mask
+            piece_type = move.promotion or board.piece_type_at(move.from_square)
+            bitboards[_plane(color, piece_type)] |= to_mask
+            board.push(move)
+        self.stack.append(bitboards + [None, None])
+
+    def pop(self, board: chess.Board):
+        board.pop()
+        self.stack.pop()
+
+
+# The twelve piece bitboards of board_to_bitboards
+def _piece_bitboards(board: chess.Board):
+    return [board.pieces_mask(piece, color) for color in (chess.WHITE, chess.BLACK) for piece in chess.PIECE_TYPES]
+
+
+def _plane(color: chess.Color, piece_type: chess.PieceType):
+    return piece_type - 1 + (0 if color == chess.WHITE else 6)
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+
+import chess
+import chess.polyglot
+
+# This file contains a persistent store of stockfish labels
+# Datasets of many games label the same positions (e.g. openings) again and again,
+# so every label is saved in a SQLite database with the zobrist hash of the position and the depth of the analysis.
+# A label is reused if it was analysed at least as deep as requested
+# The database can be used by many processes at once, e.g. by all workers of a dataset job
+# Every label belongs to the engine that analysed it (see EnginePool.identity: its name, version and settings),
+# so labels of an upgraded engine or of other Hash / Threads settings are never mixed with the old ones
+# Databases of older versions stored labels without engine in the table 'labels', these labels are not used anymore
+
+LABEL_CACHE_PATH = os.environ.get("LABEL_CACHE_PATH", os.path.join("datasets", "labels.sqlite"))
+
+# SQLite limits the number of parameters of a single query
+QUERY_SIZE = 500
+
+
+class LabelCache:
+    def __init__(self, path: str = LABEL_CACHE_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._engine_ids = {}
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS engines (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS engine_labels ("
+                                 "engine INTEGER NOT NULL, key INTEGER NOT NULL, depth INTEGER NOT NULL, score INTEGER, "
+                                 "success INTEGER NOT NULL, PRIMARY KEY (engine, key))")
+        self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM engine_labels").fetchone()[0]
+
+    # Returns the label (score, success) of a board like info_to_score does, or None if it has to be analysed
+    def get(self, board: chess.Board, engine: str, depth: int):
+        return self.get_many([board], engine, depth)[0]
+
+    # With with_depths the depths the labels were analysed with are returned as second list (None for misses)
+    def get_many(self, boards, engine: str, depth: int, with_depths: bool = False):
+        keys = [position_key(board) for board in boards]
+        stored = {}
+        with self._lock:
+            engine_id = self._engine_id(engine)
+            for start in range(0, len(keys), QUERY_SIZE):
+                chunk = keys[start:start + QUERY_SIZE]
+                rows = self._connection.execute(
+                    f"SELECT key, depth, score, success FROM engine_labels "
+                    f"WHERE engine = ? AND depth >= ? AND key IN ({','.join('?' * len(chunk))})",
+                    [engine_id, depth] + chunk)
+                for key, stored_depth, score, success in rows:
+                    stored[key] = (score if success else 0, bool(success)), stored_depth
+        found = [stored.get(key, (None, None)) for key in keys]
+        labels = [label for label, _ in found]
+        hits = sum(label is not None for label in labels)
+        self.hits += hits
+        self.misses += len(labels) - hits
+        if with_depths:
+            return labels, [stored_depth for _, stored_depth in found]
+        return labels
+
+    # Saves labels (score, success), a label is only replaced by a label of a deeper analysis
+    def put_many(self, boards, engine: str, depth: int, labels):
+        with self._lock:
+            engine_id = self._engine_id(engine)
+            rows = [(engine_id, position_key(board), depth, score if success else None, int(success))
+                    for board, (score, success) in zip(boards, labels)]
+            self._connection.executemany(
+                "INSERT INTO engine_labels (engine, key, depth, score, success) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (engine, key) DO UPDATE SET depth = excluded.depth, score = excluded.score, "
+                "success = excluded.success WHERE excluded.depth > engine_labels.depth", rows)
+            self._connection.commit()
+
+    def put(self, board: chess.Board, engine: str, depth: int, score: int, success: bool):
+        self.put_many([board], engine, depth, [(score, success)])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    # The id of an engine in the engines table, it is added on its first use
+    def _engine_id(self, engine: str):
+        if engine not in self._engine_ids:
+            self._connection.execute("INSERT OR IGNORE INTO engines (name) VALUES (?)", (engine,))
+            self._connection.commit()
+            self._engine_ids[engine] = self._connection.execute(
+                "SELECT id FROM engines WHERE name = ?", (engine,)).fetchone()[0]
+        return self._engine_ids[engine]
+
+
+# SQLite stores signed 64 bit integers, so the zobrist hash is shifted into that range
+def position_key(board: chess.Board):
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+_default_cache = None
+_configured = False
+
+
+# Returns the label cache of this process, or None if it was disabled
+# Processes that never configured their label cache only use one if the environment variable LABEL_CACHE_PATH is set,
+# so e.g. a single stockfish_evaluate does not create a database as side effect. Dataset jobs configure it explicitly
+def get_label_cache():
+    if not _configured:
+        configure_label_cache(os.environ.get("LABEL_CACHE_PATH"))
+    return _default_cache
+
+
+# Sets the database of the label cache of this process, a path of None disables the label cache
+def configure_label_cache(path: str = LABEL_CACHE_PATH):
+    global _default_cache, _configured
+    if _default_cache is not None:
+        _default_cache.close()
+    _default_cache = LabelCache(path) if path is not None else None
+    _configured = True
+    return _default_cache
@@ -0,0 +1,206 @@
+import bisect
+import dataclasses
+import json
+import os
+import random
+from typing import Dict, List
+
+import chess
+import chess.pgn
+
+from instrumentation.spans import traced
+
+# This file reads big pgn files (e.g. Lichess or TWIC dumps) as a stream
+# chess.pgn.read_game builds a whole game tree with variations and comments, which we never use.
+# Instead, the visitors of this file only collect the headers and the moves of the main line
+# and skip everything else, so one game at a time is held in memory
+
+# An index stores where every game of a pgn file starts, how many half moves it has and its headers.
+# With it, any game can be read directly and random positions can be sampled without reading the whole file
+
+INDEX_EXTENSION = ".index.jsonl"
+
+
+# The main line of a game
+@dataclasses.dataclass
+class MainlineGame:
+    headers: Dict[str, str]
+    moves: List[chess.Move]
+    offset: int
+
+    def mainline_moves(self):
+        return self.moves
+
+    # The starting position, which is only different from the normal one if the game has a FEN header
+    def board(self):
+        fen = self.headers.get("FEN")
+        return chess.Board(fen, chess960=self.headers.get("Variant", "").lower() == "chess960") if fen \
+            else chess.Board()
+
+
+# Collects the headers and main line moves of a game, variations are skipped and comments are ignored
+# A move that can not be parsed ends the main line, the moves in front of it are kept
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    def begin_game(self):
+        self.headers = {}
+        self.moves = []
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.moves.append(move)
+
+    def handle_error(self, error: Exception):
+        pass
+
+    def result(self):
+        return self.headers, self.moves
+
+
+# Only counts the half moves of the main line without parsing them, which is a lot faster
+# Every move is replaced by a null move, the parser still needs a move to recognize variations
+class PlyCountVisitor(chess.pgn.BaseVisitor):
+    def begin_game(self):
+        self.headers = {}
+        self.plies = 0
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def parse_san(self, board: chess.Board, san: str):
+        return chess.Move.null()
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.plies += 1
+
+    def result(self):
+        return self.headers, self.plies
+
+
+# Reads the main line of the game at the current position of the file, or None at the end of the file
+@traced("pgn.read_game")
+def read_mainline(pgn) -> MainlineGame:
+    offset = pgn.tell()
+    result = chess.pgn.read_game(pgn, Visitor=MainlineVisitor)
+    if result is None:
+        return None
+    headers, moves = result
+    return MainlineGame(headers, moves, offset)
+
+
+# Yields the main lines of a pgn file one by one, starting at the given offset
+def stream_games(pgn_path: str, offset: int = 0, games: int = None):
+    with open(pgn_path) as pgn:
+        pgn.seek(offset)
+        count = 0
+        while games is None or count < games:
+            game = read_mainline(pgn)
+            if game is None:
+                break
+            yield game
+            count += 1
+
+
+# The index of a pgn file
+# Headers are only loaded if they are needed, because they take most of the memory of an index
+class PgnIndex:
+    def __init__(self, pgn_path: str, offsets=None, plies=None, headers=None):
+        self.pgn_path = pgn_path
+        self.offsets = list(offsets or [])
+        self.plies = list(plies or [])
+        self.headers = headers
+        self._cumulative_plies = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Reads the game with the given number
+    def read_game(self, number: int) -> MainlineGame:
+        with open(self.pgn_path) as pgn:
+            pgn.seek(self.offsets[number])
+            return read_mainline(pgn)
+
+    # Samples random positions of all games, every position of the file has the same chance
+    # The games are read in the order of the file, so the file is only read once from the start to the end
+    # Games with moves that can not be parsed may give less positions than requested
+    def sample_positions(self, count: int, rng=random):
+        if self._cumulative_plies is None:
+            self._cumulative_plies = []
+            total = 0
+            for plies in self.plies:
+                total += plies
+                self._cumulative_plies.append(total)
+        total = self._cumulative_plies[-1] if self._cumulative_plies else 0
+        if total == 0:
+            return []
+
+        samples = {}
+        for _ in range(count):
+            position = rng.randrange(total)
+            number = bisect.bisect_right(self._cumulative_plies, position)
+            first_ply = self._cumulative_plies[number - 1] if number > 0 else 0
+            samples.setdefault(number, []).append(position - first_ply + 1)
+
+        boards = []
+        with open(self.pgn_path) as pgn:
+            for number in sorted(samples):
+                pgn.seek(self.offsets[number])
+                game = read_mainline(pgn)
+                board = game.board()
+                targets = sorted(samples[number])
+                target = 0
+                for ply, move in enumerate(game.moves, start=1):
+                    board.push(move)
+                    while target < len(targets) and targets[target] == ply:
+                        boards.append(board.copy(stack=False))
+                        target += 1
+        rng.shuffle(boards)
+        return boards
+
+    def save(self, index_path: str):
+        with open(index_path, "w") as file:
+            for i in range(len(self)):
+                headers = self.headers[i] if self.headers is not None else {}
+                file.write(json.dumps({"offset": self.offsets[i], "plies": self.plies[i], "headers": headers}) + "\n")
+
+    @classmethod
+    def load(cls, pgn_path: str, index_path: str = None, load_headers: bool = False):
+        index = cls(pgn_path, headers=[] if load_headers else None)
+        with open(index_path or pgn_path + INDEX_EXTENSION, "r") as file:
+            for line in file:
+                entry = json.loads(line)
+                index.offsets.append(entry["offset"])
+                index.plies.append(entry["plies"])
+                if load_headers:
+                    index.headers.append(entry["headers"])
+        return index
+
+
+# Reads a pgn file once and writes its index next to it (or to index_path)
+# The index is written while reading, so memory usage does not depend on the size of the file
+def build_pgn_index(pgn_path: str, index_path: str = None):
+    index_path = index_path or pgn_path + INDEX_EXTENSION
+    games = 0
+    with open(pgn_path) as pgn, open(index_path + ".tmp", "w") as file:
+        while True:
+            offset = pgn.tell()
+            result = chess.pgn.read_game(pgn, Visitor=PlyCountVisitor)
+            if result is None:
+                break
+            headers, plies = result
+            file.write(json.dumps({"offset": offset, "plies": plies, "headers": headers}) + "\n")
+            games += 1
+            if games % 10_000 == 0:
+                print("\r", end="\r")
+                print(f"Indexed games: {games}", end="")
+    os.replace(index_path + ".tmp", index_path)
+    print("\r", end="\r")
+    print(f"Indexed games: {games}")
+    return PgnIndex.load(pgn_path, index_path)
@@ -0,0 +1,224 @@
+import os
+import pickle
+import struct
+
+import numpy
+
+from instrumentation.spans import traced
+
+# This file describes the binary shard format of our datasets
+# A shard starts with a small header followed by all observations as one contiguous block
+# and all labels as one float32 block. This way a shard can be opened with numpy.memmap without copying anything,
+# and only the parts of a dataset that are actually used are read from the disk
+
+# Every value of an observation is either 0 or 1, so by default observations are stored bit packed:
+# 14 * 8 * 8 bits are 112 bytes instead of 896. This is exactly the 14 bitboards of board_to_bitboards
+# as big endian bytes. Packed observations are unpacked batch by batch when they are read
+# Version 1 shards always store unpacked int8 observations
+# Shards of labeled datasets may also store the search depth of every label as one uint8 block after the labels
+# (FLAG_DEPTHS), readers that do not know about it simply ignore it
+
+SHARD_EXTENSION = ".shard"
+SHARD_MAGIC = b"SCSHARD\0"
+SHARD_VERSION = 2
+HEADER_FORMAT = "<8sIQ"
+FLAGS_FORMAT = "<I"
+HEADER_SIZE = 64
+OBS_SHAPE = (14, 8, 8)
+PACKED_SIZE = 14 * 8 * 8 // 8
+
+FLAG_PACKED = 1
+FLAG_DEPTHS = 2
+
+
+# Packs observations of shape (N, 14, 8, 8) into bytes of shape (N, 112)
+def pack_obs(x_train):
+    x_train = numpy.asarray(x_train, dtype=numpy.uint8).reshape(-1, PACKED_SIZE * 8)
+    return numpy.packbits(x_train, axis=1, bitorder="little")
+
+
+# Unpacks bytes of shape (N, 112) into observations of shape (N, 14, 8, 8)
+# Use dtype=numpy.float32 to get the tensor the network is trained on directly
+def unpack_obs(packed, dtype=numpy.int8):
+    packed = numpy.asarray(packed, dtype=numpy.uint8)
+    x_train = numpy.unpackbits(packed, axis=-1, bitorder="little").reshape(packed.shape[:-1] + OBS_SHAPE)
+    return x_train.view(numpy.int8) if dtype == numpy.int8 else x_train.astype(dtype)
+
+
+# Writes observations and labels to a shard file
+# Observations can be given unpacked (N, 14, 8, 8) or already packed (N, 112)
+# depths are the search depths of the labels, they are optional
+# The shard is written to a temporary file first, so a shard on disk is always complete
+@traced("io.write_shard")
+def write_shard(path: str, x_train, y_train, packed: bool = True, depths=None):
+    x_train = numpy.asarray(x_train)
+    if x_train.dtype == numpy.uint8 and x_train.shape[1:] == (PACKED_SIZE,):
+        x_train = x_train if packed else unpack_obs(x_train)
+    else:
+        x_train = x_train.astype(numpy.int8).reshape((-1,) + OBS_SHAPE)
+        x_train = pack_obs(x_train) if packed else x_train
+    y_train = numpy.asarray(y_train, dtype=numpy.float32).reshape(-1)
+    if len(x_train) != len(y_train):
+        raise ValueError(f"Got {len(x_train)} observations but {len(y_train)} labels.")
+    if depths is not None:
+        depths = numpy.clip(numpy.asarray(depths).reshape(-1), 0, 255).astype(numpy.uint8)
+        if len(depths) != len(y_train):
+            raise ValueError(f"Got {len(y_train)} labels but {len(depths)} depths.")
+
+    flags = (FLAG_PACKED if packed else 0) | (FLAG_DEPTHS if depths is not None else 0)
+    header = struct.pack(HEADER_FORMAT, SHARD_MAGIC, SHARD_VERSION, len(x_train))
+    header += struct.pack(FLAGS_FORMAT, flags)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(header.ljust(HEADER_SIZE, b"\0"))
+        file.write(x_train.tobytes())
+        file.write(y_train.tobytes())
+        if depths is not None:
+            file.write(depths.tobytes())
+    os.replace(temporary_path, path)
+
+
+# Opens a shard as read only memory maps of its observations and labels
+# Packed observations are wrapped in PackedObservations, which unpacks them when they are indexed
+@traced("io.open_shard")
+def open_shard(path: str):
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    magic, version, count = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != SHARD_MAGIC:
+        raise RuntimeError(f"The file {path} is no shard file.")
+    if version > SHARD_VERSION:
+        raise RuntimeError(f"The shard {path} has the unsupported version {version}.")
+    flags = struct.unpack_from(FLAGS_FORMAT, header, struct.calcsize(HEADER_FORMAT))[0] if version >= 2 else 0
+    packed = bool(flags & FLAG_PACKED)
+
+    sample_shape = (PACKED_SIZE,) if packed else OBS_SHAPE
+    sample_dtype = numpy.uint8 if packed else numpy.int8
+    if count == 0:
+        x_train = numpy.zeros((0,) + sample_shape, dtype=sample_dtype)
+        y_train = numpy.zeros(0, dtype=numpy.float32)
+    else:
+        x_train = numpy.memmap(path, dtype=sample_dtype, mode="r", offset=HEADER_SIZE, shape=(count,) + sample_shape)
+        y_offset = HEADER_SIZE + x_train.nbytes
+        y_train = numpy.memmap(path, dtype=numpy.float32, mode="r", offset=y_offset, shape=(count,))
+    return (PackedObservations(x_train) if packed else x_train), y_train
+
+
+# Returns the search depths of the labels of a shard as read only memory map, or None if the shard has none
+def open_shard_depths(path: str):
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    magic, version, count = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != SHARD_MAGIC:
+        raise RuntimeError(f"The file {path} is no shard file.")
+    flags = struct.unpack_from(FLAGS_FORMAT, header, struct.calcsize(HEADER_FORMAT))[0] if version >= 2 else 0
+    if not flags & FLAG_DEPTHS:
+        return None
+    if count == 0:
+        return numpy.zeros(0, dtype=numpy.uint8)
+    sample_size = PACKED_SIZE if flags & FLAG_PACKED else int(numpy.prod(OBS_SHAPE))
+    offset = HEADER_SIZE + count * sample_size + count * numpy.dtype(numpy.float32).itemsize
+    return numpy.memmap(path, dtype=numpy.uint8, mode="r", offset=offset, shape=(count,))
+
+
+# A read only view of packed observations that behaves like an array of shape (N, 14, 8, 8)
+# The raw bytes are available as 'packed', e.g. to unpack them somewhere else
+class PackedObservations:
+    def __init__(self, packed):
+        self.packed = packed
+        self.dtype = numpy.dtype(numpy.int8)
+
+    def __len__(self):
+        return len(self.packed)
+
+    @property
+    def shape(self):
+        return (len(self),) + OBS_SHAPE
+
+    def __getitem__(self, index):
+        return unpack_obs(self.packed[index])
+
+    def __array__(self, dtype=None, copy=None):
+        return unpack_obs(self.packed, numpy.int8 if dtype is None else dtype)
+
+
+# Converts all pickled datasets of a folder into shards with the same name
+# If no shard folder is given, the shards are written next to the pickle files
+def convert_pickle_datasets(pickle_folder: str, shard_folder: str = None):
+    shard_folder = pickle_folder if shard_folder is None else shard_folder
+    os.makedirs(shard_folder, exist_ok=True)
+    for file in sorted(os.listdir(pickle_folder)):
+        if file.endswith(".pickle"):
+            with open(os.path.join(pickle_folder, file), "rb") as pickle_file:
+                data = pickle.load(pickle_file)
+            shard_path = os.path.join(shard_folder, os.path.splitext(file)[0] + SHARD_EXTENSION)
+            write_shard(shard_path, data.x_train, data.y_train)
+            print(f"Converted {file}: {len(data.y_train)} samples")
+
+
+# A read only array that lazily concatenates many arrays (usually shard memory maps) along the first axis
+# Indexing it only reads the requested samples, so datasets can be bigger than the available memory
+class ShardedArray:
+    def __init__(self, parts, sample_shape=OBS_SHAPE, dtype=numpy.int8):
+        self.parts = list(parts)
+        self.sample_shape = tuple(sample_shape)
+        self.dtype = numpy.dtype(dtype)
+        self.offsets = numpy.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.sample_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self[index[0]][(slice(None),) + index[1:]]
+        if isinstance(index, (int, numpy.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f"Index {index} is out of bounds for size {len(self)}.")
+            part = int(numpy.searchsorted(self.offsets, index, side="right")) - 1
+            return numpy.asarray(self.parts[part][index - self.offsets[part]])
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._read_range(start, stop)
+            index = numpy.arange(start, stop, step)
+        return self._read_indices(numpy.asarray(index))
+
+    def __array__(self, dtype=None, copy=None):
+        array = self._read_range(0, len(self))
+        return array if dtype is None else array.astype(dtype)
+
+    # Reads a contiguous range of samples
+    def _read_range(self, start: int, stop: int):
+        result = numpy.empty((max(stop - start, 0),) + self.sample_shape, dtype=self.dtype)
+        position = 0
+        for part, offset in zip(self.parts, self.offsets):
+            part_start = max(start - offset, 0)
+            part_stop = min(stop - offset, len(part))
+            if part_start < part_stop:
+                result[position:position + part_stop - part_start] = part[part_start:part_stop]
+                position += part_stop - part_start
+        return result
+
+    # Reads arbitrary samples, e.g. a shuffled batch
+    def _read_indices(self, indices: numpy.ndarray):
+        if indices.dtype == bool:
+            indices = numpy.flatnonzero(indices)
+        indices = numpy.where(indices < 0, indices + len(self), indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f"Index out of bounds for size {len(self)}.")
+        result = numpy.empty((len(indices),) + self.sample_shape, dtype=self.dtype)
+        parts = numpy.searchsorted(self.offsets, indices, side="right") - 1
+        for part in numpy.unique(parts):
+            mask = parts == part
+            result[mask] = self.parts[part][indices[mask] - self.offsets[part]]
+        return result
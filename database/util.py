@@ -1,3 +1,4 @@
+import asyncio
 import dataclasses
 import math
 import os
@@ -10,6 +11,12 @@ import chess.engine
 import numpy
 from chess.pgn import read_game
 
+from database.analysis_budget import AnalysisBudget
+from database.engine_pool import get_engine_pool
+from database.label_cache import get_label_cache
+from database.shards import write_shard, open_shard, ShardedArray, SHARD_EXTENSION, OBS_SHAPE
+from instrumentation.spans import traced, count
+
 # This file is for convenience
 # Here one can find values and utility functions about dataset management
 
@@ -38,7 +45,8 @@ squares_index = {
 }
 
 
-# Helper class that will be saved as a pickle file
+# Helper class that was saved as a pickle file by older versions
+# It is still needed to load and convert old datasets
 @dataclasses.dataclass
 class DataSet:
     x_train: List[Any]
@@ -46,6 +54,7 @@ class DataSet:
 
 
 # Retrieves the games from a pgn file with progress output
+# All games are held in memory, big files should be streamed with pgn_index.stream_games instead
 def pgn_to_games(pgn_file_path: str, max_games=MAX_GAMES):
     if os.path.exists(pgn_file_path):
         if pgn_file_path.endswith(".pgn"):
@@ -70,16 +79,108 @@ def pgn_to_games(pgn_file_path: str, max_games=MAX_GAMES):
 
 
 # This function evaluates a board position using stockfish and returns an int describing how good the position is for white
-def stockfish_evaluate(board: chess.Board, depth=10):
-    success = True
-    with chess.engine.SimpleEngine.popen_uci(os.path.curdir + '/stockfish/stockfish.exe') as sf:
-        result = sf.analyse(board, chess.engine.Limit(depth=depth))
-        score = result['score'].white().score()
-        sf.close()
-        if score is None:
-            score = 0
-            success = False
-        return score, success
+# The engine is taken from the engine pool of this process, so no new process has to be started per position
+def stockfish_evaluate(board: chess.Board, depth=10, budget: AnalysisBudget = None):
+    return label_boards([board], depth, budget)[0]
+
+
+# Labels many boards at once and returns (score, success) for every board like info_to_score
+# Labels that are already in the label cache are reused, the other boards are analysed in parallel by the engine pool
+# With an AnalysisBudget the analysis of every board stops adaptively instead of at a fixed depth
+# With with_depths the depth every label was analysed with is returned as second list
+@traced("label.boards")
+def label_boards(boards, depth=10, budget: AnalysisBudget = None, with_depths: bool = False):
+    cache = get_label_cache()
+    engine = get_engine_pool().identity if cache is not None else None
+    depth = budget.min_depth if budget is not None else depth
+    labels, depths = _cached_labels(cache, engine, boards, depth)
+    missing = [i for i, label in enumerate(labels) if label is None]
+    if missing:
+        missing_boards = [boards[i] for i in missing]
+        limit, kwargs, max_depth = _analysis_limit(depth, None, budget)
+        infos = asyncio.run(get_engine_pool().evaluate_many(missing_boards, limit, **kwargs))
+        for i, label, label_depth in zip(missing, *_store_labels(cache, engine, missing_boards, infos, max_depth)):
+            labels[i] = label
+            depths[i] = label_depth
+    return (labels, depths) if with_depths else labels
+
+
+# Labels the positions of whole games and returns one list of (score, success) per game
+# Every game is analysed in order by one warm engine (see EnginePool.analyse_game), the games run in parallel
+# The boards have to keep their move stacks, positions found in the label cache are skipped
+# nodes limits each analysis in addition to the depth; with multipv several lines are searched and the best one is the label
+# With an AnalysisBudget the analysis of every position stops adaptively instead of at a fixed depth or node count
+# With with_depths the depths of the labels are returned as second list of lists
+@traced("label.games")
+def label_games(games, depth=10, nodes=None, multipv=None, budget: AnalysisBudget = None, with_depths: bool = False):
+    cache = get_label_cache()
+    engine = get_engine_pool().identity if cache is not None else None
+    depth = budget.min_depth if budget is not None else depth
+    cached = [_cached_labels(cache, engine, boards, depth) for boards in games]
+    labels = [game_labels for game_labels, _ in cached]
+    depths = [game_depths for _, game_depths in cached]
+    missing = [[i for i, label in enumerate(game_labels) if label is None] for game_labels in labels]
+    missing_games = [[boards[i] for i in indices] for boards, indices in zip(games, missing)]
+    if any(missing_games):
+        limit, kwargs, max_depth = _analysis_limit(depth, nodes, budget)
+        if multipv is not None:
+            kwargs["multipv"] = multipv
+        results = asyncio.run(get_engine_pool().analyse_games(missing_games, limit, **kwargs))
+        for game_labels, game_depths, indices, boards, infos in zip(labels, depths, missing, missing_games, results):
+            infos = [info[0] if isinstance(info, list) else info for info in infos]
+            for i, label, label_depth in zip(indices, *_store_labels(cache, engine, boards, infos, max_depth)):
+                game_labels[i] = label
+                game_depths[i] = label_depth
+    return (labels, depths) if with_depths else labels
+
+
+# The labels and depths of the boards that are in the label cache, None for all others
+def _cached_labels(cache, engine: str, boards, depth):
+    if cache is None:
+        return [None] * len(boards), [None] * len(boards)
+    return cache.get_many(boards, engine, depth, with_depths=True)
+
+
+# The limit, the keyword arguments of the engine pool and the maximum depth of a fixed or an adaptive analysis
+# With a budget, the limit is computed right before every position and its nodes are booked right after
+def _analysis_limit(depth, nodes, budget: AnalysisBudget):
+    if budget is None:
+        return chess.engine.Limit(depth=depth, nodes=nodes), {}, depth
+    return budget.limit, {"stop": budget.should_stop, "spend": budget.spend}, budget.max_depth
+
+
+# Converts the infos of an analysis to labels and the depths the engine actually reached
+# Every label is cached with that depth,
+# so labels that were cut short by a node limit or stopped early are not reused as deeper labels
+# Finished games are reported with depth 0, their label can not get any better
+def _store_labels(cache, engine: str, boards, infos, max_depth: int):
+    labels = [info_to_score(info) for info in infos]
+    depths = [min(info.get("depth") or max_depth, max_depth) for info in infos]
+    count("label.analysed", len(infos))
+    count("label.nodes", sum(info.get("nodes", 0) for info in infos))
+    if cache is not None:
+        _cache_labels(cache, engine, boards, depths, labels)
+    return labels, depths
+
+
+# Saves labels of different depths with one query per depth
+def _cache_labels(cache, engine: str, boards, depths, labels):
+    groups = {}
+    for board, depth, label in zip(boards, depths, labels):
+        group = groups.setdefault(depth, ([], []))
+        group[0].append(board)
+        group[1].append(label)
+    for depth, (group_boards, group_labels) in groups.items():
+        cache.put_many(group_boards, engine, depth, group_labels)
+
+
+# Extracts the score for white from the info dictionary of an analysis
+# Mate scores have no centipawn value, so they are reported as unsuccessful with a score of 0
+def info_to_score(info):
+    score = info['score'].white().score()
+    if score is None:
+        return 0, False
+    return score, True
 
 
 # Converts a board object to a 14 * 8 * 8 numpy object
@@ -109,28 +210,126 @@ def stockfish_evaluate(board: chess.Board, depth=10):
 # We also include a matrix to describe what pieces are being attacked
 # This way the network has to carry less work and might be more accurate
 
+@traced("encode.board_to_obs")
 def board_to_obs(board):
-    board3d = numpy.zeros((14, 8, 8), dtype=numpy.int8)
-
-    for piece in chess.PIECE_TYPES:
-        for square in board.pieces(piece, chess.WHITE):
-            idx = numpy.unravel_index(square, (8, 8))
-            board3d[piece - 1][7 - idx[0]][idx[1]] = 1
-        for square in board.pieces(piece, chess.BLACK):
-            idx = numpy.unravel_index(square, (8, 8))
-            board3d[piece + 5][7 - idx[0]][idx[1]] = 1
+    return bitboards_to_obs(board_to_bitboards(board))
+
+
+# Same as board_to_obs, but encodes many boards into one (N, 14, 8, 8) array
+# All bitboards are unpacked in one go, which is a lot faster than encoding every board on its own
+# An already allocated array can be passed as 'out' to avoid a new allocation per batch
+@traced("encode.board_to_obs_batch")
+def board_to_obs_batch(boards, out: numpy.ndarray = None):
+    bitboards = numpy.array([board_to_bitboards(board) for board in boards], dtype=numpy.uint64)
+    return bitboards_to_obs(bitboards, out)
+
+
+# Collects the 14 bitboards the observation consists of
+# The first twelve are the white and black pieces, the last two the target squares of all legal moves per color
+def board_to_bitboards(board: chess.Board):
+    bitboards = [board.pieces_mask(piece, chess.WHITE) for piece in chess.PIECE_TYPES]
+    bitboards += [board.pieces_mask(piece, chess.BLACK) for piece in chess.PIECE_TYPES]
+    bitboards.append(legal_move_mask(board, chess.WHITE))
+    bitboards.append(legal_move_mask(board, chess.BLACK))
+    return bitboards
+
+
+# Returns a bitboard of all squares the given color could move to if it was its turn
+# Equal to collecting the target squares of board.legal_moves, but works on whole bitboards per piece
+# instead of generating and validating every single move
+def legal_move_mask(board: chess.Board, color: chess.Color):
     aux = board.turn
-    board.turn = chess.WHITE
-    for move in board.legal_moves:
-        i, j = square_to_index(move.to_square)
-        board3d[12][i][j] = 1
-    board.turn = chess.BLACK
-    for move in board.legal_moves:
-        i, j = square_to_index(move.to_square)
-        board3d[13][i][j] = 1
+    board.turn = color
+    king_mask = board.kings & board.occupied_co[color]
+    if board.is_variant_end() or chess.popcount(king_mask) != 1:
+        # Positions without exactly one king are rare, so we simply use the legal move generator here
+        mask = 0
+        for move in board.generate_legal_moves():
+            mask |= chess.BB_SQUARES[move.to_square]
+    else:
+        mask = _legal_move_mask(board, color, chess.msb(king_mask))
     board.turn = aux
+    return mask
+
+
+# Helper function of legal_move_mask
+# Mirrors the rules of python-chess: pinned pieces stay on the line of their king, a single check has to be
+# captured or blocked, a double check only allows king moves and the king must not move into an attack
+def _legal_move_mask(board: chess.Board, color: chess.Color, king: int):
+    ours = board.occupied_co[color]
+    theirs = board.occupied_co[not color]
+    blockers = board._slider_blockers(king)
+    checkers = board.attackers_mask(not color, king)
+
+    # King moves
+    king_targets = chess.BB_KING_ATTACKS[king] & ~ours
+    target = chess.BB_ALL
+    if checkers:
+        for checker in chess.scan_reversed(checkers & (board.bishops | board.rooks | board.queens)):
+            king_targets &= ~(chess.ray(king, checker) & ~chess.BB_SQUARES[checker])
+        checker = chess.msb(checkers)
+        target = chess.between(king, checker) | checkers if chess.BB_SQUARES[checker] == checkers else 0
+    mask = 0
+    for square in chess.scan_reversed(king_targets):
+        if not board.is_attacked_by(not color, square):
+            mask |= chess.BB_SQUARES[square]
+    # Generating castling moves is expensive, so it is skipped if the color has no castling rights at all
+    if not checkers and board.castling_rights & (chess.BB_RANK_1 if color == chess.WHITE else chess.BB_RANK_8):
+        for move in board.generate_castling_moves():
+            mask |= chess.BB_SQUARES[move.to_square]
+    if not target:
+        return mask
+
+    # Piece moves
+    for square in chess.scan_reversed(ours & ~board.pawns & ~board.kings):
+        targets = board.attacks_mask(square) & ~ours & target
+        if blockers & chess.BB_SQUARES[square]:
+            targets &= chess.ray(king, square)
+        mask |= targets
+
+    # Pawn moves, the captures of all pawns that are not pinned are shifted at once
+    pawns = board.pawns & ours
+    for square in chess.scan_reversed(pawns & blockers):
+        targets = chess.BB_PAWN_ATTACKS[color][square] & theirs
+        targets = (targets | _pawn_advances(board, color, chess.BB_SQUARES[square])) & chess.ray(king, square)
+        mask |= targets & target
+    mask |= (_pawn_captures(color, pawns & ~blockers) & theirs | _pawn_advances(board, color, pawns & ~blockers)) & target
+    if board.ep_square is not None:
+        for move in board.generate_legal_ep():
+            mask |= chess.BB_SQUARES[move.to_square]
+    return mask
 
-    return board3d
+
+# Returns the squares the given pawns attack
+def _pawn_captures(color: chess.Color, pawns: int):
+    if color == chess.WHITE:
+        return (pawns << 7 & ~chess.BB_FILE_H | pawns << 9 & ~chess.BB_FILE_A) & chess.BB_ALL
+    return pawns >> 9 & ~chess.BB_FILE_H | pawns >> 7 & ~chess.BB_FILE_A
+
+
+# Returns the squares the given pawns can advance to with single and double steps
+def _pawn_advances(board: chess.Board, color: chess.Color, pawns: int):
+    if color == chess.WHITE:
+        single_moves = pawns << 8 & ~board.occupied
+        double_moves = single_moves << 8 & ~board.occupied & (chess.BB_RANK_3 | chess.BB_RANK_4)
+    else:
+        single_moves = pawns >> 8 & ~board.occupied
+        double_moves = single_moves >> 8 & ~board.occupied & (chess.BB_RANK_6 | chess.BB_RANK_5)
+    return (single_moves | double_moves) & chess.BB_ALL
+
+
+# Unpacks bitboards of shape (..., 14) into observations of shape (..., 14, 8, 8)
+# A bitboard stored as big endian bytes starts with the eighth rank and has the a-file in its lowest bit,
+# so unpacking it in little bit order directly yields the rows of our 8 * 8 matrices
+def bitboards_to_obs(bitboards, out: numpy.ndarray = None):
+    bitboards = numpy.asarray(bitboards, dtype=numpy.uint64)
+    packed = bitboards.astype(">u8").view(numpy.uint8)
+    obs = numpy.unpackbits(packed, axis=-1, bitorder="little").view(numpy.int8)
+    obs = obs.reshape(bitboards.shape + (8, 8))
+    if out is None:
+        return obs
+    out[...] = obs
+    return out
 
 
 # Convert a coordinate (a1-h8) to a square int (0-63)
@@ -146,29 +345,37 @@ def normalize_labels(y_train: numpy.ndarray):
     return numpy.asarray(y_train / abs(y_train).max() / 2 + 0.5, dtype=numpy.float32)
 
 
-# Save a dataset to local storage as a pickle file
-def save_dataset(pickle_folder: str, x_train, y_train):
-    dataset = DataSet(
-        x_train=x_train,
-        y_train=y_train
-    )
-    file_name = datetime.now().strftime("%d_%m_%Y-%H_%M_%S.pickle")
-    with open(f"{pickle_folder}/{file_name}", "wb") as file:
-        pickle.dump(dataset, file)
-        file.close()
-
-
-# Load a dataset from local storage as a pickle file
-def load_datasets(pickle_folder: str):
-    x_train = []
-    y_train = []
-    path = pickle_folder
-    for file in os.listdir(path):
-        if file.endswith(".pickle"):
-            with open(path + file, "rb") as pickle_file:
+# Save a dataset to local storage as a shard file (see shards.py)
+# If no file name is given the current time is used
+# The search depths of the labels are stored with them if they are given
+@traced("io.save_dataset")
+def save_dataset(dataset_folder: str, x_train, y_train, file_name: str = None, depths=None):
+    if file_name is None:
+        file_name = datetime.now().strftime("%d_%m_%Y-%H_%M_%S" + SHARD_EXTENSION)
+    write_shard(f"{dataset_folder}/{file_name}", x_train, y_train, depths=depths)
+
+
+# Load all datasets of a folder
+# The observations are returned as a lazy view over the memory mapped shards, so nothing is read until it is used
+# The labels are small enough to be loaded into memory at once
+# Old pickle datasets are still loaded (into memory) unless they were converted with convert_pickle_datasets
+@traced("io.load_datasets")
+def load_datasets(dataset_folder: str):
+    x_parts = []
+    y_parts = []
+    path = dataset_folder
+    for file in sorted(os.listdir(path)):
+        if file.endswith(SHARD_EXTENSION):
+            x, y = open_shard(os.path.join(path, file))
+        elif file.endswith(".pickle") and not os.path.exists(os.path.join(path, file[:-7] + SHARD_EXTENSION)):
+            with open(os.path.join(path, file), "rb") as pickle_file:
                 data = pickle.load(pickle_file)
-                x_train += data.x_train
-                y_train += data.y_train
-    x_train = numpy.asarray(x_train)
-    y_train = numpy.array(y_train)
+                x = numpy.asarray(data.x_train, dtype=numpy.int8).reshape((-1,) + OBS_SHAPE)
+                y = data.y_train
+        else:
+            continue
+        x_parts.append(x)
+        y_parts.append(numpy.asarray(y, dtype=numpy.float32))
+    x_train = ShardedArray(x_parts)
+    y_train = numpy.concatenate(y_parts) if y_parts else numpy.zeros(0, dtype=numpy.float32)
     return x_train, y_train
@@ -1,16 +1,19 @@
 import random
 import sys
+import threading
 import time
 import traceback
 
 import chess
+import chess.engine
 import pygame
 
 from chess_api.chess_player import ChessPlayer, CustomEngine
 from chess_api.default_values import RANKS, FILES, BOARD_GREEN, BOARD_WHITE, SQUARE_SIZE, SCREEN_SIZE, BLACK, \
     PIECE_SIZE, GRAY, INFO_SPACE, LINE_THICKNESS, AUTO_MOVE_TIME, WHITE, BRIGHTEN_EFFECT, DARKEN_EFFECT, LIGHT_GRAY, \
     MOVES_PER_ROW, MOVE_DISTANCE, BOARD_WIDTH, BOARD_HEIGHT
-from database.database_random import stockfish_evaluate
+from database.engine_pool import get_engine_pool
+from database.util import info_to_score
 
 
 # This file is used to communicate between the user and the engines.
@@ -41,6 +44,12 @@ class InteractiveBoard:
         # The move time is used for autoplay
         self.last_move_time = time.time()
 
+        # The players search on a background thread, so the window stays responsive while they think
+        # The result is only played if the game is still in the position the search started from
+        self._search_thread = None
+        self._search_result = None
+        self._move_requested = False
+
         # We store the players in an array, so we can shuffle the positions easily anytime
         self.players = [player_1, player_2]
 
@@ -96,19 +105,54 @@ class InteractiveBoard:
         pygame.display.update()
 
     # Autoplay function. Pushes a piece every second
+    # The search for the next move starts right after the last move, so slow players use the waiting time to think
     def _auto_move(self):
-        if not self.paused:
-            if self.seconds_since_last_move() >= AUTO_MOVE_TIME:
-                self._play_next_move()
+        if not self.paused or self._move_requested:
+            self._start_search()
+            if self._move_requested or self.seconds_since_last_move() >= AUTO_MOVE_TIME:
+                self._play_found_move()
 
-    # Plays the next move according to whose turn it is
-    def _play_next_move(self):
+    # The player whose turn it is
+    def _next_player(self):
         player: ChessPlayer
         if len(self.moves) % 2 == 0:
             player = self.players[0]
         else:
             player = self.players[1]
-        self.play_move(player.get_move(self.board))
+        return player
+
+    # Starts the search of the next move on a background thread, if none is running yet
+    def _start_search(self):
+        if self._search_thread is not None or self.board.is_game_over():
+            return
+        player = self._next_player()
+        board = self.board.copy()
+
+        def search():
+            try:
+                move = player.get_move(board, chess.engine.Limit(time=AUTO_MOVE_TIME))
+                self._search_result = (player, board.move_stack, move)
+            except Exception:
+                traceback.print_exc()
+
+        self._search_result = None
+        self._search_thread = threading.Thread(target=search, daemon=True)
+        self._search_thread.start()
+
+    # Plays the move of a finished search, results of positions that were left in the meantime are dropped
+    def _play_found_move(self):
+        if self._search_thread is None or self._search_thread.is_alive():
+            return
+        self._search_thread = None
+        if self._search_result is not None:
+            player, move_stack, move = self._search_result
+            if player is self._next_player() and move_stack == self.board.move_stack:
+                self._move_requested = False
+                self.play_move(move)
+
+    # Plays the next move according to whose turn it is, as soon as the player found it
+    def _play_next_move(self):
+        self._move_requested = True
 
     # We have to know when autoplay has to make the next move
     def seconds_since_last_move(self):
@@ -137,7 +181,8 @@ class InteractiveBoard:
 
     # We ask stockfish about its evaluation for the current board position
     def update_evaluation(self):
-        self.stockfish_evaluation, success = stockfish_evaluate(board=self.board, depth=10)
+        info = get_engine_pool().evaluate(self.board, chess.engine.Limit(depth=10))
+        self.stockfish_evaluation, success = info_to_score(info)
 
     # Renders the content on the pygame surface and forces it to update
     def _update(self):
@@ -0,0 +1,189 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# This file makes long running jobs (e.g. a dataset job that runs for days) observable from the outside
+# A job reports its counters (e.g. labeled positions) and gauges (e.g. the hit rate of a cache) to a MetricsExporter.
+# The exporter publishes them in two ways, both are optional:
+# - it appends a snapshot as one json line to a file every few seconds, which can be followed with 'tail -f'
+# - it serves them in the Prometheus text format on http://127.0.0.1:<port>/metrics
+# Every snapshot also contains the rate of every counter since the last snapshot, the memory of the process (RSS)
+# and the estimated time until the job is done
+# The outputs are read at different intervals (e.g. the file every few seconds, Prometheus whenever it scrapes),
+# so every output has its own rate window and reading one of them does not change the rates of the others
+# All metrics are labeled with the name of the dataset the job creates. Prometheus reserves the label 'job'
+# for the name of the scrape target, so it is not used here
+# Without a path or port (or the environment variables below), the exporter does nothing
+
+METRICS_PATH = os.environ.get("SUPERVISED_CHESS_METRICS")
+METRICS_PORT = int(os.environ["SUPERVISED_CHESS_METRICS_PORT"]) if os.environ.get("SUPERVISED_CHESS_METRICS_PORT") \
+    else None
+METRICS_INTERVAL = 10
+
+METRIC_PREFIX = "supervised_chess_"
+
+
+class MetricsExporter:
+    # progress_counter is the counter that is compared against total to estimate the remaining time
+    def __init__(self, dataset: str, total: float = None, progress_counter: str = None, path: str = METRICS_PATH,
+                 port: int = METRICS_PORT, interval: float = METRICS_INTERVAL):
+        self.dataset = dataset
+        self.total = total
+        self.progress_counter = progress_counter
+        self.path = path
+        self.interval = interval
+        self.start = time.time()
+        self.counters = {}
+        self.gauges = {}
+        # The counters, time and rates of the last snapshot of every rate window
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._server = None
+        self._thread = None
+
+        if port is not None:
+            self._server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if path is not None:
+            self._thread = threading.Thread(target=self._write_periodically, daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return self._server is not None or self._thread is not None
+
+    def add(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    # The current state of the job, the rates are the ones since the last snapshot of the same window
+    # Snapshots less than a second apart keep the rates of the window, they would be too noisy
+    def snapshot(self, window: str = "default"):
+        now = time.time()
+        with self._lock:
+            last_counters, last_time, rates = self._windows.get(window, ({}, self.start, None))
+            elapsed = now - last_time
+            if elapsed >= 1 or rates is None:
+                rates = {name: (value - last_counters.get(name, 0)) / max(elapsed, 1e-9)
+                         for name, value in self.counters.items()}
+                self._windows[window] = (dict(self.counters), now, rates)
+            snapshot = {
+                "time": now,
+                "dataset": self.dataset,
+                "elapsed_seconds": now - self.start,
+                "counters": dict(self.counters),
+                "rates": dict(rates),
+                "gauges": dict(self.gauges),
+                "rss_bytes": rss_bytes()
+            }
+        snapshot["eta_seconds"] = self._eta(snapshot)
+        return snapshot
+
+    # The remaining time at the average speed of the job so far
+    def _eta(self, snapshot):
+        if self.total is None or self.progress_counter is None:
+            return None
+        done = snapshot["counters"].get(self.progress_counter, 0)
+        if done <= 0:
+            return None
+        return max(self.total - done, 0) * snapshot["elapsed_seconds"] / done
+
+    def prometheus(self):
+        snapshot = self.snapshot("prometheus")
+        lines = []
+
+        def metric(name, value, kind):
+            if value is None:
+                return
+            name = METRIC_PREFIX + _metric_name(name)
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f'{name}{{dataset="{self.dataset}"}} {value}')
+
+        for name, value in snapshot["counters"].items():
+            metric(name + "_total", value, "counter")
+        for name, value in snapshot["rates"].items():
+            metric(name + "_per_second", value, "gauge")
+        for name, value in snapshot["gauges"].items():
+            metric(name, value, "gauge")
+        metric("elapsed_seconds", snapshot["elapsed_seconds"], "gauge")
+        metric("eta_seconds", snapshot["eta_seconds"], "gauge")
+        metric("rss_bytes", snapshot["rss_bytes"], "gauge")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self):
+        if self.path is None:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as file:
+            file.write(json.dumps(self.snapshot("file")) + "\n")
+
+    def _write_periodically(self):
+        while not self._closed.wait(self.interval):
+            self.write_snapshot()
+
+    # Writes a last snapshot and stops the http server
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.write_snapshot()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _metric_name(name: str):
+    return "".join(character if character.isalnum() else "_" for character in name)
+
+
+def _handler(exporter: MetricsExporter):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = exporter.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Requests are not logged, they would mix with the progress output of the job
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+# The resident memory of this process in bytes
+# Linux reports the current value, other systems only the peak, which is used instead
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
@@ -0,0 +1,225 @@
+import atexit
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+
+# This file measures where the time of a dataset job, a training run or a game goes
+# Hot paths are wrapped into named spans (@traced("name") or "with span('name'):") and events are counted (count)
+# Everything is off by default and then costs a single flag check per call.
+# It is switched on with enable() or the environment variable SUPERVISED_CHESS_TRACE:
+# - "1": every span records how often it ran and a histogram of its durations, a summary is printed at exit
+# - "profile": additionally runs cProfile over the whole process and saves its stats at exit (see PROFILE_PATH)
+# Traced functions are renamed to "span_<name>" in their code object, so cProfile and sampling profilers
+# like py-spy show the span names in their stacks
+# Worker processes inherit the state of their parent, their summaries can be sent back and merged with merge()
+
+TRACE_VARIABLE = "SUPERVISED_CHESS_TRACE"
+PROFILE_PATH = os.environ.get("SUPERVISED_CHESS_PROFILE", "trace.prof")
+
+# Durations are sorted into buckets by powers of two nanoseconds, which is enough to tell microseconds from seconds
+BUCKETS = 40
+
+_enabled = False
+_profiler = None
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_exit_registered = False
+
+
+def is_enabled():
+    return _enabled
+
+
+# Switches the instrumentation on, with profile=True the whole process also runs under cProfile
+def enable(profile: bool = False):
+    global _enabled, _profiler, _exit_registered
+    _enabled = True
+    if profile and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if not _exit_registered:
+        atexit.register(_dump_at_exit)
+        _exit_registered = True
+
+
+def disable():
+    global _enabled, _profiler
+    _enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(PROFILE_PATH)
+        _profiler = None
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+# Durations of one span: count, total, min, max and the histogram
+class _SpanStats:
+    __slots__ = ("count", "total", "minimum", "maximum", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = 0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, nanoseconds: int):
+        self.count += 1
+        self.total += nanoseconds
+        self.minimum = nanoseconds if self.minimum is None else min(self.minimum, nanoseconds)
+        self.maximum = max(self.maximum, nanoseconds)
+        self.buckets[min(nanoseconds.bit_length(), BUCKETS - 1)] += 1
+
+    # The upper bound of the bucket that contains the given share of all durations
+    def percentile(self, share: float):
+        target = share * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(1 << bucket, self.maximum)
+        return self.maximum
+
+
+def _record(name: str, nanoseconds: int):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = _SpanStats()
+        stats.add(nanoseconds)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _record(self.name, time.perf_counter_ns() - self.start)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+# with span("name"): measures the block, the same disabled span object is reused, so nothing is allocated
+def span(name: str):
+    return _Span(name) if _enabled else _NO_SPAN
+
+
+# Measures every call of the decorated function
+def traced(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter_ns() - start)
+
+        wrapper.__code__ = wrapper.__code__.replace(co_name="span_" + name.replace(".", "_"))
+        return wrapper
+
+    return decorator
+
+
+# Adds to a named counter, e.g. the number of evaluated positions
+def count(name: str, value: int = 1):
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+# All spans and counters as plain dictionaries, times are in milliseconds
+def summary():
+    with _lock:
+        spans = {
+            name: {
+                "count": stats.count,
+                "total_ms": stats.total / 1e6,
+                "mean_ms": stats.total / max(stats.count, 1) / 1e6,
+                "min_ms": (stats.minimum or 0) / 1e6,
+                "p50_ms": stats.percentile(0.5) / 1e6,
+                "p90_ms": stats.percentile(0.9) / 1e6,
+                "p99_ms": stats.percentile(0.99) / 1e6,
+                "max_ms": stats.maximum / 1e6,
+                "buckets": list(stats.buckets)
+            } for name, stats in _spans.items()
+        }
+        return {"spans": spans, "counters": dict(_counters)}
+
+
+# Returns the summary and starts over, e.g. to send the data of a finished work unit to the main process
+def take_summary():
+    result = summary()
+    reset()
+    return result
+
+
+# Adds the summary of another process to the data of this process
+def merge(other: dict):
+    with _lock:
+        for name, data in other.get("spans", {}).items():
+            stats = _spans.get(name)
+            if stats is None:
+                stats = _spans[name] = _SpanStats()
+            stats.count += data["count"]
+            stats.total += round(data["total_ms"] * 1e6)
+            minimum = round(data["min_ms"] * 1e6)
+            stats.minimum = minimum if stats.minimum is None else min(stats.minimum, minimum)
+            stats.maximum = max(stats.maximum, round(data["max_ms"] * 1e6))
+            stats.buckets = [a + b for a, b in zip(stats.buckets, data["buckets"])]
+        for name, value in other.get("counters", {}).items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+# Prints one line per span, sorted by the total time, and the counters
+def dump_summary(file=sys.stderr):
+    data = summary()
+    if not data["spans"] and not data["counters"]:
+        return
+    print(f"{'span':<28}{'count':>10}{'total ms':>12}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}", file=file)
+    for name, stats in sorted(data["spans"].items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"{name:<28}{stats['count']:>10}{stats['total_ms']:>12.1f}{stats['mean_ms']:>10.3f}"
+              f"{stats['p50_ms']:>10.3f}{stats['p90_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}",
+              file=file)
+    for name, value in sorted(data["counters"].items()):
+        print(f"{name:<28}{value:>10}", file=file)
+
+
+def _dump_at_exit():
+    if _profiler is not None:
+        disable()
+        print(f"cProfile stats written to {PROFILE_PATH}", file=sys.stderr)
+    dump_summary()
+
+
+if os.environ.get(TRACE_VARIABLE, "").lower() in ("1", "true", "on"):
+    enable()
+elif os.environ.get(TRACE_VARIABLE, "").lower() == "profile":
+    enable(profile=True)
@@ -1,48 +1,56 @@
+import argparse
 import os.path
-import numpy
+import sys
 
-from chess_api.chess_player import RandomEngine, CustomEngine
-from chess_api.default_values import PIECE_IMAGE_PATH, BUTTON_IMAGE_PATH
-from database.util import load_datasets, normalize_labels
-from gui.interactive_board import InteractiveBoard
+from instrumentation.metrics import METRICS_PATH, METRICS_PORT
 
-from neural_network.evaluation import BoardEvaluationNetwork
-from database.database_random import create_random_dataset, random_board, stockfish_evaluate
-from database.database_pgn import create_pgn_dataset
+# The command line interface of the project
+# python main.py <command> --help shows the options of a command
+# TensorFlow, keras and pygame take seconds to import, so every command only imports what it needs:
+# generating datasets, playing or benchmarking with a converted model never touches TensorFlow
 
 
 # Create a dataset of given size
 def create_dataset(dataset_size=10_000):
+    from database.database_random import create_random_dataset
     # Create dataset
     create_random_dataset(dataset_size=dataset_size)
 
 
 # Create a convolutional neural network
-def create_convolutional_network(pickle_folder: str, save_folder: str, size: int = 32, depth: int = 4,
+# The dataset is streamed from its shards, so it does not have to fit into memory
+def create_convolutional_network(dataset_folder: str, save_folder: str, size: int = 32, depth: int = 4,
                                  epochs: int = 500):
-    x_train, y_train = load_datasets(pickle_folder)
-    x_train = numpy.array(x_train)
-    y_train = normalize_labels(y_train)
-
+    from neural_network.evaluation import BoardEvaluationNetwork
     network = BoardEvaluationNetwork()
     network.create_convolutional_network(size, depth)
-    network.train(save_folder, x_train, y_train, batch_size=2048, epochs=epochs)
-    test_board = random_board()
-    network_score = network.predict_evaluation(test_board)
-    stockfish_score = stockfish_evaluate(test_board)
-    print(f"Predicted Normalized Score: {network_score}")
-    print(f"Actual Non-Normalized Score: {stockfish_score}")
+    network.train_streaming(save_folder, dataset_folder, batch_size=2048, epochs=epochs)
+    _compare_with_stockfish(network)
 
 
 # Create a residual neural network for deeper connections
-def create_residual_network(pickle_folder: str, save_folder: str, size: int = 32, depth: int = 4, epochs: int = 1000):
-    x_train, y_train = load_datasets(pickle_folder)
-    x_train = numpy.array(x_train)
-    y_train = normalize_labels(y_train)
-
+def create_residual_network(dataset_folder: str, save_folder: str, size: int = 32, depth: int = 4, epochs: int = 1000):
+    from neural_network.evaluation import BoardEvaluationNetwork
     network = BoardEvaluationNetwork()
     network.create_residual_network(size, depth)
-    network.train(save_folder, x_train, y_train, batch_size=2048, epochs=epochs)
+    network.train_streaming(save_folder, dataset_folder, batch_size=2048, epochs=epochs)
+    _compare_with_stockfish(network)
+
+
+# Create an efficiently updatable network (NNUE)
+# Next to the keras model, the weights for the numpy accumulator are saved as 'nnue.npz' in the save folder
+def create_nnue_network(dataset_folder: str, save_folder: str, accumulator_size: int = 256, hidden_size: int = 32,
+                        epochs: int = 500):
+    from neural_network.evaluation import BoardEvaluationNetwork
+    network = BoardEvaluationNetwork()
+    network.create_nnue_network(accumulator_size, hidden_size)
+    network.train_streaming(save_folder, dataset_folder, batch_size=2048, epochs=epochs)
+    network.export_nnue_model(os.path.join(save_folder, "nnue.npz"))
+    _compare_with_stockfish(network)
+
+
+def _compare_with_stockfish(network):
+    from database.database_random import random_board, stockfish_evaluate
     test_board = random_board()
     network_score = network.predict_evaluation(test_board)
     stockfish_score = stockfish_evaluate(test_board)
@@ -52,18 +60,172 @@ def create_residual_network(pickle_folder: str, save_folder: str, size: int = 32
 
 # Set up a playing environment to run the simulation
 def play(model_path: str):
+    from chess_api.chess_player import RandomEngine, CustomEngine, load_network
+    from chess_api.default_values import PIECE_IMAGE_PATH, BUTTON_IMAGE_PATH
+    from gui.interactive_board import InteractiveBoard
     board = InteractiveBoard(button_folder=os.getcwd() + BUTTON_IMAGE_PATH, piece_folder=os.getcwd() + PIECE_IMAGE_PATH,
-                             player_1=RandomEngine(), player_2=CustomEngine(
-            BoardEvaluationNetwork(model_path)))
+                             player_1=RandomEngine(), player_2=CustomEngine(load_network(model_path)))
     board.run()
 
 
 # Create a non-random but instead grandmaster level dataset using pgn files
 def create_pgn_data():
+    from database.database_pgn import create_pgn_dataset
     create_pgn_dataset(pgn_folder=os.getcwd() + "/database/pgn/", save_folder=os.getcwd() + "/datasets/pgn_trained/")
 
 
+def _generate(arguments):
+    budget = None
+    if arguments.shard_nodes is not None:
+        from database.analysis_budget import AnalysisBudget
+        budget = AnalysisBudget(shard_nodes=arguments.shard_nodes, shard_size=arguments.shard_size)
+    engine_options = {"engine_path": arguments.engine} if arguments.engine is not None else None
+    if arguments.source == "random":
+        from database.database_random import create_random_dataset
+        create_random_dataset(arguments.size, arguments.depth or 4, arguments.save_folder, workers=arguments.workers,
+                              shard_size=arguments.shard_size, engine_options=engine_options, budget=budget,
+                              metrics_path=arguments.metrics_file, metrics_port=arguments.metrics_port)
+    else:
+        from database.database_pgn import create_pgn_dataset
+        create_pgn_dataset(arguments.pgn_folder, arguments.save_folder, workers=arguments.workers,
+                           shard_size=arguments.shard_size, engine_options=engine_options,
+                           depth=arguments.depth or 10, budget=budget, metrics_path=arguments.metrics_file,
+                           metrics_port=arguments.metrics_port)
+
+
+def _train(arguments):
+    if arguments.network == "convolutional":
+        create_convolutional_network(arguments.dataset_folder, arguments.save_folder, arguments.size,
+                                     arguments.depth, arguments.epochs)
+    elif arguments.network == "residual":
+        create_residual_network(arguments.dataset_folder, arguments.save_folder, arguments.size,
+                                arguments.depth, arguments.epochs)
+    else:
+        create_nnue_network(arguments.dataset_folder, arguments.save_folder, epochs=arguments.epochs)
+
+
+def _match(arguments):
+    import functools
+    from chess_api.match_runner import run_match, random_player, custom_player
+
+    def player(name):
+        return random_player if name == "random" else functools.partial(custom_player, name, arguments.depth)
+
+    result = run_match(player(arguments.player_1), player(arguments.player_2), games=arguments.games,
+                       workers=arguments.workers, openings=arguments.openings, move_time=arguments.move_time,
+                       pgn_path=arguments.pgn, threads=arguments.threads)
+    print(result.summary())
+
+
+def _uci(arguments):
+    from chess_api.uci import UciEngine
+    UciEngine(arguments.model_path, depth=arguments.depth).run()
+
+
+def _bench(arguments):
+    from bench.runner import main as run_bench
+    run_bench(arguments.options)
+
+
+# Models are written next to the source model if no output is given
+def _convert(arguments):
+    root = os.path.splitext(arguments.source)[0]
+    if arguments.target == "shards":
+        from database.shards import convert_pickle_datasets
+        convert_pickle_datasets(arguments.source, arguments.output)
+    elif arguments.target == "numpy":
+        from neural_network.evaluation import BoardEvaluationNetwork
+        BoardEvaluationNetwork(arguments.source).export_numpy_model(arguments.output or root + ".npz")
+    elif arguments.target == "nnue":
+        from neural_network.evaluation import BoardEvaluationNetwork
+        BoardEvaluationNetwork(arguments.source).export_nnue_model(arguments.output or root + "_nnue.npz")
+    elif arguments.target == "quantized":
+        from neural_network.quantization import quantize_with_dataset
+        quantize_with_dataset(arguments.source, arguments.output or root + "_int8.tflite", arguments.dataset_folder)
+    else:
+        from database.pgn_index import build_pgn_index
+        build_pgn_index(arguments.source, arguments.output)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="SupervisedChess")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="create a labeled dataset")
+    generate.add_argument("source", choices=["random", "pgn"])
+    generate.add_argument("--save-folder", default="datasets")
+    generate.add_argument("--pgn-folder", default=os.path.join("database", "pgn"))
+    generate.add_argument("--size", type=int, default=10_000, help="number of random positions")
+    generate.add_argument("--depth", type=int, help="analysis depth (4 for random, 10 for pgn positions)")
+    generate.add_argument("--shard-nodes", type=int, help="analyse adaptively with this node budget per shard")
+    generate.add_argument("--shard-size", type=int, default=10_000)
+    generate.add_argument("--workers", type=int)
+    generate.add_argument("--engine", help="path of the UCI engine, STOCKFISH_PATH by default")
+    generate.add_argument("--metrics-file", default=METRICS_PATH, help="json lines file the job metrics are appended to")
+    generate.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                          help="serve the job metrics in the Prometheus format on localhost")
+    generate.set_defaults(function=_generate)
+
+    train = commands.add_parser("train", help="train a network on a dataset")
+    train.add_argument("network", choices=["convolutional", "residual", "nnue"])
+    train.add_argument("dataset_folder")
+    train.add_argument("save_folder")
+    train.add_argument("--size", type=int, default=32)
+    train.add_argument("--depth", type=int, default=4)
+    train.add_argument("--epochs", type=int, default=500)
+    train.set_defaults(function=_train)
+
+    play_command = commands.add_parser("play", help="watch a network play in the gui")
+    play_command.add_argument("model_path")
+    play_command.set_defaults(function=lambda arguments: play(arguments.model_path))
+
+    match = commands.add_parser("match", help="play a headless match, a player is 'random' or a model path")
+    match.add_argument("player_1")
+    match.add_argument("player_2")
+    match.add_argument("--games", type=int, default=100)
+    match.add_argument("--workers", type=int)
+    match.add_argument("--threads", type=int, default=1,
+                       help="games every worker plays at the same time, custom players share one network")
+    match.add_argument("--move-time", type=float, default=0.1)
+    match.add_argument("--depth", type=int, default=3)
+    match.add_argument("--openings", help="pgn or epd file with openings")
+    match.add_argument("--pgn", help="file the games are appended to")
+    match.set_defaults(function=_match)
+
+    uci = commands.add_parser("uci", help="run a network as UCI engine")
+    uci.add_argument("model_path")
+    uci.add_argument("--depth", type=int, default=3)
+    uci.set_defaults(function=_uci)
+
+    # The options of the benchmarks are passed on to bench/runner.py
+    bench = commands.add_parser("bench", help="run the benchmarks, python main.py bench --help for the options",
+                                add_help=False)
+    bench.set_defaults(function=_bench)
+
+    convert = commands.add_parser("convert", help="convert datasets, models and pgn files")
+    convert.add_argument("target", choices=["shards", "numpy", "nnue", "quantized", "index"],
+                         help="shards: pickle datasets to shards, numpy / nnue: keras model to npz, "
+                              "quantized: keras model to an int8 tflite model (smaller and faster on the cpu), "
+                              "index: index of a pgn file")
+    convert.add_argument("source")
+    convert.add_argument("output", nargs="?")
+    convert.add_argument("--dataset-folder",
+                         help="positions to calibrate quantized models and to report their error and speedup")
+    convert.set_defaults(function=_convert)
+    return parser
+
+
+def main(argv=None):
+    parser = create_parser()
+    arguments, options = parser.parse_known_args(argv)
+    if options and arguments.command != "bench":
+        parser.error(f"unrecognized arguments: {' '.join(options)}")
+    if arguments.command == "convert" and arguments.target == "quantized" and arguments.dataset_folder is None:
+        parser.error("convert quantized requires --dataset-folder")
+    arguments.options = options
+    arguments.function(arguments)
+
+
 # Run the program (driver)
 if __name__ == '__main__':
-    play("C:/Users/reyof/PycharmProjects/SupervisedChess/models/pgn_trained/normalized_y/convolutional_1000.h5")
-    # create_convolutional_network("C:/Users/reyof/PycharmProjects/SupervisedChess/datasets/pgn_data/", "C:/Users/reyof/PycharmProjects/SupervisedChess/models/pgn_trained/", 64, 18, 1000)
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+import os
+import random
+
+import numpy
+import tensorflow as tf
+
+from database.shards import open_shard, pack_obs, PackedObservations, SHARD_EXTENSION, PACKED_SIZE, OBS_SHAPE
+
+# This file streams datasets from shard files into keras
+# Instead of loading the whole dataset into memory, the shards are read in chunks by several readers at once,
+# mixed in a bounded shuffle buffer, decoded in parallel and prefetched while the model trains on the previous batch
+# Samples stay bit packed until they are decoded, so the shuffle buffer only needs 112 bytes per sample
+
+CHUNK_SIZE = 4096
+
+
+# Describes a dataset folder that can be streamed into model.fit
+# The shards are split into a training and a validation part once, so validation samples are never trained on
+class ShardStream:
+    def __init__(self, dataset_folder: str, batch_size: int = 2048, shuffle_buffer: int = 200_000,
+                 validation_split: float = 0.1, readers: int = 4, seed: int = None):
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.readers = readers
+        self.seed = seed
+
+        shard_paths = sorted(os.path.join(dataset_folder, file) for file in os.listdir(dataset_folder)
+                             if file.endswith(SHARD_EXTENSION))
+        if not shard_paths:
+            raise FileNotFoundError(f"No shards found in {dataset_folder}. "
+                                    f"Old pickle datasets can be converted with convert_pickle_datasets.")
+        random.Random(seed).shuffle(shard_paths)
+        validation_shards = int(len(shard_paths) * validation_split)
+        if validation_split > 0 and len(shard_paths) > 1:
+            validation_shards = max(validation_shards, 1)
+        self.validation_paths = shard_paths[:validation_shards]
+        self.training_paths = shard_paths[validation_shards:]
+
+        # The labels are normalized just like normalize_labels does it, which needs the highest value of all labels
+        self.samples = {}
+        label_scale = 0
+        for path in shard_paths:
+            y_train = open_shard(path)[1]
+            self.samples[path] = len(y_train)
+            if len(y_train):
+                label_scale = max(label_scale, float(numpy.abs(y_train).max()))
+        self.label_scale = label_scale if label_scale > 0 else 1
+
+    def training_size(self):
+        return sum(self.samples[path] for path in self.training_paths)
+
+    def validation_size(self):
+        return sum(self.samples[path] for path in self.validation_paths)
+
+    # The dataset used for training, which is shuffled again whenever keras starts a new epoch
+    def training_dataset(self):
+        return self._dataset(self.training_paths, shuffle=True)
+
+    # The dataset used for validation, which is neither shuffled nor repeated
+    def validation_dataset(self):
+        if not self.validation_paths:
+            return None
+        return self._dataset(self.validation_paths, shuffle=False)
+
+    def _dataset(self, paths, shuffle: bool):
+        dataset = tf.data.Dataset.from_tensor_slices(paths)
+        if shuffle:
+            dataset = dataset.shuffle(len(paths), seed=self.seed, reshuffle_each_iteration=True)
+        dataset = dataset.interleave(
+            lambda path: tf.data.Dataset.from_generator(
+                _read_chunks,
+                args=(path,),
+                output_signature=(
+                    tf.TensorSpec(shape=(None, PACKED_SIZE), dtype=tf.uint8),
+                    tf.TensorSpec(shape=(None,), dtype=tf.float32)
+                )),
+            cycle_length=self.readers,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=not shuffle
+        )
+        dataset = dataset.unbatch()
+        if shuffle:
+            dataset = dataset.shuffle(self.shuffle_buffer, seed=self.seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.map(self._decode, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    # Unpacks a batch of packed observations into float tensors and normalizes the labels
+    def _decode(self, packed, y_train):
+        bits = tf.bitwise.right_shift(tf.expand_dims(packed, -1), tf.constant(list(range(8)), dtype=tf.uint8))
+        x_train = tf.reshape(tf.bitwise.bitwise_and(bits, 1), (-1,) + OBS_SHAPE)
+        y_train = y_train / self.label_scale / 2 + 0.5
+        return tf.cast(x_train, tf.float32), y_train
+
+
+# Reads a shard in chunks of packed observations and labels
+def _read_chunks(path):
+    x_train, y_train = open_shard(path.decode() if isinstance(path, bytes) else path)
+    for start in range(0, len(y_train), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        if isinstance(x_train, PackedObservations):
+            packed = numpy.asarray(x_train.packed[start:stop])
+        else:
+            packed = pack_obs(x_train[start:stop])
+        yield packed, numpy.asarray(y_train[start:stop])
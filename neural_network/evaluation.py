@@ -1,16 +1,21 @@
-import math
 import os
 from datetime import datetime
 
 import chess
 import numpy
 from keras.models import Sequential, Model
-from keras.layers import Dense, Input, Conv2D, Flatten, BatchNormalization, Activation, Add
+from keras.layers import Dense, Input, Conv2D, Flatten, BatchNormalization, Activation, Add, Reshape, Cropping1D, \
+    ReLU
 from keras.optimizers import Adam, RMSprop
 from keras.losses import MeanSquaredError
 from keras.saving.save import load_model
 
-from database.util import board_to_obs
+from database.incremental_encoder import IncrementalEncoder
+from database.util import board_to_obs, board_to_obs_batch, bitboards_to_obs
+from instrumentation.spans import span
+from neural_network.data_pipeline import ShardStream
+from neural_network.nnue import NNUEModel
+from neural_network.numpy_inference import export_numpy_model
 
 
 # This class describes the deep neural network used for board prediction
@@ -89,6 +94,28 @@ class BoardEvaluationNetwork:
             loss=MeanSquaredError()
         )
 
+    # Create an efficiently updatable network (NNUE), see nnue.py
+    # It only uses the piece planes, because the attack planes can not be updated move by move
+    # The first layer is the accumulator, clipped relu activations keep the values of the small layers in [0, 1]
+    def create_nnue_network(self, accumulator_size: int = 256, hidden_size: int = 32):
+        input_layer = Input(shape=(14, 8, 8))
+
+        x = Reshape((14, 64))(input_layer)
+        x = Cropping1D((0, 2))(x)
+        x = Flatten()(x)
+        x = Dense(accumulator_size)(x)
+        x = ReLU(max_value=1)(x)
+        x = Dense(hidden_size)(x)
+        x = ReLU(max_value=1)(x)
+        x = Dense(1, activation="sigmoid")(x)
+
+        self.model = Model(inputs=input_layer, outputs=x)
+
+        self.model.compile(
+            optimizer=Adam(1e-3),
+            loss=MeanSquaredError()
+        )
+
     # Trains the given network using given parameters
     def train(self, save_folder: str, x_train, y_train, batch_size=None, epochs=None, steps_per_epoch=None,
               validation_split=0.1,
@@ -106,11 +133,36 @@ class BoardEvaluationNetwork:
         )
         self.save_model(save_folder)
 
+    # Trains the network by streaming the shards of a dataset folder instead of loading them into memory
+    # Memory usage stays the same no matter how big the dataset is, see data_pipeline.py
+    def train_streaming(self, save_folder: str, dataset_folder: str, batch_size=2048, epochs=None,
+                        shuffle_buffer=200_000, validation_split=0.1, callbacks=None):
+        stream = ShardStream(dataset_folder, batch_size=batch_size, shuffle_buffer=shuffle_buffer,
+                             validation_split=validation_split)
+        print(f"Training model with database of size {stream.training_size()} "
+              f"(validation size {stream.validation_size()})")
+        self.model.fit(
+            stream.training_dataset(),
+            validation_data=stream.validation_dataset(),
+            verbose=1,
+            epochs=epochs,
+            callbacks=callbacks
+        )
+        self.save_model(save_folder)
+
     # Saves the model to local storage
     def save_model(self, save_folder: str):
         file_name = "/model_" + datetime.now().strftime("%d_%m_%Y-%H_%M_%S.h5")
         self.model.save(save_folder + file_name)
 
+    # Exports the model for the numpy runtime, see numpy_inference.py
+    def export_numpy_model(self, path: str):
+        export_numpy_model(self.model, path)
+
+    # Exports a network of create_nnue_network for the NNUEModel
+    def export_nnue_model(self, path: str):
+        NNUEModel.from_keras(self.model).save(path)
+
     # Loads a model from local storage
     def load_model(self, model_path: str):
         if model_path.endswith(".h5"):
@@ -128,30 +180,45 @@ class BoardEvaluationNetwork:
     def predict_evaluation(self, board: chess.Board):
         obs = board_to_obs(board)
         obs = numpy.expand_dims(obs, 0)  # Translate shape (None, 8, 8) into shape (14,8,8)
-        evaluation = self.model(obs).numpy()[0][0]
+        with span("network.model"):
+            evaluation = self.model(obs).numpy()[0][0]
         return evaluation
 
+    # Analyses many board positions at once and returns their evaluations
+    # One forward pass for all boards is a lot faster than one pass per board
+    def predict_evaluations(self, boards):
+        if len(boards) == 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+        obs = board_to_obs_batch(boards)
+        with span("network.model"):
+            return self.model(obs).numpy()[:, 0]
+
+    # The SearchEngine follows its positions move by move with an IncrementalEncoder instead of encoding every board
+    def create_accumulator(self, board: chess.Board):
+        return IncrementalEncoder(board)
+
+    # Evaluates the bitboards of IncrementalEncoders
+    def evaluate_accumulators(self, bitboards):
+        obs = bitboards_to_obs(bitboards)
+        with span("network.model"):
+            return self.model(obs).numpy()[:, 0]
+
     # Returns what it thinks is the best move using a simple algorithm that checks all position
+    # All positions after one move are evaluated in a single batch
     def get_move(self, board: chess.Board):
-        evaluations = []
-        moves = []
-        for move in board.legal_moves:
+        moves = list(board.legal_moves)
+        boards = []
+        for move in moves:
             board.push(move)
-            evaluations.append(self.predict_evaluation(board))
-            moves.append(move)
+            boards.append(board.copy(stack=False))
             board.pop()
 
-        max_eval = -math.inf
-        index = 0
-        for i in range(len(evaluations)):
-            if evaluations[i] > max_eval:
-                max_eval = evaluations[i]
-                index = i
-
-        return moves[index]
+        evaluations = self.predict_evaluations(boards)
+        return moves[int(numpy.argmax(evaluations))]
 
     # Deprecated: Even with alpha beta pruning this minimax algorithm showed very slow performance
     # It is therefore not considered as a viable choice for the network
+    # Use neural_network.search.SearchEngine instead, which batches the leaf evaluations
 
     # Scans all possible options from the current position up to a given depth
     # Evaluates every "notable board position" and picks the best next position according to deeper board states
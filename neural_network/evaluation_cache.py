@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+# This file contains a cache for network evaluations
+# Positions are identified by position_key, their polyglot zobrist hash, which is also the key of the transposition
+# table of the search. chess.polyglot.zobrist_hash is too slow to compute for every position of a search, so the
+# search computes it once for the root and updates it move by move with next_position_key
+# The cache is bounded: once it is full, the evaluation that was used the longest time ago is dropped (LRU)
+# One cache can be shared by many searches and games, as long as they all use the same network
+
+# Estimated memory of one entry: the key, the evaluation and the node of the ordered dict
+ENTRY_SIZE = 160
+
+ZOBRIST_KEYS = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+# The castling rights of the polyglot keys, by the square of the rook
+CASTLING_KEYS = [(chess.BB_H1, 768), (chess.BB_A1, 769), (chess.BB_H8, 770), (chess.BB_A8, 771)]
+EN_PASSANT_KEY = 772
+TURN_KEY = 780
+_HASHER = chess.polyglot.ZobristHasher(ZOBRIST_KEYS)
+
+
+# The key of a position in the cache
+def position_key(board: chess.Board):
+    return chess.polyglot.zobrist_hash(board)
+
+
+# The key of the position after a move from the key of the position before it, for a move that is not pushed yet
+# The moved and captured pieces, the castling rights, the en passant file and the side to move are updated.
+# Castling and en passant captures move more than two pieces, None is returned for them and their key is
+# computed with position_key after the move
+def next_position_key(board: chess.Board, move: chess.Move, key: int):
+    if board.is_castling(move) or board.is_en_passant(move):
+        return None
+    color = board.turn
+    piece_type = board.piece_type_at(move.from_square)
+    key ^= _piece_key(piece_type, color, move.from_square) ^ _piece_key(move.promotion or piece_type, color,
+                                                                         move.to_square)
+    captured = board.piece_type_at(move.to_square)
+    if captured is not None:
+        key ^= _piece_key(captured, not color, move.to_square)
+
+    rights = board.clean_castling_rights()
+    new_rights = rights & ~chess.BB_SQUARES[move.from_square] & ~chess.BB_SQUARES[move.to_square]
+    if piece_type == chess.KING:
+        new_rights &= ~(chess.BB_RANK_1 if color == chess.WHITE else chess.BB_RANK_8)
+    key ^= _castling_key(rights) ^ _castling_key(new_rights)
+
+    # The en passant file only counts if a pawn stands next to the pawn that moved two squares
+    key ^= _HASHER.hash_ep_square(board)
+    if piece_type == chess.PAWN and abs(move.to_square - move.from_square) == 16:
+        to_mask = chess.BB_SQUARES[move.to_square]
+        neighbours = ((to_mask & ~chess.BB_FILE_A) >> 1) | ((to_mask & ~chess.BB_FILE_H) << 1)
+        if neighbours & board.pawns & board.occupied_co[not color]:
+            key ^= ZOBRIST_KEYS[EN_PASSANT_KEY + chess.square_file(move.to_square)]
+    return key ^ ZOBRIST_KEYS[TURN_KEY]
+
+
+# Polyglot orders the pieces black pawn, white pawn, black knight, ...
+def _piece_key(piece_type: chess.PieceType, color: chess.Color, square: chess.Square):
+    return ZOBRIST_KEYS[64 * ((piece_type - 1) * 2 + int(color)) + square]
+
+
+def _castling_key(rights: chess.Bitboard):
+    key = 0
+    for mask, index in CASTLING_KEYS:
+        if rights & mask:
+            key ^= ZOBRIST_KEYS[index]
+    return key
+
+
+class EvaluationCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.capacity = max(max_bytes // ENTRY_SIZE, 1)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the cached evaluation or None
+    def get(self, key: int):
+        evaluation = self.entries.get(key)
+        if evaluation is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return evaluation
+
+    def put(self, key: int, evaluation: float):
+        self.entries[key] = evaluation
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def memory_usage(self):
+        return len(self.entries) * ENTRY_SIZE
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.memory_usage(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate()
+        }
@@ -0,0 +1,122 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import chess
+import numpy
+
+# This file contains an inference server that lets many games share one network
+# Searches running in different threads submit their positions to a queue and get a future back
+# A single worker thread collects the waiting requests into one batch, until either the batch is full
+# or the first request waited long enough, and evaluates them with one forward pass
+# This turns many small forward passes into a few big ones
+
+_STOP = object()
+
+
+class InferenceServer:
+    # network can be anything with a predict_evaluations(boards) method, e.g. a BoardEvaluationNetwork
+    # The server has a predict_evaluations method itself, so it can be used wherever a network is expected
+    def __init__(self, network, max_batch_size: int = 1024, max_wait_us: int = 500):
+        self.network = network
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us / 1_000_000
+        self.batches = 0
+        self.positions = 0
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="InferenceServer", daemon=True)
+        self._thread.start()
+
+    # Queues the boards for evaluation
+    # The future returns the evaluations of the boards in the same order as predict_evaluations does
+    # After close, the future fails with a RuntimeError
+    def submit(self, boards) -> Future:
+        future = Future()
+        boards = list(boards)
+        if not boards:
+            future.set_result(numpy.zeros(0, dtype=numpy.float32))
+            return future
+        with self._lock:
+            if self._closed:
+                future.set_exception(RuntimeError("The inference server is closed."))
+            else:
+                self._requests.put((boards, future))
+        return future
+
+    # Blocks until the boards are evaluated
+    def predict_evaluations(self, boards):
+        return self.submit(boards).result()
+
+    def predict_evaluation(self, board: chess.Board):
+        return float(self.predict_evaluations([board])[0])
+
+    # Can be awaited inside of an event loop
+    async def evaluate_async(self, boards):
+        return await asyncio.wrap_future(self.submit(boards))
+
+    def average_batch_size(self):
+        return self.positions / max(self.batches, 1)
+
+    # Evaluates the requests that were submitted before and stops the worker thread
+    # Requests the worker did not answer (e.g. because it died) fail, so no caller waits forever
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(_STOP)
+        self._thread.join()
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not _STOP:
+                request[1].set_exception(RuntimeError("The inference server is closed."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self._requests.get()
+            if request is _STOP:
+                break
+            requests = [request]
+            size = len(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = self._requests.get(timeout=timeout) if timeout > 0 else self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                requests.append(request)
+                size += len(request[0])
+            self._evaluate(requests)
+
+    def _evaluate(self, requests):
+        boards = [board for request in requests for board in request[0]]
+        try:
+            evaluations = numpy.asarray(self.network.predict_evaluations(boards))
+        except Exception as exception:
+            for _, future in requests:
+                future.set_exception(exception)
+            return
+        self.batches += 1
+        self.positions += len(boards)
+        start = 0
+        for request_boards, future in requests:
+            future.set_result(evaluations[start:start + len(request_boards)])
+            start += len(request_boards)
@@ -0,0 +1,132 @@
+import chess
+import numpy
+
+from instrumentation.spans import traced
+
+# This file contains the numpy runtime of the efficiently updatable network (NNUE) of create_nnue_network
+# The network only looks at the 12 piece planes of an observation, which are 768 inputs that are either 0 or 1
+# Its first layer (the accumulator) is the sum of one weight row per piece on the board, plus the bias.
+# A move only changes two to four pieces, so instead of computing the first layer again for every position,
+# the rows of the changed pieces are added to or subtracted from the accumulator of the position before.
+# Only the small layers after the accumulator have to be computed for every evaluation
+
+PIECE_PLANES = 12
+FEATURES = PIECE_PLANES * 64
+
+
+# The input index of a piece, see board_to_bitboards for the order of the planes
+# Observations store the eighth rank first, so the square is mirrored vertically
+def feature_index(color: chess.Color, piece_type: chess.PieceType, square: chess.Square):
+    plane = piece_type - 1 + (0 if color == chess.WHITE else 6)
+    return plane * 64 + (square ^ 56)
+
+
+# The 12 piece bitboards in the order of the piece planes
+def piece_masks(board: chess.Board):
+    return [board.pieces_mask(piece_type, color) for color in (chess.WHITE, chess.BLACK)
+            for piece_type in chess.PIECE_TYPES]
+
+
+# The inputs that are 1 in the given position
+def active_features(board: chess.Board):
+    return [plane * 64 + (square ^ 56) for plane, mask in enumerate(piece_masks(board))
+            for square in chess.scan_forward(mask)]
+
+
+def _clipped_relu(x):
+    return numpy.clip(x, 0, 1, out=x)
+
+
+# The weights of a NNUE network
+# It has the same prediction methods as the BoardEvaluationNetwork, and it can create accumulators,
+# which the SearchEngine uses to update the first layer move by move
+class NNUEModel:
+    def __init__(self, model_path: str = None):
+        self.layers = []
+        if model_path is not None:
+            with numpy.load(model_path, allow_pickle=False) as data:
+                self.layers = [(data[f"kernel_{i}"], data[f"bias_{i}"]) for i in range(len(data.files) // 2)]
+
+    # Reads the dense layers of a keras model built by create_nnue_network
+    @classmethod
+    def from_keras(cls, model):
+        nnue = cls()
+        for layer in model.layers:
+            if layer.__class__.__name__ == "Dense":
+                kernel, bias = layer.get_weights()
+                nnue.layers.append((kernel.astype(numpy.float32), bias.astype(numpy.float32)))
+        if len(nnue.layers) < 2 or nnue.layers[0][0].shape[0] != FEATURES:
+            raise ValueError("The model is no NNUE network.")
+        return nnue
+
+    def save(self, path: str):
+        arrays = {}
+        for i, (kernel, bias) in enumerate(self.layers):
+            arrays[f"kernel_{i}"] = kernel
+            arrays[f"bias_{i}"] = bias
+        numpy.savez(path, **arrays)
+
+    # The accumulator of a position computed from scratch
+    def refresh(self, board: chess.Board):
+        kernel, bias = self.layers[0]
+        return bias + kernel[active_features(board)].sum(axis=0)
+
+    # Evaluates accumulators of shape (N, accumulator size), the result is the evaluation for white in [0, 1]
+    @traced("network.nnue")
+    def evaluate_accumulators(self, accumulators):
+        x = _clipped_relu(numpy.array(accumulators, dtype=numpy.float32, ndmin=2))
+        for kernel, bias in self.layers[1:-1]:
+            x = _clipped_relu(x @ kernel + bias)
+        kernel, bias = self.layers[-1]
+        return 1 / (1 + numpy.exp(-(x @ kernel + bias)[:, 0]))
+
+    def predict_evaluations(self, boards):
+        if len(boards) == 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+        return self.evaluate_accumulators([self.refresh(board) for board in boards])
+
+    def predict_evaluation(self, board: chess.Board):
+        return float(self.predict_evaluations([board])[0])
+
+    def create_accumulator(self, board: chess.Board):
+        return NNUEAccumulator(self, board)
+
+
+# Follows a board through push and pop and keeps the accumulator of the current position up to date
+# The board has to be changed through the accumulator, so that both stay in sync
+class NNUEAccumulator:
+    def __init__(self, model: NNUEModel, board: chess.Board):
+        self.model = model
+        self.kernel = model.layers[0][0]
+        self.stack = [model.refresh(board)]
+
+    @property
+    def value(self):
+        return self.stack[-1]
+
+    def push(self, board: chess.Board, move: chess.Move):
+        before = piece_masks(board)
+        board.push(move)
+        after = piece_masks(board)
+        added = []
+        removed = []
+        for plane, (old_mask, new_mask) in enumerate(zip(before, after)):
+            changed = old_mask ^ new_mask
+            if changed:
+                for square in chess.scan_forward(changed & new_mask):
+                    added.append(plane * 64 + (square ^ 56))
+                for square in chess.scan_forward(changed & old_mask):
+                    removed.append(plane * 64 + (square ^ 56))
+        value = self.stack[-1].copy()
+        for feature in added:
+            value += self.kernel[feature]
+        for feature in removed:
+            value -= self.kernel[feature]
+        self.stack.append(value)
+
+    def pop(self, board: chess.Board):
+        board.pop()
+        self.stack.pop()
+
+    def evaluate(self):
+        return float(self.model.evaluate_accumulators([self.value])[0])
@@ -0,0 +1,309 @@
+import json
+
+import chess
+import numpy
+
+from database.incremental_encoder import IncrementalEncoder
+from database.util import board_to_obs_batch, bitboards_to_obs
+from instrumentation.spans import traced
+
+# This file evaluates trained networks with numpy only
+# A keras model is exported once into an .npz file that contains its weights and the graph of its layers.
+# The runtime does not need tensorflow at all, which makes loading fast and small batches a lot cheaper,
+# because a keras call has a big constant overhead compared to the math of our small networks
+
+# Batch normalization is folded into the convolution in front of it:
+# - if it normalizes the channels, the kernel and the bias of the convolution are scaled (no extra work at all)
+# - otherwise (create_residual_network normalizes the last axis) the scale and shift are applied
+#   to the result of the matrix multiplication of the convolution
+# Convolutions are computed with im2col and one matrix multiplication
+# Internally the results of channels_first convolutions are kept as (N, H, W, C), which is what im2col produces,
+# and they are only transposed back into the keras layout when a layer needs it (e.g. Flatten)
+
+NUMPY_MODEL_EXTENSION = ".npz"
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: numpy.maximum(x, 0, out=x),
+    "sigmoid": lambda x: 1 / (1 + numpy.exp(-x)),
+    "tanh": numpy.tanh
+}
+
+
+# Exports a keras model (as created by BoardEvaluationNetwork) into an npz file
+def export_numpy_model(model, path: str):
+    layers, outputs = _model_layers(model)
+    consumers = {}
+    for layer in layers:
+        for inbound in layer["inputs"]:
+            consumers.setdefault(inbound, []).append(layer["name"])
+
+    operations = []
+    arrays = {}
+    folded = {}
+    by_name = {op["name"]: op for op in operations}
+    for layer in layers:
+        name, class_name, config = layer["name"], layer["class_name"], layer["config"]
+        inputs = [folded.get(inbound, inbound) for inbound in layer["inputs"]]
+        weights = model.get_layer(name).get_weights() if class_name != "InputLayer" else []
+        operation = {"name": name, "inputs": inputs}
+
+        if class_name == "InputLayer":
+            operation["type"] = "input"
+        elif class_name == "Conv2D":
+            _check_conv_config(config)
+            kernel = weights[0]
+            bias = weights[1] if config["use_bias"] else numpy.zeros(kernel.shape[-1], dtype=numpy.float32)
+            operation.update(type="conv", activation=config["activation"], padding=config["padding"],
+                             kernel_size=list(kernel.shape[:2]), data_format=config["data_format"])
+            arrays[f"{name}/kernel"] = kernel
+            arrays[f"{name}/bias"] = bias
+        elif class_name == "BatchNormalization":
+            scale, shift = _batch_norm_scale_shift(config, weights)
+            producer = by_name.get(inputs[0])
+            if producer is not None and producer["type"] == "conv" and producer["activation"] == "linear" \
+                    and "scale" not in producer and consumers.get(inputs[0]) == [name]:
+                _fold_batch_norm(producer, arrays, config, scale, shift, layer["input_shape"])
+                folded[name] = producer["name"]
+                continue
+            operation.update(type="batch_norm", axis=_axes(config["axis"]))
+            arrays[f"{name}/scale"] = scale
+            arrays[f"{name}/shift"] = shift
+        elif class_name == "Dense":
+            operation.update(type="dense", activation=config["activation"])
+            arrays[f"{name}/kernel"] = weights[0]
+            arrays[f"{name}/bias"] = weights[1] if config["use_bias"] \
+                else numpy.zeros(weights[0].shape[-1], dtype=numpy.float32)
+        elif class_name == "Activation":
+            operation.update(type="activation", activation=config["activation"])
+        elif class_name == "Add":
+            operation["type"] = "add"
+        elif class_name == "Flatten":
+            operation["type"] = "flatten"
+        else:
+            raise ValueError(f"The layer {name} of type {class_name} can not be exported.")
+
+        if operation.get("activation", "linear") not in ACTIVATIONS:
+            raise ValueError(f"The activation {operation['activation']} of layer {name} is not supported.")
+        operations.append(operation)
+        by_name[name] = operation
+
+    graph = {"operations": operations, "outputs": [folded.get(output, output) for output in outputs]}
+    arrays = {key: numpy.asarray(value, dtype=numpy.float32) for key, value in arrays.items()}
+    numpy.savez(path, graph=numpy.array(json.dumps(graph)), **arrays)
+
+
+# A model that was exported by export_numpy_model
+class NumpyModel:
+    def __init__(self, path: str):
+        with numpy.load(path, allow_pickle=False) as data:
+            graph = json.loads(str(data["graph"]))
+            self.arrays = {key: data[key] for key in data.files if key != "graph"}
+        self.operations = graph["operations"]
+        self.outputs = graph["outputs"]
+        self._prepare()
+
+    # Same as keras' model.predict, x has the shape of the model input
+    @traced("network.numpy_model")
+    def predict(self, x):
+        x = numpy.asarray(x, dtype=numpy.float32)
+        values = {}
+        for operation in self.operations:
+            inputs = [values[name] for name in operation["inputs"]]
+            values[operation["name"]] = getattr(self, "_" + operation["type"])(operation, inputs, x)
+        outputs = [self._keras_layout(values[name]) for name in self.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    __call__ = predict
+
+    # Brings the kernels into the layout used by im2col once
+    def _prepare(self):
+        for operation in self.operations:
+            if operation["type"] in ("conv", "dense"):
+                name = operation["name"]
+                kernel = self.arrays[f"{name}/kernel"]
+                self.arrays[f"{name}/matrix"] = numpy.ascontiguousarray(kernel.reshape(-1, kernel.shape[-1]),
+                                                                        dtype=numpy.float32)
+
+    def _input(self, operation, inputs, x):
+        return _Tensor(x, transposed=False)
+
+    def _conv(self, operation, inputs, x):
+        name = operation["name"]
+        tensor = inputs[0]
+        # Keras layout (N, C, H, W) for channels_first, im2col needs (N, H, W, C)
+        if operation["data_format"] == "channels_first":
+            data = tensor.value if tensor.transposed else tensor.value.transpose(0, 2, 3, 1)
+        else:
+            data = self._keras_layout(tensor)
+        kernel_height, kernel_width = operation["kernel_size"]
+        if operation["padding"] == "same":
+            pad_height, pad_width = kernel_height // 2, kernel_width // 2
+            data = numpy.pad(data, ((0, 0), (pad_height, pad_height), (pad_width, pad_width), (0, 0)))
+        batch = len(data)
+        height = data.shape[1] - kernel_height + 1
+        width = data.shape[2] - kernel_width + 1
+        # Every row of columns holds the input values around one output position
+        columns = numpy.empty((batch, height, width, kernel_height, kernel_width, data.shape[3]), dtype=numpy.float32)
+        for y in range(kernel_height):
+            for x in range(kernel_width):
+                columns[:, :, :, y, x] = data[:, y:y + height, x:x + width]
+        columns = columns.reshape(batch * height * width, -1)
+
+        result = columns @ self.arrays[f"{name}/matrix"]
+        result = result.reshape(batch, height * width, -1)
+        if f"{name}/scale" in self.arrays:
+            result *= self.arrays[f"{name}/scale"]
+        result += self.arrays[f"{name}/bias"]
+        result = ACTIVATIONS[operation["activation"]](result).reshape(batch, height, width, -1)
+        return _Tensor(result, transposed=operation["data_format"] == "channels_first")
+
+    def _batch_norm(self, operation, inputs, x):
+        name = operation["name"]
+        value = self._keras_layout(inputs[0])
+        shape = [1] * value.ndim
+        for axis in operation["axis"]:
+            shape[axis] = value.shape[axis]
+        value = value * self.arrays[f"{name}/scale"].reshape(shape) + self.arrays[f"{name}/shift"].reshape(shape)
+        return _Tensor(value, transposed=False)
+
+    def _dense(self, operation, inputs, x):
+        name = operation["name"]
+        value = self._keras_layout(inputs[0]) @ self.arrays[f"{name}/matrix"] + self.arrays[f"{name}/bias"]
+        return _Tensor(ACTIVATIONS[operation["activation"]](value), transposed=False)
+
+    def _activation(self, operation, inputs, x):
+        return _Tensor(ACTIVATIONS[operation["activation"]](inputs[0].value.copy()), inputs[0].transposed)
+
+    def _add(self, operation, inputs, x):
+        transposed = all(tensor.transposed for tensor in inputs)
+        values = [tensor.value if transposed else self._keras_layout(tensor) for tensor in inputs]
+        return _Tensor(sum(values[1:], values[0].copy()), transposed)
+
+    def _flatten(self, operation, inputs, x):
+        value = self._keras_layout(inputs[0])
+        return _Tensor(value.reshape(len(value), -1), transposed=False)
+
+    @staticmethod
+    def _keras_layout(tensor):
+        return tensor.value.transpose(0, 3, 1, 2) if tensor.transposed else tensor.value
+
+
+# Evaluates boards with an exported model
+# It has the same prediction methods as the BoardEvaluationNetwork, so it can be used by the SearchEngine
+class NumpyEvaluationNetwork:
+    def __init__(self, model_path: str):
+        self.model = NumpyModel(model_path)
+
+    def predict_evaluation(self, board: chess.Board):
+        return self.predict_evaluations([board])[0]
+
+    def predict_evaluations(self, boards):
+        if len(boards) == 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+        output = self.model.predict(board_to_obs_batch(boards))
+        return output.reshape(len(boards), -1)[:, 0]
+
+    # See BoardEvaluationNetwork.create_accumulator
+    def create_accumulator(self, board: chess.Board):
+        return IncrementalEncoder(board)
+
+    def evaluate_accumulators(self, bitboards):
+        output = self.model.predict(bitboards_to_obs(bitboards))
+        return output.reshape(len(bitboards), -1)[:, 0]
+
+
+# A tensor between two operations
+# Results of channels_first convolutions are stored transposed to (N, H, W, C) instead of the keras layout (N, C, H, W)
+class _Tensor:
+    def __init__(self, value, transposed: bool):
+        self.value = value
+        self.transposed = transposed
+
+
+# Returns the layers of a model in the order they are computed, each with the names of its inputs
+def _model_layers(model):
+    config = model.get_config()
+    layers = []
+    if "input_layers" not in config:
+        # A sequential model, every layer uses the one before it
+        previous = []
+        for layer in model.layers:
+            layers.append(_layer_info(layer, previous))
+            previous = [layer.name]
+        return layers, previous
+
+    for layer_config in config["layers"]:
+        inbound_nodes = layer_config["inbound_nodes"]
+        if len(inbound_nodes) > 1:
+            raise ValueError(f"The layer {layer_config['name']} is used more than once, which is not supported.")
+        inputs = [inbound[0] for inbound in inbound_nodes[0]] if inbound_nodes else []
+        layers.append(_layer_info(model.get_layer(layer_config["name"]), inputs))
+    return layers, [output[0] for output in config["output_layers"]]
+
+
+def _layer_info(layer, inputs):
+    input_shape = layer.input_shape if layer.__class__.__name__ != "InputLayer" else None
+    return {
+        "name": layer.name,
+        "class_name": layer.__class__.__name__,
+        "config": layer.get_config(),
+        "inputs": inputs,
+        "input_shape": input_shape
+    }
+
+
+def _check_conv_config(config: dict):
+    if tuple(config["strides"]) != (1, 1) or tuple(config["dilation_rate"]) != (1, 1) or config.get("groups", 1) != 1:
+        raise ValueError(f"The convolution {config['name']} has to use strides, dilation and groups of 1.")
+    if config["padding"] not in ("same", "valid"):
+        raise ValueError(f"The convolution {config['name']} uses the unsupported padding {config['padding']}.")
+    if config["padding"] == "same" and any(size % 2 == 0 for size in config["kernel_size"]):
+        raise ValueError(f"The convolution {config['name']} needs an odd kernel size for 'same' padding.")
+
+
+def _axes(axis):
+    return list(axis) if isinstance(axis, (list, tuple)) else [axis]
+
+
+# Inference of batch normalization is x * scale + shift
+def _batch_norm_scale_shift(config: dict, weights):
+    weights = list(weights)
+    gamma = weights.pop(0) if config["scale"] else None
+    beta = weights.pop(0) if config["center"] else None
+    mean, variance = weights
+    scale = 1 / numpy.sqrt(variance + config["epsilon"])
+    if gamma is not None:
+        scale = scale * gamma
+    shift = -mean * scale
+    if beta is not None:
+        shift = shift + beta
+    return scale, shift
+
+
+# Folds a batch normalization into the convolution in front of it
+def _fold_batch_norm(conv: dict, arrays: dict, config: dict, scale, shift, input_shape):
+    name = conv["name"]
+    kernel, bias = arrays[f"{name}/kernel"], arrays[f"{name}/bias"]
+    axes = [axis % len(input_shape) for axis in _axes(config["axis"])]
+    channel_axis = 1 if conv["data_format"] == "channels_first" else 3
+
+    if axes == [channel_axis]:
+        arrays[f"{name}/kernel"] = kernel * scale
+        arrays[f"{name}/bias"] = bias * scale + shift
+        return
+
+    # The scale and shift depend on the position, so they are applied after the matrix multiplication
+    # The arrays are brought into the layout of the result of the convolution: (H * W, C)
+    shape = [1] * len(input_shape)
+    for axis in axes:
+        shape[axis] = input_shape[axis]
+    full_shape = (1,) + tuple(input_shape[1:])
+    scale = numpy.broadcast_to(scale.reshape(shape), full_shape)[0]
+    shift = numpy.broadcast_to(shift.reshape(shape), full_shape)[0]
+    if conv["data_format"] == "channels_first":
+        scale, shift = scale.transpose(1, 2, 0), shift.transpose(1, 2, 0)
+    filters = kernel.shape[-1]
+    arrays[f"{name}/scale"] = scale.reshape(-1, filters)
+    arrays[f"{name}/bias"] = (bias * scale + shift).reshape(-1, filters)
+    conv["scale"] = True
@@ -0,0 +1,363 @@
+import dataclasses
+import math
+
+import chess
+import chess.engine
+
+from instrumentation.spans import traced, span, count
+from neural_network.evaluation_cache import EvaluationCache, position_key, next_position_key
+from neural_network.time_manager import TimeManager
+
+# This file contains the search used by the CustomEngine
+# It is an alpha beta search with iterative deepening, a transposition table and move ordering
+# Positions at the end of the search are not evaluated one by one:
+# all positions after the last move are collected and evaluated by the network in one batch
+# How long it searches is decided by a TimeManager, so it can be limited by time, nodes, depth or a chess clock
+
+# Scores are seen from the side to move and lie in between -0.5 and 0.5 for network evaluations
+# Mates are scored far outside of that range, shorter mates are preferred
+# Mate scores count the plies from the root, the transposition table stores them counted from the position itself
+# Draws by repetition or the fifty move rule depend on the moves that led to a position, not only on the position.
+# Scores that depend on such a draw are not stored in the transposition table, another path to the position
+# could have a different score
+MATE_SCORE = 10.0
+MATE_PLY_PENALTY = 0.001
+
+# Values used to order captures by "most valuable victim, least valuable attacker"
+ORDER_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 100
+}
+
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+
+# Raised inside the search when the time manager stops it
+class SearchAborted(Exception):
+    pass
+
+
+# The result of a search
+@dataclasses.dataclass
+class SearchResult:
+    move: chess.Move
+    score: float
+    depth: int
+    nodes: int
+    evaluations: int
+    seconds: float
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / max(self.seconds, 1e-9)
+
+
+# A transposition table with a fixed amount of slots
+# Every position is stored in the slot given by its zobrist hash
+# A slot is replaced if it belongs to an older search or if the new entry was searched at least as deep
+class TranspositionTable:
+    def __init__(self, size: int = 1_000_000):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+
+    # Makes entries of previous searches replaceable
+    def new_search(self):
+        self.generation += 1
+
+    def probe(self, key: int):
+        entry = self.slots[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key: int, depth: int, score: float, flag: int, move: chess.Move):
+        index = key % self.size
+        entry = self.slots[index]
+        if entry is None or entry[0] == key or entry[5] != self.generation or depth >= entry[1]:
+            self.slots[index] = (key, depth, score, flag, move, self.generation)
+
+    def clear(self):
+        self.slots = [None] * self.size
+
+
+# The search engine
+# network can be anything with a predict_evaluations(boards) method that returns evaluations for white in [0, 1]
+# If it can create accumulators (an NNUEModel or an IncrementalEncoder for observation networks),
+# they are updated move by move instead of encoding every board
+# With an EvaluationCache, positions that were evaluated before (e.g. in the search of the last move) are not
+# evaluated by the network again
+class SearchEngine:
+    def __init__(self, network, max_depth: int = 3, tt_size: int = 1_000_000, verbose: bool = False,
+                 cache: EvaluationCache = None):
+        self.network = network
+        self.cache = cache
+        self.max_depth = max_depth
+        self.verbose = verbose
+        self.table = TranspositionTable(tt_size)
+        self.killers = []
+        self.history = [[0] * 4096, [0] * 4096]
+        self.nodes = 0
+        self.evaluations = 0
+        self.time_manager = TimeManager()
+        self._abortable = False
+        self._stop_requested = False
+        self._root_best = None
+        self._path_draws = 0
+        self.accumulator = None
+        self.keys = []
+
+    # Searches the given position with iterative deepening and returns the best move found
+    # Without a limit the search goes up to max_depth, otherwise the limit decides when to stop
+    # If the limit is reached during an iteration, the best move found so far is returned
+    # The board is returned in the same state it was given in
+    # on_iteration is called with the SearchResult of every finished iteration, e.g. to report the progress
+    @traced("search")
+    def search(self, board: chess.Board, limit: chess.engine.Limit = None, on_iteration=None):
+        self._stop_requested = False
+        self.time_manager = TimeManager(limit, board.turn, self.max_depth)
+        self.accumulator = self.network.create_accumulator(board) \
+            if hasattr(self.network, "create_accumulator") else None
+        self.keys = [position_key(board)]
+        self.table.new_search()
+        self.killers = [[None, None] for _ in range(self.time_manager.max_depth + 1)]
+        self.history = [[value // 8 for value in history] for history in self.history]
+        self.nodes = 0
+        self.evaluations = 0
+
+        result = None
+        depth = 1
+        stack_size = len(board.move_stack)
+        history = self._history_keys(board)
+        # The first iteration is always finished, so there always is a move to play
+        while result is None or self.time_manager.can_start_iteration(depth):
+            self._abortable = result is not None
+            self._root_best = None
+            try:
+                score, move = self._negamax(board, depth, -math.inf, math.inf, 0, set(history))
+            except SearchAborted:
+                while len(board.move_stack) > stack_size:
+                    board.pop()
+                # Every root move that was searched completely was compared against the best move of the last iteration
+                if self._root_best is not None:
+                    result.score, result.move = self._root_best
+                result.nodes, result.evaluations = self.nodes, self.evaluations
+                result.seconds = self.time_manager.elapsed()
+                break
+            result = SearchResult(move, score, depth, self.nodes, self.evaluations, self.time_manager.elapsed())
+            if on_iteration is not None:
+                on_iteration(result)
+            if self.verbose:
+                cache_info = f" | Cache hits: {self.cache.hit_rate():.1%}" if self.cache is not None else ""
+                print(f"Depth: {depth} | Move: {move} | Score: {score:.4f} | Nodes: {result.nodes} | "
+                      f"{result.nodes_per_second:.0f} nodes/sec{cache_info}")
+            if move is None or abs(score) >= MATE_SCORE - MATE_PLY_PENALTY * self.time_manager.max_depth \
+                    or self._stop_requested:
+                break
+            depth += 1
+        count("search.nodes", self.nodes)
+        count("search.evaluations", self.evaluations)
+        return result
+
+    # Stops a running search from another thread, the search returns the best move found so far
+    # Like a reached time limit, the first iteration is always finished
+    def stop(self):
+        self._stop_requested = True
+
+    # The keys of the positions of the game before the root that can still be repeated,
+    # which are the ones since the last capture or pawn move
+    @staticmethod
+    def _history_keys(board: chess.Board):
+        keys = set()
+        board = board.copy()
+        for _ in range(min(board.halfmove_clock, len(board.move_stack))):
+            board.pop()
+            keys.add(position_key(board))
+        return keys
+
+    # Returns the score of the position and the best move
+    # path contains the positions of the game and from the root to this position to detect repetitions
+    def _negamax(self, board: chess.Board, depth: int, alpha: float, beta: float, ply: int, path: set):
+        if self._abortable and (self._stop_requested or self.time_manager.should_stop(self.nodes)):
+            raise SearchAborted
+        self.nodes += 1
+        moves = list(board.legal_moves)
+        if not moves:
+            return (-MATE_SCORE + ply * MATE_PLY_PENALTY if board.is_check() else 0.0), None
+        if ply > 0 and board.is_insufficient_material():
+            return 0.0, None
+
+        key = self.keys[-1]
+        if ply > 0 and (key in path or board.halfmove_clock >= 100):
+            self._path_draws += 1
+            return 0.0, None
+        path_draws = self._path_draws
+        entry = self.table.probe(key)
+        tt_move = None
+        if entry is not None:
+            tt_move = entry[4]
+            if ply > 0 and entry[1] >= depth:
+                flag, score = entry[3], _score_from_table(entry[2], ply)
+                if flag == EXACT or (flag == LOWER_BOUND and score >= beta) or (flag == UPPER_BOUND and score <= alpha):
+                    return score, tt_move
+
+        if depth == 1:
+            score, best_move = self._evaluate_children(board, moves, ply, tt_move, path)
+            if self._path_draws == path_draws:
+                self.table.store(key, 1, _score_to_table(score, ply), EXACT, best_move)
+            return score, best_move
+
+        original_alpha = alpha
+        best_score = -math.inf
+        best_move = None
+        # The root may repeat a position of the game, which then has to stay in the path
+        added = key not in path
+        path.add(key)
+        for move in self._order_moves(board, moves, tt_move, ply):
+            self._push(board, move)
+            score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1, path)[0]
+            self._pop(board)
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if ply == 0:
+                    self._root_best = (score, move)
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                if not board.is_capture(move):
+                    self._update_killers(move, ply)
+                    self.history[board.turn][move.from_square * 64 + move.to_square] += depth * depth
+                break
+        if added:
+            path.discard(key)
+
+        if self._path_draws == path_draws:
+            if best_score <= original_alpha:
+                flag = UPPER_BOUND
+            elif best_score >= beta:
+                flag = LOWER_BOUND
+            else:
+                flag = EXACT
+            self.table.store(key, depth, _score_to_table(best_score, ply), flag, best_move)
+        return best_score, best_move
+
+    # Evaluates all positions after one move with a single forward pass of the network
+    # Mates are detected for checking moves, stalemates are left to the network
+    # Only moves that are no capture and no pawn move can repeat a position of the path
+    def _evaluate_children(self, board: chess.Board, moves, ply: int, tt_move: chess.Move, path: set):
+        color = board.turn
+        scores = {}
+        positions = []
+        keys = []
+        evaluated_moves = []
+        for move in moves:
+            gives_check = board.gives_check(move)
+            reversible = not board.is_zeroing(move)
+            self._push(board, move)
+            if gives_check and board.is_checkmate():
+                scores[move] = MATE_SCORE - (ply + 1) * MATE_PLY_PENALTY
+            elif board.is_insufficient_material():
+                scores[move] = 0.0
+            elif reversible and (board.halfmove_clock >= 100 or self.keys[-1] in path):
+                scores[move] = 0.0
+                self._path_draws += 1
+            else:
+                key = self.keys[-1] if self.cache is not None else None
+                evaluation = self.cache.get(key) if key is not None else None
+                if evaluation is not None:
+                    scores[move] = _score(evaluation, color)
+                else:
+                    positions.append(board.copy(stack=False) if self.accumulator is None else self.accumulator.value)
+                    keys.append(key)
+                    evaluated_moves.append(move)
+            self._pop(board)
+
+        self.nodes += len(moves)
+        self.evaluations += len(positions)
+        if positions:
+            with span("search.evaluate"):
+                if self.accumulator is None:
+                    evaluations = self.network.predict_evaluations(positions)
+                else:
+                    evaluations = self.network.evaluate_accumulators(positions)
+            for move, key, evaluation in zip(evaluated_moves, keys, evaluations):
+                evaluation = float(evaluation)
+                if key is not None:
+                    self.cache.put(key, evaluation)
+                scores[move] = _score(evaluation, color)
+
+        # Prefer the move of the transposition table on equal scores to keep the choice stable
+        best_move = max(moves, key=lambda move: (scores[move], move == tt_move))
+        return scores[best_move], best_move
+
+    # The key of every position from the root to the current one is kept on a stack and updated move by move
+    def _push(self, board: chess.Board, move: chess.Move):
+        key = next_position_key(board, move, self.keys[-1])
+        if self.accumulator is None:
+            board.push(move)
+        else:
+            self.accumulator.push(board, move)
+        self.keys.append(key if key is not None else position_key(board))
+
+    def _pop(self, board: chess.Board):
+        if self.accumulator is None:
+            board.pop()
+        else:
+            self.accumulator.pop(board)
+        self.keys.pop()
+
+    # Orders moves so that the most promising moves are searched first, which makes alpha beta cut off earlier:
+    # the move of the transposition table, captures (most valuable victim, least valuable attacker), promotions,
+    # killer moves and finally quiet moves by their history score
+    def _order_moves(self, board: chess.Board, moves, tt_move: chess.Move, ply: int):
+        killers = self.killers[ply] if ply < len(self.killers) else [None, None]
+        history = self.history[board.turn]
+
+        def order(move):
+            if move == tt_move:
+                return 1_000_000
+            if board.is_capture(move):
+                victim = board.piece_type_at(move.to_square) or chess.PAWN  # En passant
+                return 100_000 + 10 * ORDER_VALUES[victim] - ORDER_VALUES[board.piece_type_at(move.from_square)]
+            if move.promotion:
+                return 90_000 + move.promotion
+            if move in killers:
+                return 80_000
+            return history[move.from_square * 64 + move.to_square]
+
+        return sorted(moves, key=order, reverse=True)
+
+    # Killer moves are quiet moves that caused a cut off at the same ply before
+    def _update_killers(self, move: chess.Move, ply: int):
+        if ply < len(self.killers) and self.killers[ply][0] != move:
+            self.killers[ply][1] = self.killers[ply][0]
+            self.killers[ply][0] = move
+
+
+# Turns an evaluation of the network (for white in [0, 1]) into a score for the given color
+def _score(evaluation: float, color: chess.Color):
+    return evaluation - 0.5 if color == chess.WHITE else 0.5 - evaluation
+
+
+# Mate scores of the search count the plies from the root, in the transposition table they count from the position,
+# so a mate found at one ply is reported with the right distance when the position is reached at another ply
+def _score_to_table(score: float, ply: int):
+    if score >= MATE_SCORE / 2:
+        return score + ply * MATE_PLY_PENALTY
+    if score <= -MATE_SCORE / 2:
+        return score - ply * MATE_PLY_PENALTY
+    return score
+
+
+def _score_from_table(score: float, ply: int):
+    if score >= MATE_SCORE / 2:
+        return score - ply * MATE_PLY_PENALTY
+    if score <= -MATE_SCORE / 2:
+        return score + ply * MATE_PLY_PENALTY
+    return score
@@ -0,0 +1,72 @@
+import time
+
+import chess
+import chess.engine
+
+# This file decides how long the search may think about a move
+# A limit can be given as a fixed time per move, a node count, a depth or a chess clock with increment
+# There are two boundaries:
+# - the soft limit: no new iteration of the iterative deepening is started once it is reached
+# - the hard limit: the running iteration is aborted and the best move found so far is played
+
+# Used when a limit has no depth, e.g. when only the time is limited
+MAX_SEARCH_DEPTH = 64
+
+# The time that is kept back for everything around the search, e.g. sending the move
+MOVE_OVERHEAD = 0.05
+
+# The number of moves the remaining clock time is spread over if the limit does not tell
+DEFAULT_MOVES_TO_GO = 30
+
+# A move may use a few times its share of the clock, but never more than half of the remaining clock
+HARD_LIMIT_FACTOR = 4
+MAX_CLOCK_USAGE = 0.5
+INCREMENT_USAGE = 0.75
+
+
+class TimeManager:
+    def __init__(self, limit: chess.engine.Limit = None, color: chess.Color = chess.WHITE, default_depth: int = 3,
+                 move_overhead: float = MOVE_OVERHEAD):
+        self.start = time.time()
+        self.max_nodes = None
+        self.soft_limit = None
+        self.hard_limit = None
+
+        # Without any limit the search runs up to its default depth like before
+        if limit is None:
+            self.max_depth = default_depth
+            return
+
+        self.max_nodes = limit.nodes
+        limited = limit.time is not None or limit.nodes is not None
+        if limit.time is not None:
+            self.hard_limit = self.soft_limit = max(limit.time - move_overhead, 0)
+
+        clock = limit.white_clock if color == chess.WHITE else limit.black_clock
+        if clock is not None:
+            limited = True
+            increment = (limit.white_inc if color == chess.WHITE else limit.black_inc) or 0
+            moves_to_go = limit.remaining_moves or DEFAULT_MOVES_TO_GO
+            soft_limit = clock / moves_to_go + increment * INCREMENT_USAGE
+            hard_limit = max(min(soft_limit * HARD_LIMIT_FACTOR, clock * MAX_CLOCK_USAGE) - move_overhead, 0)
+            self.hard_limit = hard_limit if self.hard_limit is None else min(self.hard_limit, hard_limit)
+            self.soft_limit = min(soft_limit, self.hard_limit) if self.soft_limit is None \
+                else min(self.soft_limit, soft_limit, self.hard_limit)
+
+        if limit.depth is not None:
+            self.max_depth = limit.depth
+        else:
+            self.max_depth = MAX_SEARCH_DEPTH if limited else default_depth
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    # Whether the iterative deepening should search the given depth
+    def can_start_iteration(self, depth: int):
+        return depth <= self.max_depth and (self.soft_limit is None or self.elapsed() < self.soft_limit)
+
+    # Whether the running iteration has to be aborted
+    def should_stop(self, nodes: int):
+        if self.max_nodes is not None and nodes >= self.max_nodes:
+            return True
+        return self.hard_limit is not None and self.elapsed() >= self.hard_limit
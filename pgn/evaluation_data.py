@@ -3,11 +3,13 @@ import math
 import pickle
 from typing import List
 import datetime
+import time
 
 import chess
 import numpy
 
 from database.util import pgn_to_games, board_to_obs
+from instrumentation.metrics import MetricsExporter
 from .fen_generator import get_random_fen_from_games, get_random_fen
 from stockfish_api import StockFishEngine
 
@@ -40,25 +42,33 @@ def pgn_to_convolutional_training_data(pgn_file_path, dataset_size: int = math.i
         engine_threads=2,
         engine_hash=1024
     )
-    try:
-        while True:
-            fen = get_random_fen_from_games(games)
-            print("\r", end="\r")
-            print(f"Dataset: {len(x_train)} | Fen: {fen}", end="")
-            if fen is not None:
-                x, y = fen_to_convolutional_training_data(fen, stockfish_engine)
-                x_train.append(x)
-                y_train.append(y)
-    except KeyboardInterrupt:
-        # Save Data
-        x_train = numpy.array(x_train)
-        y_train = numpy.array(y_train)
-        data = EvaluationConvolutionalTrainingData(x_train=x_train, y_train=y_train)
-        with open(f"evaluation_convolutional_{datetime.date.today()}.pickle", "wb") as file:
-            pickle.dump(data, file)
-            file.close()
-
-        return x_train, y_train
+    with MetricsExporter(f"evaluation_convolutional_{datetime.date.today()}",
+                         total=dataset_size if dataset_size != math.inf else None,
+                         progress_counter="positions_labeled") as metrics:
+        try:
+            while True:
+                fen = get_random_fen_from_games(games)
+                print("\r", end="\r")
+                print(f"Dataset: {len(x_train)} | Fen: {fen}", end="")
+                if fen is not None:
+                    start = time.perf_counter()
+                    x, y = fen_to_convolutional_training_data(fen, stockfish_engine)
+                    metrics.add("engine_busy_seconds", time.perf_counter() - start)
+                    metrics.add("positions_labeled")
+                    metrics.set("engine_pool_utilization",
+                                metrics.counters["engine_busy_seconds"] / max(time.time() - metrics.start, 1e-9))
+                    x_train.append(x)
+                    y_train.append(y)
+        except KeyboardInterrupt:
+            # Save Data
+            x_train = numpy.array(x_train)
+            y_train = numpy.array(y_train)
+            data = EvaluationConvolutionalTrainingData(x_train=x_train, y_train=y_train)
+            with open(f"evaluation_convolutional_{datetime.date.today()}.pickle", "wb") as file:
+                pickle.dump(data, file)
+                file.close()
+
+            return x_train, y_train
 
 
 def random_training_data(dataset_size: int = math.inf):
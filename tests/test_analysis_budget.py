@@ -0,0 +1,46 @@
+import chess
+import chess.engine
+
+from database.analysis_budget import AnalysisBudget
+from database.engine_pool import EnginePool
+from database.fake_engine import FAKE_ENGINE_COMMAND
+
+
+def _info(score, nodes: int, depth: int = 10):
+    return {"score": chess.engine.PovScore(score, chess.WHITE), "nodes": nodes, "depth": depth}
+
+
+def test_only_labels_are_charged():
+    budget = AnalysisBudget(shard_nodes=1_000_000, shard_size=10)
+    budget.spend([_info(chess.engine.Cp(20), 50_000), _info(chess.engine.Mate(3), 30_000), {"nodes": 10_000}, {}])
+    assert (budget.positions, budget.nodes) == (1, 50_000)
+    assert (budget.failures, budget.failed_nodes) == (3, 40_000)
+    stats = budget.stats()
+    assert stats["positions"] == 1 and stats["nodes_per_position"] == 50_000 and stats["average_depth"] == 10
+    assert stats["failures"] == 3
+    # The failures leave the nodes per remaining position unchanged
+    assert budget.limit().nodes == int(budget.max_share * 950_000 / 9)
+
+
+def test_shard_starts_after_its_labels():
+    budget = AnalysisBudget(shard_nodes=1_000_000, shard_size=2)
+    budget.spend([_info(chess.engine.Cp(0), 100), {}])
+    assert budget.positions == 1
+    budget.spend([_info(chess.engine.Cp(0), 100)])
+    assert (budget.positions, budget.nodes, budget.total_positions) == (0, 0, 2)
+
+
+def test_pool_books_crashes_and_mates_as_failures():
+    pool = EnginePool(engine_path=FAKE_ENGINE_COMMAND + ["--crash-after", "1"], size=1)
+    budget = AnalysisBudget(shard_nodes=1_000_000, shard_size=10, min_depth=1, max_depth=2)
+    try:
+        assert pool.evaluate(chess.Board(), budget.limit, spend=budget.spend)["score"].white() == chess.engine.Cp(0)
+        # The engine crashes on its second analysis and is restarted
+        assert pool.evaluate(chess.Board(), budget.limit, spend=budget.spend)["score"].white() == chess.engine.Cp(0)
+        # The restarted engine crashes on its second analysis again, the mate gives no label either
+        mated = chess.Board("R5k1/5ppp/8/8/8/8/8/6K1 b - - 0 1")
+        pool.evaluate(mated, budget.limit, spend=budget.spend)
+    finally:
+        pool.close()
+    assert budget.total_positions == 2
+    assert budget.failures == 3
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from chess_api import chess_player
+from chess_api.chess_player import load_network, numpy_cache_path
+from neural_network.numpy_inference import NumpyEvaluationNetwork
+
+
+def test_cache_path_is_in_the_cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(chess_player, "MODEL_CACHE_FOLDER", str(tmp_path / "cache"))
+    first = numpy_cache_path(str(tmp_path / "a" / "model.h5"))
+    second = numpy_cache_path(str(tmp_path / "b" / "model.h5"))
+    assert os.path.dirname(first) == str(tmp_path / "cache")
+    assert os.path.basename(first).startswith("model.h5-") and first.endswith(chess_player.NUMPY_CACHE_EXTENSION)
+    assert first != second
+    assert numpy_cache_path(str(tmp_path / "a" / "model.h5")) == first
+
+
+def test_converted_model_is_loaded_from_the_cache_folder(tmp_path, monkeypatch):
+    keras = pytest.importorskip("keras")
+    from neural_network.numpy_inference import export_numpy_model
+
+    monkeypatch.setattr(chess_player, "MODEL_CACHE_FOLDER", str(tmp_path / "cache"))
+    model_folder = tmp_path / "models"
+    model_folder.mkdir()
+    model_path = str(model_folder / "model.h5")
+    with open(model_path, "wb") as file:
+        file.write(b"keras model")
+    input_layer = keras.layers.Input(shape=(14, 8, 8))
+    output = keras.layers.Dense(1, activation="sigmoid")(keras.layers.Flatten()(input_layer))
+    os.makedirs(tmp_path / "cache")
+    export_numpy_model(keras.Model(inputs=input_layer, outputs=output), numpy_cache_path(model_path))
+
+    assert isinstance(load_network(model_path), NumpyEvaluationNetwork)
+    assert os.listdir(model_folder) == ["model.h5"]
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import chess
+import chess.engine
+
+from database import engine_pool
+from database.engine_pool import EnginePool, configure_engine_pool, get_engine_pool
+from database.fake_engine import FAKE_ENGINE_COMMAND
+
+
+def test_pool_can_be_used_after_close():
+    pool = EnginePool(engine_path=FAKE_ENGINE_COMMAND, size=2)
+    limit = chess.engine.Limit(depth=1)
+    try:
+        assert pool.evaluate(chess.Board(), limit)["score"].white() == chess.engine.Cp(0)
+        pool.close()
+        infos = asyncio.run(pool.analyse_games([[chess.Board()], [chess.Board()]], limit))
+        assert len(infos) == 2
+    finally:
+        pool.close()
+
+
+def test_pool_restarts_crashed_engine():
+    pool = EnginePool(engine_path=FAKE_ENGINE_COMMAND, size=1)
+    limit = chess.engine.Limit(depth=1)
+    try:
+        engine = pool._acquire()
+        os.kill(engine.protocol.transport.get_pid(), signal.SIGKILL)
+        while not engine.protocol.returncode.done():
+            time.sleep(0.01)
+        pool._engines.put(engine)
+        board = chess.Board("4k3/8/8/8/8/8/8/Q3K3 w - - 0 1")
+        assert pool.evaluate(board, limit)["score"].white() == chess.engine.Cp(900)
+    finally:
+        pool.close()
+
+
+def test_configure_engine_pool_replaces_shared_pool(monkeypatch):
+    monkeypatch.setattr(engine_pool, "_default_pool", None)
+    first = configure_engine_pool(engine_path=FAKE_ENGINE_COMMAND, size=1)
+    try:
+        assert get_engine_pool() is first
+        second = configure_engine_pool(engine_path=FAKE_ENGINE_COMMAND, size=1)
+        assert get_engine_pool() is second
+        assert first.evaluate(chess.Board(), chess.engine.Limit(depth=1)) is not None
+    finally:
+        get_engine_pool().close()
+        first.close()
+
+
+def test_process_with_shared_pool_exits():
+    script = ("import chess, chess.engine\n"
+              "from database.engine_pool import configure_engine_pool\n"
+              "from database.fake_engine import FAKE_ENGINE_COMMAND\n"
+              "pool = configure_engine_pool(engine_path=FAKE_ENGINE_COMMAND, size=1)\n"
+              "pool.evaluate(chess.Board(), chess.engine.Limit(depth=1))\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], cwd=root, timeout=30, check=True)
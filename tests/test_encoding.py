@@ -0,0 +1,99 @@
+import random
+
+import chess
+import numpy
+import pytest
+
+from database.database_random import random_board
+from database.incremental_encoder import IncrementalEncoder
+from database.util import board_to_obs, board_to_obs_batch, square_to_index
+
+
+# The encoder board_to_obs replaced, it walks over the pieces and legal moves one by one
+def reference_board_to_obs(board):
+    board3d = numpy.zeros((14, 8, 8), dtype=numpy.int8)
+
+    for piece in chess.PIECE_TYPES:
+        for square in board.pieces(piece, chess.WHITE):
+            idx = numpy.unravel_index(square, (8, 8))
+            board3d[piece - 1][7 - idx[0]][idx[1]] = 1
+        for square in board.pieces(piece, chess.BLACK):
+            idx = numpy.unravel_index(square, (8, 8))
+            board3d[piece + 5][7 - idx[0]][idx[1]] = 1
+    aux = board.turn
+    board.turn = chess.WHITE
+    for move in board.legal_moves:
+        i, j = square_to_index(move.to_square)
+        board3d[12][i][j] = 1
+    board.turn = chess.BLACK
+    for move in board.legal_moves:
+        i, j = square_to_index(move.to_square)
+        board3d[13][i][j] = 1
+    board.turn = aux
+
+    return board3d
+
+
+BOARDS = [random_board(rng=random.Random(seed)) for seed in range(200)] + [
+    chess.Board(),
+    # Castling, en passant and promotions
+    chess.Board("r3k2r/pppq1ppp/8/3pP3/8/8/PPPQ1PPP/R3K2R w KQkq d6 0 1"),
+    chess.Board("8/1P4k1/8/8/8/8/6p1/K7 b - - 0 1"),
+    # Pinned pieces and checks
+    chess.Board("4k3/8/8/8/4r3/8/4B3/4K3 w - - 0 1"),
+    chess.Board("4k3/8/8/8/1b6/8/3P4/4K3 w - - 0 1"),
+    # Positions without exactly one king per side
+    chess.Board("8/8/8/4k3/8/8/8/8 w - - 0 1"),
+    chess.Board("8/8/8/4k3/8/8/3Q4/K6K w - - 0 1"),
+]
+
+
+@pytest.mark.parametrize("board", BOARDS, ids=lambda board: board.fen())
+def test_board_to_obs_matches_reference(board):
+    fen = board.fen()
+    numpy.testing.assert_array_equal(board_to_obs(board), reference_board_to_obs(board))
+    assert board.fen() == fen
+
+
+def test_board_to_obs_batch_matches_single_boards():
+    numpy.testing.assert_array_equal(board_to_obs_batch(BOARDS), numpy.stack([board_to_obs(b) for b in BOARDS]))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_incremental_encoder_matches_board_to_obs(seed):
+    rng = random.Random(seed)
+    board = chess.Board()
+    encoder = IncrementalEncoder(board)
+    expected = [board_to_obs(board)]
+    while not board.is_game_over() and len(expected) < 300:
+        encoder.push(board, rng.choice(list(board.legal_moves)))
+        expected.append(board_to_obs(board))
+        numpy.testing.assert_array_equal(encoder.obs(), expected[-1])
+        # Sometimes go back and forth, like a search does
+        if rng.random() < 0.2:
+            encoder.pop(board)
+            expected.pop()
+            numpy.testing.assert_array_equal(encoder.obs(), expected[-1])
+    while board.move_stack:
+        encoder.pop(board)
+        expected.pop()
+        numpy.testing.assert_array_equal(encoder.obs(), expected[-1])
+    assert board == chess.Board()
+
+
+# Castling, en passant and promotions with and without capture
+@pytest.mark.parametrize("fen, move", [
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", "e1g1"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1", "e8c8"),
+    ("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1", "e5d6"),
+    ("1n2k3/P7/8/8/8/8/8/4K3 w - - 0 1", "a7a8q"),
+    ("1n2k3/P7/8/8/8/8/8/4K3 w - - 0 1", "a7b8n"),
+])
+def test_incremental_encoder_special_moves(fen, move):
+    board = chess.Board(fen)
+    encoder = IncrementalEncoder(board)
+    before = board_to_obs(board)
+    encoder.push(board, chess.Move.from_uci(move))
+    numpy.testing.assert_array_equal(encoder.obs(), board_to_obs(board))
+    encoder.pop(board)
+    numpy.testing.assert_array_equal(encoder.obs(), before)
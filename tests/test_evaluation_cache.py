@@ -0,0 +1,58 @@
+import random
+
+import chess
+import chess.polyglot
+import pytest
+
+from neural_network.evaluation_cache import EvaluationCache, position_key, next_position_key
+
+# Castling in both directions, en passant with and without a pawn next to the moved pawn and promotions
+SPECIAL_POSITIONS = [
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "4k3/1P6/8/8/3p4/8/2P1P3/4K3 w - - 0 1",
+    "r3k3/1P6/8/8/8/8/8/4K2R w Kq - 0 1"
+]
+
+
+def _random_games(count: int, plies: int, seed: int):
+    rng = random.Random(seed)
+    for number in range(count):
+        board = chess.Board(SPECIAL_POSITIONS[number % len(SPECIAL_POSITIONS)]) if number % 2 else chess.Board()
+        yield board, [rng.random() for _ in range(plies)]
+
+
+def test_next_position_key_matches_zobrist_hash():
+    for board, choices in _random_games(40, 120, seed=0):
+        key = position_key(board)
+        for choice in choices:
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = moves[int(choice * len(moves))]
+            next_key = next_position_key(board, move, key)
+            board.push(move)
+            key = next_key if next_key is not None else position_key(board)
+            assert key == chess.polyglot.zobrist_hash(board), board.fen()
+
+
+@pytest.mark.parametrize("fen", SPECIAL_POSITIONS)
+def test_next_position_key_of_every_move(fen):
+    board = chess.Board(fen)
+    key = position_key(board)
+    for move in board.legal_moves:
+        next_key = next_position_key(board, move, key)
+        board.push(move)
+        assert next_key is None or next_key == chess.polyglot.zobrist_hash(board), move
+        board.pop()
+
+
+def test_cache_drops_the_least_recently_used_entry():
+    cache = EvaluationCache(max_bytes=2 * 160)
+    cache.put(1, 0.1)
+    cache.put(2, 0.2)
+    assert cache.get(1) == 0.1
+    cache.put(3, 0.3)
+    assert cache.get(2) is None
+    assert cache.stats()["evictions"] == 1 and cache.hits == 1 and cache.misses == 1
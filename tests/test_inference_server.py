@@ -0,0 +1,83 @@
+import threading
+import time
+
+import chess
+import numpy
+import pytest
+
+from chess_api.chess_player import CustomEngine
+from neural_network.inference_server import InferenceServer
+
+
+# Evaluates a board by its number of pieces and counts the forward passes
+class CountingNetwork:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def predict_evaluations(self, boards):
+        self.calls += 1
+        time.sleep(self.delay)
+        return numpy.array([len(board.piece_map()) / 100 for board in boards])
+
+
+def test_concurrent_requests_are_batched():
+    network = CountingNetwork(delay=0.01)
+    boards = []
+    for pieces in range(8):
+        board = chess.Board()
+        for square in range(pieces):
+            board.remove_piece_at(chess.A2 + square)
+        boards.append(board)
+    expected = network.predict_evaluations(boards)
+    network.calls = 0
+    with InferenceServer(network, max_wait_us=20_000) as server:
+        futures = [server.submit([board]) for board in boards]
+        results = [future.result(timeout=5)[0] for future in futures]
+    assert results == pytest.approx(list(expected))
+    assert server.positions == len(boards)
+    assert network.calls == server.batches < len(boards)
+
+
+def test_requests_after_close_fail():
+    server = InferenceServer(CountingNetwork())
+    assert server.predict_evaluations([chess.Board()]).shape == (1,)
+    server.close()
+    with pytest.raises(RuntimeError):
+        server.submit([chess.Board()]).result(timeout=1)
+    server.close()
+
+
+def test_close_answers_every_pending_request():
+    server = InferenceServer(CountingNetwork(delay=0.2), max_wait_us=0)
+    first = server.submit([chess.Board()])
+    time.sleep(0.05)
+    # The worker is still evaluating the first request while the server closes and another request comes in
+    closing = threading.Thread(target=server.close)
+    closing.start()
+    time.sleep(0.05)
+    second = server.submit([chess.Board()])
+    assert isinstance(second.exception(timeout=2), RuntimeError)
+    assert first.result(timeout=2).shape == (1,)
+    closing.join()
+
+
+def test_engines_share_a_server():
+    network = CountingNetwork()
+    CustomEngine(network, depth=2).get_move(chess.Board())
+    requests = network.calls
+    network.calls = 0
+    with InferenceServer(network, max_wait_us=2_000) as server:
+        engines = [CustomEngine(server, depth=2) for _ in range(4)]
+        moves = [None] * len(engines)
+
+        def play(number):
+            moves[number] = engines[number].get_move(chess.Board())
+
+        threads = [threading.Thread(target=play, args=(number,)) for number in range(len(engines))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert all(move in chess.Board().legal_moves for move in moves)
+    assert network.calls < len(engines) * requests
@@ -0,0 +1,89 @@
+import sqlite3
+
+import chess
+
+from database import label_cache
+from database.label_cache import LabelCache, position_key
+
+STOCKFISH = "Stockfish 16 Hash=16 Threads=1"
+UPGRADED = "Stockfish 17 Hash=16 Threads=1"
+
+
+def _boards():
+    boards = [chess.Board()]
+    for move in ["e2e4", "e7e5", "g1f3", "b8c6", "f1b5"]:
+        board = boards[-1].copy()
+        board.push_uci(move)
+        boards.append(board)
+    return boards
+
+
+def test_hits_and_misses(tmp_path):
+    cache = LabelCache(str(tmp_path / "labels.sqlite"))
+    boards = _boards()
+    assert cache.get(boards[0], STOCKFISH, 10) is None
+    cache.put(boards[0], STOCKFISH, 10, 35, True)
+    cache.put_many(boards[1:3], STOCKFISH, 12, [(-20, True), (0, False)])
+
+    assert cache.get(boards[0], STOCKFISH, 10) == (35, True)
+    assert cache.get(boards[0], STOCKFISH, 8) == (35, True)
+    # A shallower label is no label for a deeper analysis
+    assert cache.get(boards[0], STOCKFISH, 11) is None
+    labels, depths = cache.get_many(boards, STOCKFISH, 10, with_depths=True)
+    assert labels == [(35, True), (-20, True), (0, False), None, None, None]
+    assert depths == [10, 12, 12, None, None, None]
+    assert (cache.hits, cache.misses) == (5, 5)
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_labels_belong_to_their_engine(tmp_path):
+    path = str(tmp_path / "labels.sqlite")
+    cache = LabelCache(path)
+    board = chess.Board()
+    cache.put(board, STOCKFISH, 10, 35, True)
+    assert cache.get(board, UPGRADED, 10) is None
+    cache.put(board, UPGRADED, 10, 20, True)
+    assert cache.get(board, STOCKFISH, 10) == (35, True)
+    assert cache.get(board, UPGRADED, 10) == (20, True)
+    cache.close()
+
+    # The labels are persistent and the engine ids are shared by every process using the database
+    cache = LabelCache(path)
+    assert cache.get(board, UPGRADED, 10) == (20, True)
+    assert len(cache) == 2
+    cache.close()
+
+
+def test_deeper_labels_replace_shallower_ones(tmp_path):
+    cache = LabelCache(str(tmp_path / "labels.sqlite"))
+    board = chess.Board()
+    cache.put(board, STOCKFISH, 10, 35, True)
+    cache.put(board, STOCKFISH, 8, 50, True)
+    assert cache.get_many([board], STOCKFISH, 0, with_depths=True) == ([(35, True)], [10])
+    cache.put(board, STOCKFISH, 14, 28, True)
+    assert cache.get_many([board], STOCKFISH, 0, with_depths=True) == ([(28, True)], [14])
+    cache.close()
+
+
+def test_keys_fit_into_sqlite(tmp_path):
+    keys = [position_key(board) for board in _boards()]
+    assert all(-(1 << 63) <= key < 1 << 63 for key in keys)
+    assert len(set(keys)) == len(keys)
+    connection = sqlite3.connect(str(tmp_path / "keys.sqlite"))
+    connection.execute("CREATE TABLE keys (key INTEGER)")
+    connection.executemany("INSERT INTO keys VALUES (?)", [(key,) for key in keys])
+    connection.close()
+
+
+def test_no_cache_unless_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv("LABEL_CACHE_PATH", raising=False)
+    monkeypatch.setattr(label_cache, "_default_cache", None)
+    monkeypatch.setattr(label_cache, "_configured", False)
+    assert label_cache.get_label_cache() is None
+
+    path = str(tmp_path / "job" / "labels.sqlite")
+    cache = label_cache.configure_label_cache(path)
+    assert label_cache.get_label_cache() is cache and cache.path == path
+    assert label_cache.configure_label_cache(None) is None
+    assert label_cache.get_label_cache() is None
@@ -0,0 +1,54 @@
+import functools
+import math
+
+import numpy
+import pytest
+
+from chess_api import match_runner
+from chess_api.match_runner import elo_estimate
+from neural_network.nnue import NNUEModel, FEATURES
+
+
+def test_single_game_is_not_even():
+    assert elo_estimate(1, 0, 0)[0] > 0
+    assert elo_estimate(0, 0, 1)[0] < 0
+    assert elo_estimate(0, 1, 0)[0] == 0
+
+
+@pytest.mark.parametrize("wins, draws, losses", [(1, 0, 0), (10, 0, 0), (6, 2, 2), (50, 30, 20)])
+def test_estimate_is_symmetric_and_finite(wins, draws, losses):
+    elo, margin = elo_estimate(wins, draws, losses)
+    assert elo_estimate(losses, draws, wins) == pytest.approx((-elo, margin))
+    assert math.isfinite(elo) and 0 < margin < math.inf
+
+
+def test_margin_shrinks_with_more_games():
+    assert elo_estimate(60, 20, 20)[1] < elo_estimate(6, 2, 2)[1]
+    assert elo_estimate(0, 0, 0) == (0.0, math.inf)
+
+
+def _nnue_model(path):
+    rng = numpy.random.default_rng(0)
+    model = NNUEModel()
+    model.layers = [(rng.normal(0, 0.1, (FEATURES, 16)).astype(numpy.float32), numpy.zeros(16, numpy.float32)),
+                    (rng.normal(0, 0.1, (16, 1)).astype(numpy.float32), numpy.zeros(1, numpy.float32))]
+    model.save(path)
+    return path
+
+
+def test_threads_of_a_worker_share_one_network(tmp_path):
+    model_path = _nnue_model(str(tmp_path / "nnue.npz"))
+    player = functools.partial(match_runner.custom_player, model_path, 1)
+    match_runner._init_worker(player, match_runner.random_player, None, threads=2)
+    openings = [match_runner._opening_board(line) for line in match_runner.DEFAULT_OPENINGS[:2]]
+    games = match_runner._play_games([(number, openings[number], True, 1.0, 6) for number in range(2)])
+    assert len(games) == 2
+    server = match_runner._servers[model_path]
+    assert server.positions > 0
+    server.close()
+
+
+def test_match_with_threads_plays_every_game():
+    result = match_runner.run_match(match_runner.random_player, match_runner.random_player, games=5, workers=1,
+                                    move_time=1.0, max_plies=10, threads=2)
+    assert result.games == 5
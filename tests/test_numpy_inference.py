@@ -0,0 +1,95 @@
+import random
+
+import numpy
+import pytest
+
+from database.database_random import random_board
+from database.util import board_to_obs_batch
+
+keras = pytest.importorskip("keras")
+
+from keras.layers import Input, Conv2D, Dense, Flatten, BatchNormalization, Activation, Add, Reshape, Cropping1D, \
+    ReLU
+
+from neural_network.nnue import NNUEModel
+from neural_network.numpy_inference import NumpyModel, export_numpy_model
+
+
+def convolutional_network():
+    input_layer = Input(shape=(14, 8, 8))
+    x = input_layer
+    for _ in range(2):
+        x = Conv2D(filters=8, kernel_size=3, padding="same", activation="relu", data_format="channels_first")(x)
+    x = Flatten()(x)
+    x = Dense(16, activation="relu")(x)
+    x = Dense(1, activation="sigmoid")(x)
+    return keras.Model(inputs=input_layer, outputs=x)
+
+
+# The residual network of create_residual_network normalizes the last axis,
+# the other batch normalizations cover folding into the channels and a normalization that can not be folded
+def residual_network():
+    input_layer = Input(shape=(14, 8, 8))
+    x = Conv2D(filters=8, kernel_size=3, padding="same", data_format="channels_first")(input_layer)
+    previous = x
+    x = Conv2D(filters=8, kernel_size=3, padding="same", data_format="channels_first")(x)
+    x = BatchNormalization()(x)
+    x = Activation("relu")(x)
+    x = Conv2D(filters=8, kernel_size=3, padding="same", data_format="channels_first")(x)
+    x = BatchNormalization(axis=1)(x)
+    x = Add()([x, previous])
+    x = Activation("relu")(x)
+    x = BatchNormalization(axis=1)(x)
+    x = Flatten()(x)
+    x = Dense(1, "sigmoid")(x)
+    return keras.Model(inputs=input_layer, outputs=x)
+
+
+def nnue_network():
+    input_layer = Input(shape=(14, 8, 8))
+    x = Reshape((14, 64))(input_layer)
+    x = Cropping1D((0, 2))(x)
+    x = Flatten()(x)
+    x = Dense(32)(x)
+    x = ReLU(max_value=1)(x)
+    x = Dense(8)(x)
+    x = ReLU(max_value=1)(x)
+    x = Dense(1, activation="sigmoid")(x)
+    return keras.Model(inputs=input_layer, outputs=x)
+
+
+# Fresh batch normalizations compute the identity, so they get statistics as after a training
+def randomize_batch_norms(model, rng):
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            gamma, beta, mean, variance = layer.get_weights()
+            layer.set_weights([rng.uniform(0.5, 1.5, gamma.shape), rng.normal(0, 0.5, beta.shape),
+                               rng.normal(0, 0.5, mean.shape), rng.uniform(0.5, 2, variance.shape)])
+
+
+@pytest.fixture(scope="module")
+def observations():
+    rng = random.Random(0)
+    return board_to_obs_batch([random_board(rng=rng) for _ in range(64)]).astype(numpy.float32)
+
+
+@pytest.mark.parametrize("create_network", [convolutional_network, residual_network])
+def test_numpy_model_matches_keras(create_network, observations, tmp_path):
+    keras.utils.set_random_seed(0)
+    model = create_network()
+    randomize_batch_norms(model, numpy.random.default_rng(0))
+    path = str(tmp_path / "model.npz")
+    export_numpy_model(model, path)
+    expected = model(observations, training=False).numpy()
+    numpy.testing.assert_allclose(NumpyModel(path).predict(observations), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_nnue_model_matches_keras(observations, tmp_path):
+    keras.utils.set_random_seed(0)
+    model = nnue_network()
+    path = str(tmp_path / "nnue.npz")
+    NNUEModel.from_keras(model).save(path)
+    rng = random.Random(1)
+    boards = [random_board(rng=rng) for _ in range(32)]
+    expected = model(board_to_obs_batch(boards).astype(numpy.float32), training=False).numpy().ravel()
+    numpy.testing.assert_allclose(NNUEModel(path).predict_evaluations(boards), expected, rtol=1e-4, atol=1e-5)
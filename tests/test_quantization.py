@@ -0,0 +1,48 @@
+import random
+
+import numpy
+import pytest
+
+from database.database_random import random_board
+from database.util import board_to_obs_batch
+
+keras = pytest.importorskip("keras")
+
+from neural_network.quantization import quantize_keras_model, QuantizedModel, QuantizedEvaluationNetwork
+
+
+@pytest.fixture(scope="module")
+def quantized(tmp_path_factory):
+    keras.utils.set_random_seed(0)
+    input_layer = keras.layers.Input(shape=(14, 8, 8))
+    x = keras.layers.Conv2D(8, 3, padding="same", activation="relu", data_format="channels_first")(input_layer)
+    x = keras.layers.Flatten()(x)
+    x = keras.layers.Dense(1, activation="sigmoid")(x)
+    model = keras.Model(inputs=input_layer, outputs=x)
+
+    rng = random.Random(0)
+    boards = [random_board(rng=rng) for _ in range(300)]
+    path = str(tmp_path_factory.mktemp("quantized") / "model.tflite")
+    quantize_keras_model(model, path, board_to_obs_batch(boards[:200]))
+    return model, path, boards[200:]
+
+
+def test_quantized_model_is_close_to_float_model(quantized):
+    model, path, boards = quantized
+    x = board_to_obs_batch(boards).astype(numpy.float32)
+    expected = model.predict(x, verbose=0).ravel()
+    numpy.testing.assert_allclose(QuantizedModel(path).predict(x).ravel(), expected, atol=0.02)
+
+
+def test_batches_of_any_size_are_padded(quantized):
+    model, path, boards = quantized
+    network = QuantizedEvaluationNetwork(path)
+    batch = network.predict_evaluations(boards[:5])
+    assert batch.shape == (5,)
+    numpy.testing.assert_allclose([network.predict_evaluation(board) for board in boards[:5]], batch, atol=1e-6)
+
+
+def test_calibration_needs_positions(quantized, tmp_path):
+    model, path, boards = quantized
+    with pytest.raises(ValueError):
+        quantize_keras_model(model, str(tmp_path / "empty.tflite"), numpy.zeros((0, 14, 8, 8)))
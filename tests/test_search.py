@@ -0,0 +1,68 @@
+import math
+
+import chess
+import chess.polyglot
+import numpy
+import pytest
+
+from neural_network.search import SearchEngine, MATE_SCORE, MATE_PLY_PENALTY
+
+# White mates in 3 plies: Rd8+ Rxd8 Rxd8#
+MATE_IN_TWO = "2r3k1/5ppp/8/8/8/8/3R1PPP/3R2K1 w - - 0 1"
+
+
+# Evaluates every position as equal, or as won for white while a white knight stands on g1
+class StubNetwork:
+    def __init__(self, knight_on_g1: bool = False):
+        self.knight_on_g1 = knight_on_g1
+
+    def predict_evaluations(self, boards):
+        return numpy.array([0.9 if self.knight_on_g1 and board.piece_at(chess.G1) == chess.Piece.from_symbol("N")
+                            else 0.5 for board in boards])
+
+
+def test_mate_distance_is_relative_to_the_probing_ply():
+    board = chess.Board(MATE_IN_TWO)
+    engine = SearchEngine(StubNetwork(), max_depth=3)
+    result = engine.search(board)
+    assert result.score == pytest.approx(MATE_SCORE - 3 * MATE_PLY_PENALTY)
+
+    # The same position reached two plies deeper is a mate two plies further away from that root
+    entry = engine.table.probe(chess.polyglot.zobrist_hash(board))
+    assert entry is not None
+    score, _ = engine._negamax(board, entry[1], -math.inf, math.inf, 2, set())
+    assert score == pytest.approx(MATE_SCORE - 5 * MATE_PLY_PENALTY)
+
+
+def _knight_shuffle():
+    board = chess.Board()
+    for move in ["g1f3", "g8f6", "f3g1", "f6g8", "g1f3", "g8f6"]:
+        board.push_uci(move)
+    return board
+
+
+def test_repetitions_of_the_game_before_the_root_are_draws():
+    # Without the game history, Nf3-g1 reaches a won position
+    board = chess.Board(_knight_shuffle().fen())
+    result = SearchEngine(StubNetwork(knight_on_g1=True), max_depth=1).search(board)
+    assert result.move == chess.Move.from_uci("f3g1")
+    assert result.score == pytest.approx(0.4)
+
+    # With it, the position after Nf3-g1 is a repetition
+    board = _knight_shuffle()
+    engine = SearchEngine(StubNetwork(knight_on_g1=True), max_depth=1)
+    result = engine.search(board)
+    assert result.score == pytest.approx(0.0)
+    assert len(board.move_stack) == 6
+
+
+def test_repetition_draws_are_not_stored():
+    board = _knight_shuffle()
+    engine = SearchEngine(StubNetwork(knight_on_g1=True), max_depth=2)
+    engine.search(board)
+    assert engine.table.probe(chess.polyglot.zobrist_hash(board)) is None
+
+    # The same position without the history has no repetition, its score is stored
+    board = chess.Board(board.fen())
+    engine.search(board)
+    assert engine.table.probe(chess.polyglot.zobrist_hash(board)) is not None
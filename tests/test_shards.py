@@ -0,0 +1,176 @@
+import os
+import pickle
+import struct
+
+import chess
+import numpy
+import pytest
+
+from database.shards import write_shard, open_shard, open_shard_depths, convert_pickle_datasets, pack_obs, \
+    unpack_obs, ShardedArray, PackedObservations, HEADER_FORMAT, FLAGS_FORMAT, HEADER_SIZE, SHARD_MAGIC, \
+    SHARD_VERSION, OBS_SHAPE, PACKED_SIZE, FLAG_PACKED, FLAG_DEPTHS
+from database.util import DataSet, load_datasets, board_to_obs, board_to_bitboards
+
+
+def _samples(count: int, seed: int = 0):
+    rng = numpy.random.default_rng(seed)
+    x_train = rng.integers(0, 2, (count,) + OBS_SHAPE).astype(numpy.int8)
+    y_train = rng.normal(0, 300, count).astype(numpy.float32)
+    return x_train, y_train
+
+
+def _header(path: str):
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    return struct.unpack_from(HEADER_FORMAT, header) + \
+        struct.unpack_from(FLAGS_FORMAT, header, struct.calcsize(HEADER_FORMAT))
+
+
+def test_unpacked_round_trip(tmp_path):
+    path = str(tmp_path / "data.shard")
+    x_train, y_train = _samples(10)
+    write_shard(path, x_train, y_train, packed=False)
+    assert _header(path) == (SHARD_MAGIC, SHARD_VERSION, 10, 0)
+    assert os.path.getsize(path) == HEADER_SIZE + x_train.nbytes + y_train.nbytes
+
+    x, y = open_shard(path)
+    assert isinstance(x, numpy.memmap)
+    numpy.testing.assert_array_equal(x, x_train)
+    numpy.testing.assert_array_equal(y, y_train)
+    assert open_shard_depths(path) is None
+
+
+def test_depths_round_trip(tmp_path):
+    path = str(tmp_path / "data.shard")
+    x_train, y_train = _samples(7)
+    depths = [1, 4, 10, 300, 0, 12, 8]
+    for packed in [False, True]:
+        write_shard(path, x_train, y_train, packed=packed, depths=depths)
+        assert _header(path)[3] & FLAG_DEPTHS
+        numpy.testing.assert_array_equal(open_shard_depths(path), [1, 4, 10, 255, 0, 12, 8])
+        x, y = open_shard(path)
+        numpy.testing.assert_array_equal(numpy.asarray(x), x_train)
+        numpy.testing.assert_array_equal(y, y_train)
+
+
+def test_empty_shard(tmp_path):
+    path = str(tmp_path / "empty.shard")
+    write_shard(path, numpy.zeros((0,) + OBS_SHAPE), [], depths=[])
+    x, y = open_shard(path)
+    assert len(x) == len(y) == 0
+    assert len(open_shard_depths(path)) == 0
+
+
+# Version 1 shards have no flags and unpacked observations
+def test_version_1_shard(tmp_path):
+    path = str(tmp_path / "old.shard")
+    x_train, y_train = _samples(3)
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, SHARD_MAGIC, 1, 3).ljust(HEADER_SIZE, b"\0"))
+        file.write(x_train.tobytes())
+        file.write(y_train.tobytes())
+    x, y = open_shard(path)
+    numpy.testing.assert_array_equal(x, x_train)
+    numpy.testing.assert_array_equal(y, y_train)
+    assert open_shard_depths(path) is None
+
+
+def test_invalid_shards(tmp_path):
+    path = str(tmp_path / "data.shard")
+    with pytest.raises(ValueError):
+        write_shard(path, *_samples(3)[:1], [0.0, 1.0])
+    with pytest.raises(ValueError):
+        write_shard(path, *_samples(3), depths=[1])
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, b"NOSHARD\0", 2, 0).ljust(HEADER_SIZE, b"\0"))
+    with pytest.raises(RuntimeError):
+        open_shard(path)
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, SHARD_MAGIC, SHARD_VERSION + 1, 0).ljust(HEADER_SIZE, b"\0"))
+    with pytest.raises(RuntimeError):
+        open_shard(path)
+
+
+def test_convert_pickle_datasets(tmp_path):
+    pickle_folder = tmp_path / "pickles"
+    pickle_folder.mkdir()
+    parts = [_samples(5, seed=1), _samples(3, seed=2)]
+    for number, (x_train, y_train) in enumerate(parts):
+        with open(pickle_folder / f"part_{number}.pickle", "wb") as file:
+            pickle.dump(DataSet(x_train.tolist(), y_train.tolist()), file)
+
+    convert_pickle_datasets(str(pickle_folder), str(tmp_path / "shards"))
+    assert sorted(os.listdir(tmp_path / "shards")) == ["part_0.shard", "part_1.shard"]
+    for number, (x_train, y_train) in enumerate(parts):
+        x, y = open_shard(str(tmp_path / "shards" / f"part_{number}.shard"))
+        numpy.testing.assert_array_equal(numpy.asarray(x), x_train)
+        numpy.testing.assert_array_equal(y, y_train)
+
+    # Pickles next to a shard of the same name are not loaded twice
+    convert_pickle_datasets(str(pickle_folder))
+    x, y = load_datasets(str(pickle_folder))
+    numpy.testing.assert_array_equal(x[:], numpy.concatenate([parts[0][0], parts[1][0]]))
+    numpy.testing.assert_array_equal(y, numpy.concatenate([parts[0][1], parts[1][1]]))
+
+
+def test_sharded_array_indexing():
+    parts = [_samples(count, seed=count)[0] for count in [4, 0, 3, 5]]
+    array = ShardedArray(parts)
+    expected = numpy.concatenate(parts)
+    assert len(array) == 12 and array.shape == expected.shape
+    numpy.testing.assert_array_equal(array[2:9], expected[2:9])
+    numpy.testing.assert_array_equal(array[::3], expected[::3])
+    numpy.testing.assert_array_equal(array[[11, 0, 5, -1]], expected[[11, 0, 5, -1]])
+    numpy.testing.assert_array_equal(array[6], expected[6])
+    numpy.testing.assert_array_equal(array[3:7, 1], expected[3:7, 1])
+    with pytest.raises(IndexError):
+        array[12]
+
+
+def test_pack_and_unpack():
+    x_train, _ = _samples(9)
+    packed = pack_obs(x_train)
+    assert packed.shape == (9, PACKED_SIZE) and packed.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(unpack_obs(packed), x_train)
+    assert unpack_obs(packed).dtype == numpy.int8
+    numpy.testing.assert_array_equal(unpack_obs(packed, numpy.float32), x_train.astype(numpy.float32))
+    numpy.testing.assert_array_equal(unpack_obs(packed[3]), x_train[3])
+
+
+# A packed observation are the bitboards of the position as big endian bytes
+def test_packed_observations_are_bitboards():
+    board = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4")
+    bitboards = numpy.array(board_to_bitboards(board), dtype=">u8")
+    numpy.testing.assert_array_equal(pack_obs(board_to_obs(board))[0], bitboards.view(numpy.uint8))
+
+
+def test_packed_round_trip(tmp_path):
+    path = str(tmp_path / "data.shard")
+    x_train, y_train = _samples(10)
+    write_shard(path, x_train, y_train)
+    assert _header(path) == (SHARD_MAGIC, SHARD_VERSION, 10, FLAG_PACKED)
+    assert os.path.getsize(path) == HEADER_SIZE + 10 * PACKED_SIZE + y_train.nbytes
+
+    x, y = open_shard(path)
+    assert isinstance(x, PackedObservations)
+    assert x.shape == x_train.shape and len(x) == 10
+    numpy.testing.assert_array_equal(numpy.asarray(x), x_train)
+    numpy.testing.assert_array_equal(x[2:5], x_train[2:5])
+    numpy.testing.assert_array_equal(x[[7, 1]], x_train[[7, 1]])
+    numpy.testing.assert_array_equal(y, y_train)
+
+    # Already packed observations are written as they are, or unpacked for an unpacked shard
+    write_shard(path, x.packed, y_train)
+    numpy.testing.assert_array_equal(numpy.asarray(open_shard(path)[0]), x_train)
+    write_shard(path, x.packed, y_train, packed=False)
+    numpy.testing.assert_array_equal(open_shard(path)[0], x_train)
+
+
+def test_sharded_array_of_packed_shards(tmp_path):
+    parts = [_samples(4, seed=1), _samples(6, seed=2)]
+    for number, (x_train, y_train) in enumerate(parts):
+        write_shard(str(tmp_path / f"part_{number}.shard"), x_train, y_train)
+    x, y = load_datasets(str(tmp_path))
+    expected = numpy.concatenate([parts[0][0], parts[1][0]])
+    numpy.testing.assert_array_equal(x[[9, 0, 4, 3]], expected[[9, 0, 4, 3]])
+    numpy.testing.assert_array_equal(numpy.asarray(x), expected)